@@ -0,0 +1,216 @@
+import asyncio
+import datetime
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, List, Optional
+
+from telethon.errors import FloodWaitError
+from telethon.tl.types import (Channel, ChatPhotoEmpty, Document,
+                               DocumentAttributeFilename,
+                               InputMessagesFilterDocument, Message,
+                               MessageEntityHashtag, MessageEntityUrl,
+                               MessageFwdHeader, MessageMediaDocument,
+                               MessageMediaPhoto, MessageReactions,
+                               PeerChannel, Photo, PhotoSize, ReactionCount,
+                               ReactionEmoji)
+
+# Telegram returns history in pages of up to 100 messages per request.
+PAGE_SIZE = 100
+# Size of the chunks iter_download yields, one request each.
+DOWNLOAD_CHUNK_SIZE = 128 * 1024
+START_DATE = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def file_content(file_id: int, size: int) -> bytes:
+    """size bytes that differ between files, so stored blobs are not deduplicated."""
+    return (file_id.to_bytes(8, "big") * (size // 8 + 1))[:size]
+
+
+@dataclass
+class SyntheticChannel:
+    """
+    A channel whose messages are generated from their id, so every run sees
+    the same history. Every photo_every-th message has a photo, every
+    document_every-th a document and every forward_every-th is forwarded
+    from forward_source. 0 turns a kind of message off.
+    """
+
+    channel_id: int
+    username: str
+    messages: int
+    photo_every: int = 5
+    document_every: int = 50
+    forward_every: int = 10
+    forward_source: Optional[int] = None
+    photo_size: int = 100 * 1024
+    document_size: int = 256 * 1024
+
+    def has(self, every: int, message_id: int) -> bool:
+        return every > 0 and message_id % every == 0
+
+    def entity(self) -> Channel:
+        return Channel(
+            id=self.channel_id,
+            title="Synthetic %s" % self.username,
+            photo=ChatPhotoEmpty(),
+            date=START_DATE,
+            username=self.username,
+            access_hash=self.channel_id,
+            participants_count=1000,
+        )
+
+    def media(self, message_id: int):
+        if self.has(self.document_every, message_id):
+            return MessageMediaDocument(
+                document=Document(
+                    id=self.channel_id * 10_000_000 + message_id,
+                    access_hash=0,
+                    file_reference=b"",
+                    date=START_DATE,
+                    mime_type="application/pdf",
+                    size=self.document_size,
+                    dc_id=2,
+                    attributes=[DocumentAttributeFilename(file_name="doc_%s.pdf" % message_id)],
+                )
+            )
+        if self.has(self.photo_every, message_id):
+            return MessageMediaPhoto(
+                photo=Photo(
+                    id=self.channel_id * 10_000_000 + message_id,
+                    access_hash=0,
+                    file_reference=b"",
+                    date=START_DATE,
+                    sizes=[PhotoSize(type="x", w=800, h=600, size=self.photo_size)],
+                    dc_id=2,
+                )
+            )
+        return None
+
+    def message(self, message_id: int) -> Message:
+        date = START_DATE + datetime.timedelta(minutes=message_id)
+        text = "Post %s about #leaks at example.org/%s" % (message_id, message_id)
+        url_offset = text.index("example.org")
+        fwd_from = None
+        if self.forward_source is not None and self.has(self.forward_every, message_id):
+            fwd_from = MessageFwdHeader(
+                date=date, from_id=PeerChannel(self.forward_source), channel_post=message_id
+            )
+        return Message(
+            id=message_id,
+            peer_id=PeerChannel(self.channel_id),
+            date=date,
+            message=text,
+            entities=[
+                MessageEntityHashtag(offset=text.index("#"), length=len("#leaks")),
+                MessageEntityUrl(offset=url_offset, length=len(text) - url_offset),
+            ],
+            media=self.media(message_id),
+            fwd_from=fwd_from,
+            views=message_id * 3,
+            forwards=message_id % 7,
+            reactions=MessageReactions(
+                results=[ReactionCount(reaction=ReactionEmoji("👍"), count=message_id % 11 + 1)]
+            ),
+        )
+
+
+class FakeTelegramClient:
+    """
+    In-process stand-in for TelegramClient serving SyntheticChannels.
+
+    Every request sleeps for latency seconds, and every flood_wait_every-th
+    request raises a FloodWaitError of flood_wait_seconds instead, like
+    Telegram does under load. Counters tell how much a run requested and
+    downloaded.
+    """
+
+    def __init__(
+        self,
+        channels: List[SyntheticChannel],
+        latency: float = 0.0,
+        flood_wait_every: int = 0,
+        flood_wait_seconds: int = 0,
+    ) -> None:
+        self.channels: Dict[str, SyntheticChannel] = {c.username: c for c in channels}
+        self.channels_by_id: Dict[int, SyntheticChannel] = {c.channel_id: c for c in channels}
+        self.latency = latency
+        self.flood_wait_every = flood_wait_every
+        self.flood_wait_seconds = flood_wait_seconds
+        self.flood_sleep_threshold = 60
+        self.requests = 0
+        self.flood_waits = 0
+        self.bytes_downloaded = 0
+
+    def _channel(self, entity) -> SyntheticChannel:
+        if isinstance(entity, PeerChannel):
+            entity = entity.channel_id
+        if isinstance(entity, Channel):
+            entity = entity.id
+        if isinstance(entity, int):
+            return self.channels_by_id[entity]
+        return self.channels[entity.rsplit("/", 1)[-1]]
+
+    async def _request(self) -> None:
+        self.requests += 1
+        if self.flood_wait_every and self.requests % self.flood_wait_every == 0:
+            self.flood_waits += 1
+            raise FloodWaitError(request=None, capture=self.flood_wait_seconds)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def get_entity(self, entity) -> Channel:
+        await self._request()
+        return self._channel(entity).entity()
+
+    async def get_messages(self, entity, ids=None, **kwargs) -> List[Optional[Message]]:
+        channel = self._channel(entity)
+        await self._request()
+        return [
+            channel.message(message_id) if 0 < message_id <= channel.messages else None
+            for message_id in ids
+        ]
+
+    async def iter_messages(
+        self,
+        entity,
+        limit=None,
+        min_id=0,
+        max_id=0,
+        reverse=False,
+        filter=None,
+        wait_time=None,
+        **kwargs,
+    ) -> AsyncIterator[Message]:
+        channel = self._channel(entity)
+        message_ids = range(min_id + 1, min(max_id or channel.messages + 1, channel.messages + 1))
+        if not reverse:
+            message_ids = reversed(message_ids)
+        if filter is InputMessagesFilterDocument:
+            message_ids = (i for i in message_ids if channel.has(channel.document_every, i))
+        yielded = 0
+        for message_id in message_ids:
+            if limit is not None and yielded >= limit:
+                return
+            if yielded % PAGE_SIZE == 0:
+                await self._request()
+            yielded += 1
+            yield channel.message(message_id)
+
+    async def download_media(self, message: Message, file=None, progress_callback=None) -> bytes:
+        await self._request()
+        photo = message.media.photo
+        size = photo.sizes[-1].size
+        self.bytes_downloaded += size
+        return file_content(photo.id, size)
+
+    async def iter_download(
+        self, file, offset: int = 0, limit=None, file_size=None, **kwargs
+    ) -> AsyncIterator[bytes]:
+        size = file_size or file.document.size
+        chunks = 0
+        while offset < size and (limit is None or chunks < limit):
+            await self._request()
+            chunk = file_content(file.document.id, min(DOWNLOAD_CHUNK_SIZE, size - offset))
+            offset += len(chunk)
+            chunks += 1
+            self.bytes_downloaded += len(chunk)
+            yield chunk
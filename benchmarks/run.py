@@ -0,0 +1,226 @@
+"""
+Benchmark the scrape pipeline end to end against FakeTelegramClient.
+
+    python -m benchmarks.run --scenario small
+
+Runs the same code as `python main.py` after login: channel info, full
+history backfill, photo and document downloads by the worker pools. Every
+run is appended to benchmarks/results.jsonl and compared with the last run
+of the same configuration, so regressions show up as a drop in the rates.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from dataclasses import asdict, dataclass, replace
+from typing import List, Optional
+
+from benchmarks.fake_client import FakeTelegramClient, SyntheticChannel
+from main import scrape
+from src.blobstore import BlobStore
+from src.db import Database
+from src.entity_cache import EntityCache, EntityCachingClient
+from src.ratelimit import RateLimit, RateLimitedClient, RateLimiter
+
+RESULTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results.jsonl")
+# A request budget so large that the benchmark measures the scraper, not
+# the RateLimiter. --telegram-rate-limits uses the real budget instead.
+UNLIMITED_RATE_LIMITS = {
+    request_class: RateLimit(requests_per_second=1e6, burst=1e6)
+    for request_class in ("entity", "messages", "download")
+}
+
+
+@dataclass
+class BenchmarkConfig:
+    scenario: str
+    channels: int
+    messages_per_channel: int
+    latency: float = 0.0
+    flood_wait_every: int = 0
+    flood_wait_seconds: int = 0
+    telegram_rate_limits: bool = False
+
+
+SCENARIOS = {
+    "small": BenchmarkConfig("small", channels=2, messages_per_channel=2000),
+    "large": BenchmarkConfig("large", channels=4, messages_per_channel=20000),
+    # Network latency and a flood wait every 50 requests.
+    "flaky": BenchmarkConfig(
+        "flaky", channels=2, messages_per_channel=2000, latency=0.005, flood_wait_every=50
+    ),
+}
+
+
+class CountingDatabase(Database):
+    """Database that counts its committed transactions."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.commits = 0
+
+    @asynccontextmanager
+    async def db_cursor(self):
+        async with super().db_cursor() as cursor:
+            yield cursor
+        self.commits += 1
+
+
+def synthetic_channels(config: BenchmarkConfig) -> List[SyntheticChannel]:
+    # Every channel forwards posts of the one before it.
+    channel_ids = [1000 + i for i in range(config.channels)]
+    return [
+        SyntheticChannel(
+            channel_id,
+            "synthetic%s" % i,
+            config.messages_per_channel,
+            forward_source=channel_ids[i - 1],
+        )
+        for i, channel_id in enumerate(channel_ids)
+    ]
+
+
+def get_peak_rss_mb() -> float:
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KiB everywhere else.
+    return peak_rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def get_git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(RESULTS_FILE),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_benchmark(config: BenchmarkConfig, directory: str) -> dict:
+    """Scrape the synthetic channels of config into a new database in directory."""
+    channels = synthetic_channels(config)
+    fake_client = FakeTelegramClient(
+        channels, config.latency, config.flood_wait_every, config.flood_wait_seconds
+    )
+    limiter = RateLimiter(
+        None if config.telegram_rate_limits else UNLIMITED_RATE_LIMITS, flood_wait_margin=0
+    )
+    async with CountingDatabase(
+        os.path.join(directory, "benchmark.db"), BlobStore(os.path.join(directory, "blobs"))
+    ) as db:
+        await db.create_schema()
+        client = EntityCachingClient(RateLimitedClient(fake_client, limiter), EntityCache(db))
+        db.commits = 0
+        started = time.perf_counter()
+        await scrape(client, db, [channel.username for channel in channels])
+        seconds = time.perf_counter() - started
+        async with db.db_cursor() as cursor:
+            await cursor.execute("SELECT COUNT(*) FROM messages")
+            messages = (await cursor.fetchone())[0]
+        download_jobs = await db.count_download_jobs()
+
+    return {
+        "seconds": round(seconds, 3),
+        "messages": messages,
+        "messages_per_second": round(messages / seconds, 1),
+        "bytes_downloaded": fake_client.bytes_downloaded,
+        "bytes_per_second": round(fake_client.bytes_downloaded / seconds),
+        "requests": fake_client.requests,
+        "flood_waits": fake_client.flood_waits,
+        "db_commits": db.commits,
+        "download_jobs": download_jobs,
+        "peak_rss_mb": round(get_peak_rss_mb(), 1),
+    }
+
+
+def load_previous_result(config: BenchmarkConfig, results_file: str) -> Optional[dict]:
+    if not os.path.exists(results_file):
+        return None
+    previous = None
+    with open(results_file) as file:
+        for line in file:
+            result = json.loads(line)
+            if result["config"] == asdict(config):
+                previous = result
+    return previous
+
+
+def format_report(result: dict, previous: Optional[dict]) -> str:
+    lines = ["%s: %s" % (key, value) for key, value in result["metrics"].items()]
+    if previous is not None:
+        for key in ("messages_per_second", "bytes_per_second"):
+            old, new = previous["metrics"][key], result["metrics"][key]
+            if old:
+                lines.append(
+                    "%s vs %s (%s): %+.1f%%"
+                    % (key, previous["commit"], previous["timestamp"], (new - old) / old * 100)
+                )
+    return "\n".join(lines)
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scenario", choices=list(SCENARIOS), default="small")
+    parser.add_argument("--channels", type=int, help="number of synthetic channels")
+    parser.add_argument("--messages", type=int, help="messages per channel")
+    parser.add_argument("--latency", type=float, help="seconds per request")
+    parser.add_argument("--flood-wait-every", type=int, help="raise a FloodWaitError every N requests")
+    parser.add_argument("--flood-wait-seconds", type=int, help="seconds of each FloodWaitError")
+    parser.add_argument(
+        "--telegram-rate-limits", action="store_true", help="pace requests like a real account"
+    )
+    parser.add_argument("--results", default=RESULTS_FILE, help="JSONL file the result is appended to")
+    parser.add_argument("--no-save", action="store_true", help="do not append the result")
+    return parser.parse_args(argv)
+
+
+def get_config(args: argparse.Namespace) -> BenchmarkConfig:
+    overrides = {
+        "channels": args.channels,
+        "messages_per_channel": args.messages,
+        "latency": args.latency,
+        "flood_wait_every": args.flood_wait_every,
+        "flood_wait_seconds": args.flood_wait_seconds,
+        "telegram_rate_limits": args.telegram_rate_limits or None,
+    }
+    return replace(
+        SCENARIOS[args.scenario],
+        **{key: value for key, value in overrides.items() if value is not None},
+    )
+
+
+async def main(argv=None) -> None:
+    args = parse_args(argv)
+    config = get_config(args)
+    results_file = os.path.abspath(args.results)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        # Documents above the inline blob size are written to the working directory.
+        os.chdir(directory)
+        try:
+            metrics = await run_benchmark(config, directory)
+        finally:
+            os.chdir(cwd)
+    result = {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "commit": get_git_commit(),
+        "python": sys.version.split()[0],
+        "config": asdict(config),
+        "metrics": metrics,
+    }
+    print(format_report(result, load_previous_result(config, results_file)))
+    if not args.no_save:
+        with open(results_file, "a") as file:
+            file.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
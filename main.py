@@ -1,15 +1,33 @@
+import argparse
 import asyncio
 import os
+from functools import partial
 from typing import List
 
 import yaml
 from dotenv import load_dotenv
 
-from src.app import (download_document, download_large_media,
-                     download_messages, init_telegram_client, process_channel)
+from src.app import init_telegram_client, run_download_job, scrape_channel
+from src.archive import (ARCHIVE_TABLES, export_archive, format_archive_stats,
+                         import_archive)
+from src.blobstore import (DEFAULT_BLOB_INLINE_MAX_BYTES,
+                           DEFAULT_BLOB_STORE_DIR, BlobStore)
 from src.db import Database
+from src.entity_cache import EntityCache, EntityCachingClient
+from src.export import EXPORT_TABLES, export_parquet, format_export_stats
+from src.graph import (DEFAULT_DAMPING, DEFAULT_TOP_CHANNELS,
+                       format_channel_ranks, rank_channels, write_edges_csv)
+from src.jobs import (DEFAULT_DOWNLOAD_WORKERS, DEFAULT_LARGE_FILE_WORKERS,
+                      JOB_DOCUMENT, JOB_LARGE_FILE, JOB_PHOTO,
+                      DownloadWorkerPool)
+from src.live import LiveScraper
 from src.logging_config import logger
-from src.message import get_last_message_id
+from src.ratelimit import RateLimitedClient, RateLimiter
+from src.reconcile import reconcile_channel
+from src.refresh import refresh_channel
+from src.scheduler import DEFAULT_MAX_CONCURRENT_CHANNELS, ChannelScheduler
+from src.search import (DEFAULT_SEARCH_LIMIT, format_search_results,
+                        search_messages)
 
 load_dotenv()
 
@@ -22,65 +40,247 @@ def get_channels(yml_file: str) -> List[str]:
         logger.error("Error while reading yml file:\t%s" % type(e).__name__)
 
 
-async def main():
-    client = await init_telegram_client(
-        "snooper", os.getenv("PHONE"), int(os.getenv("API_ID")), os.getenv("API_HASH")
-    )
-    logger.info("Telegram client initialized")
-    db = Database(os.getenv("DB_NAME"))
-    await db.create_schema()
-    logger.info("Connection to database created")
-    tasks = []
-    channel_list = get_channels("telegram_channels.yml")
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Scrape the Telegram channels listed in telegram_channels.yml"
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("scrape", help="download new messages and media (default)")
+    for command, help_text in (
+        ("refresh", "update views, forwards, reactions and edits of recent messages"),
+        ("reconcile", "mark stored messages that were deleted in the channel"),
+    ):
+        pass_parser = subparsers.add_parser(command, help=help_text)
+        pass_parser.add_argument(
+            "--interval",
+            type=float,
+            default=None,
+            help="keep running and start a new pass every INTERVAL seconds",
+        )
+    subparsers.add_parser(
+        "live", help="follow the channels and store new posts, edits and deletions as they happen"
+    )
+    search_parser = subparsers.add_parser(
+        "search", help="full-text search over the stored messages"
+    )
+    search_parser.add_argument("query", help="words that must all appear in a message")
+    search_parser.add_argument(
+        "--channel", action="append", dest="channels", help="only this channel, repeatable"
+    )
+    search_parser.add_argument("--since", help="only messages from this date on (YYYY-MM-DD)")
+    search_parser.add_argument("--until", help="only messages before this date (YYYY-MM-DD)")
+    search_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT)
+    search_parser.add_argument(
+        "--raw", action="store_true", help="pass the query to SQLite FTS5 unchanged"
+    )
+    graph_parser = subparsers.add_parser(
+        "graph", help="rank channels by how influential they are in the forward graph"
+    )
+    graph_parser.add_argument("--output", help="also write the forward graph to this CSV file")
+    graph_parser.add_argument(
+        "--top", type=int, default=DEFAULT_TOP_CHANNELS, help="number of channels to print"
+    )
+    graph_parser.add_argument("--damping", type=float, default=DEFAULT_DAMPING)
+    export_parser = subparsers.add_parser(
+        "export", help="write messages, reactions and channels to partitioned Parquet files"
+    )
+    export_parser.add_argument("destination", help="directory of the Parquet files")
+    export_parser.add_argument(
+        "--table", action="append", dest="tables", choices=list(EXPORT_TABLES),
+        help="only this table, repeatable",
+    )
+    export_parser.add_argument(
+        "--full", action="store_true", help="write every partition, not only the changed ones"
+    )
+    for command, help_text in (
+        ("export-jsonl", "write the archive as JSONL files, one per table"),
+        ("import-jsonl", "merge JSONL files written by export-jsonl into this database"),
+    ):
+        archive_parser = subparsers.add_parser(command, help=help_text)
+        archive_parser.add_argument("directory", help="directory of the JSONL files")
+        archive_parser.add_argument(
+            "--table", action="append", dest="tables", choices=list(ARCHIVE_TABLES),
+            help="only this table, repeatable",
+        )
+    subparsers.choices["export-jsonl"].add_argument(
+        "--zstd", action="store_true", help="compress the files with zstandard"
+    )
+    subparsers.choices["import-jsonl"].add_argument(
+        "--restart", action="store_true", help="import from the first line, not from the saved offset"
+    )
+    args = parser.parse_args(argv)
+    args.command = args.command or "scrape"
+    return args
+
+
+def get_max_concurrent_channels() -> int:
+    return int(os.getenv("MAX_CONCURRENT_CHANNELS", DEFAULT_MAX_CONCURRENT_CHANNELS))
+
+
+def create_download_pools(client, db: Database) -> List[DownloadWorkerPool]:
+    handle_job = partial(run_download_job, client, db)
+    # Large files get their own workers, so they never hold up photos and documents.
+    return [
+        DownloadWorkerPool(
+            client,
+            db,
+            handle_job,
+            int(os.getenv("DOWNLOAD_WORKERS", DEFAULT_DOWNLOAD_WORKERS)),
+            kinds=(JOB_PHOTO, JOB_DOCUMENT),
+        ),
+        DownloadWorkerPool(
+            client,
+            db,
+            handle_job,
+            int(os.getenv("LARGE_FILE_WORKERS", DEFAULT_LARGE_FILE_WORKERS)),
+            kinds=(JOB_LARGE_FILE,),
+            batch_size=1,
+        ),
+    ]
+
+
+async def scrape(client, db: Database, channel_list: List[str]) -> None:
+    scheduler = ChannelScheduler(
+        partial(scrape_channel, client, db), get_max_concurrent_channels()
+    )
+    download_pools = create_download_pools(client, db)
+    downloads = asyncio.gather(*(pool.run() for pool in download_pools))
+    try:
+        await scheduler.run(channel_list)
+        logger.info("Channel timings:\n%s" % scheduler.format_timings())
+    finally:
+        for pool in download_pools:
+            pool.close()
+        await downloads
+    logger.info("Download jobs: %s" % await db.count_download_jobs())
+
+
+async def live(client, db: Database, channel_list: List[str]) -> None:
+    download_pools = create_download_pools(client, db)
+    downloads = asyncio.gather(*(pool.run() for pool in download_pools))
+    try:
+        await LiveScraper(client, db).run(channel_list)
+    finally:
+        for pool in download_pools:
+            pool.close()
+        await downloads
+
+
+async def run_passes(pipeline, channel_list: List[str], interval=None) -> None:
+    """Run pipeline for every channel once, or every interval seconds if given."""
+    while True:
+        scheduler = ChannelScheduler(pipeline, get_max_concurrent_channels())
+        await scheduler.run(channel_list)
+        logger.info("Channel timings:\n%s" % scheduler.format_timings())
+        if interval is None:
+            return
+        await asyncio.sleep(interval)
+
+
+async def search(db: Database, args: argparse.Namespace) -> None:
+    results = await search_messages(
+        db, args.query, args.channels, args.since, args.until, args.limit, args.raw
+    )
+    print(format_search_results(results))
+
+
+async def graph(db: Database, args: argparse.Namespace) -> None:
+    edges = await db.get_forward_edges()
+    if args.output:
+        with open(args.output, "w", newline="") as file:
+            write_edges_csv(edges, file)
+    print(format_channel_ranks(rank_channels(edges, args.damping)[:args.top]))
+
+
+async def export(db: Database, args: argparse.Namespace) -> None:
+    try:
+        stats = await export_parquet(
+            db, args.destination, args.tables or list(EXPORT_TABLES), args.full
+        )
+    except RuntimeError as e:
+        print(e)
+        return
+    print(format_export_stats(stats))
+
+
+async def export_jsonl(db: Database, args: argparse.Namespace) -> None:
     try:
-        for channel in channel_list:
-            channel_entity = await client.get_entity(channel)
-            tg_channel_name = channel_entity.username
-            logger.info("Processing channel %s information" % tg_channel_name)
-            await process_channel(client, channel, channel_entity, db)
-
-            last_message_id_in_db, from_channel = await db.get_last_message_record(
-                tg_channel_name
-            )
-            logger.info(
-                "Last message in db is %s, from channel > %s" %
-                (last_message_id_in_db,
-                from_channel)
-            )
-
-            if last_message_id_in_db > 0:
-                # check if we have any messages in db.
-                last_message_in_channel = await get_last_message_id(
-                    client, tg_channel_name
+        stats = await export_archive(
+            db, args.directory, args.tables or list(ARCHIVE_TABLES), args.zstd
+        )
+    except RuntimeError as e:
+        print(e)
+        return
+    print(format_archive_stats(stats))
+
+
+async def import_jsonl(db: Database, args: argparse.Namespace) -> None:
+    try:
+        stats = await import_archive(
+            db, args.directory, args.tables or list(ARCHIVE_TABLES), args.restart
+        )
+    except RuntimeError as e:
+        print(e)
+        return
+    print(format_archive_stats(stats))
+
+
+OFFLINE_COMMANDS = {
+    "search": search,
+    "graph": graph,
+    "export": export,
+    "export-jsonl": export_jsonl,
+    "import-jsonl": import_jsonl,
+}
+
+
+async def main():
+    args = parse_args()
+    blob_store = BlobStore(
+        os.getenv("BLOB_STORE_DIR", DEFAULT_BLOB_STORE_DIR),
+        int(os.getenv("BLOB_INLINE_MAX_BYTES", DEFAULT_BLOB_INLINE_MAX_BYTES)),
+    )
+    db = Database(
+        os.getenv("DB_NAME"),
+        blob_store,
+        reaction_snapshots=os.getenv("REACTION_SNAPSHOTS", "") == "1",
+    )
+    # Closing the database runs PRAGMA optimize, after every command.
+    async with db:
+        await db.create_schema()
+        logger.info("Connection to database created")
+        if args.command in OFFLINE_COMMANDS:
+            # These work on the database alone, no Telegram client needed.
+            await OFFLINE_COMMANDS[args.command](db, args)
+            return
+
+        client = await init_telegram_client(
+            "snooper", os.getenv("PHONE"), int(os.getenv("API_ID")), os.getenv("API_HASH")
+        )
+        client = RateLimitedClient(client, RateLimiter())
+        logger.info("Telegram client initialized")
+        entity_cache = EntityCache(db)
+        client = EntityCachingClient(client, entity_cache)
+        channel_list = get_channels("telegram_channels.yml")
+        try:
+            if args.command == "refresh":
+                await run_passes(
+                    partial(refresh_channel, client, db), channel_list, args.interval
                 )
-                logger.info(
-                    "Last message_id %s in our db, last message id in channel %s channel %s" %
-                    (last_message_id_in_db,
-                     last_message_in_channel,
-                     tg_channel_name),
+            elif args.command == "reconcile":
+                await run_passes(
+                    partial(reconcile_channel, client, db), channel_list, args.interval
                 )
-
-                if last_message_id_in_db < last_message_in_channel:
-                    await download_messages(
-                        client, db, tg_channel_name, db_message_id=last_message_id_in_db
-                    )
-
-            if last_message_id_in_db == 0:
-                # we don't have messages yet, download all of them
-                logger.info("Downloading all messages for channel %s" % tg_channel_name)
-                await download_messages(client, db, tg_channel_name, db_message_id=None)
-
-            await download_document(client, db, channel_entity.id, tg_channel_name)
-            await asyncio.sleep(1)
-            tasks.append(download_large_media(client, tg_channel_name))
-            await asyncio.sleep(1)
-
-        await asyncio.gather(*tasks)
-    except KeyboardInterrupt:
-        pass
-    except Exception as e:
-        logger.error("An error %s occurred" % str(e))
-        pass
+            elif args.command == "live":
+                await live(client, db, channel_list)
+            else:
+                await scrape(client, db, channel_list)
+            logger.info("Entity cache statistics: %s" % entity_cache.stats())
+        except KeyboardInterrupt:
+            pass
+        except Exception as e:
+            logger.error("An error %s occurred" % str(e))
+            pass
 
 
 if __name__ == "__main__":
@@ -1,26 +1,34 @@
 import asyncio
+import hashlib
 import os
 import sys
 import time
+from typing import AsyncIterator, List
 
 from telethon import TelegramClient, hints
-from telethon.errors import (BadRequestError, FloodWaitError, RPCError,
-                             ServerError)
 from telethon.tl.types import (InputMessagesFilterDocument, Message,
                                MessageMediaPhoto)
 from telethon.utils import get_appropriated_part_size
 from tqdm import tqdm
 
-from src.channel import get_channel_info_rows, get_channel_username
-from src.db import Database
+from src.backfill import backfill_channel
+from src.batch import ImageData, MessageBatch, ReactionData
+from src.channel import (ScrapeContext, create_scrape_context,
+                         get_channel_info_rows)
+from src.db import Database, DownloadJob, DownloadManifestEntry
+from src.downloader import (SEGMENT_SIZE, ParallelDownloader, Segment,
+                            is_segment_done, new_range_bitmap,
+                            set_segment_done, split_into_segments)
+from src.jobs import (JOB_DOCUMENT, JOB_LARGE_FILE, JOB_PHOTO,
+                      new_download_job)
 from src.logging_config import logger
 from src.message import (create_message_data, get_first_message_date,
-                         get_fwd_channel_username)
-from src.utils import (callback_document, callback_photo, get_document_name,
-                       get_mime_type, read_binary_file)
+                         get_fwd_channel_username, get_last_message_id,
+                         get_message_entities, get_reaction_emoticon)
+from src.utils import (callback_document, callback_photo, file_sha256_hex,
+                       get_document_name, get_mime_type, get_photo_size)
 
 THRESHOLD_SIZE_IN_MB = 500
-MESSAGES_WITH_BIG_FILES = {}
 
 
 async def init_telegram_client(
@@ -66,6 +74,49 @@ async def process_channel(
         await create_and_save_channel_info(client, channel_url, channel_entity, db)
 
 
+async def scrape_channel(client: TelegramClient, db: Database, channel: str) -> None:
+    """
+    Run the whole pipeline of one channel: channel info, new messages and
+    the documents posted since the last run. Photos and documents are only
+    queued here, the download workers fetch them.
+    """
+    channel_entity = await client.get_entity(channel)
+    tg_channel_name = channel_entity.username
+    logger.info("Processing channel %s information" % tg_channel_name)
+    await process_channel(client, channel, channel_entity, db)
+
+    context = await create_scrape_context(db, channel_entity)
+    last_message_id_in_db = context.last_message_id
+    logger.info(
+        "Last message in db is %s, from channel > %s"
+        % (last_message_id_in_db, tg_channel_name)
+    )
+
+    if last_message_id_in_db > 0:
+        # check if we have any messages in db.
+        last_message_in_channel = await get_last_message_id(client, tg_channel_name)
+        logger.info(
+            "Last message_id %s in our db, last message id in channel %s channel %s"
+            % (last_message_id_in_db, last_message_in_channel, tg_channel_name),
+        )
+
+        if last_message_id_in_db < last_message_in_channel:
+            await download_messages(client, db, context)
+
+    if last_message_id_in_db == 0:
+        # we don't have messages yet, download all of them
+        logger.info("Downloading all messages for channel %s" % tg_channel_name)
+        await download_messages(client, db, context)
+
+    if context.skipped_photos:
+        logger.info(
+            "Skipped %s known photos of channel %s, %s bytes not downloaded"
+            % (context.skipped_photos, tg_channel_name, context.skipped_photo_bytes)
+        )
+
+    await download_document(client, db, channel_entity.id, tg_channel_name)
+
+
 async def create_and_save_channel_info(
     client: TelegramClient,
     channel_url: str,
@@ -85,75 +136,95 @@ async def create_and_save_channel_info(
 
 
 async def download_messages(
-    client: TelegramClient, db: Database, channel: str, db_message_id=None, limit=None
+    client: TelegramClient, db: Database, context: ScrapeContext, limit=None
 ) -> None:
-    if db_message_id is None:
-        # Start downloading all messages from the beginning of the channel with hardcoded limit 1000
-        iterator = client.iter_messages(channel, reverse=True, limit=1000)
-    else:
-        iterator = client.iter_messages(
-            channel, limit=limit, min_id=db_message_id, reverse=True
-        )
+    channel = context.channel_username
+    if context.last_message_id == 0:
+        # New channels, and backfills that were interrupted, get their whole
+        # history first. The loop below then stores what was posted meanwhile.
+        await backfill_channel(client, db, context, process_and_save_message)
+    iterator = client.iter_messages(
+        channel, limit=limit, min_id=context.last_message_id, reverse=True
+    )
 
-    async for message in iterator:
-        await process_and_save_message(client, db, channel, message)
-        # Update the checkpoint with the ID of the last successfully processed message
-        await db.update_last_processed_message_id(channel, message.id)
+    async with MessageBatch(db, context.channel_id, channel) as batch:
+        async for message in iterator:
+            await process_and_save_message(client, db, batch, context, message)
+            # Update the checkpoint with the ID of the last successfully processed message
+            batch.checkpoint(message.id)
+            await batch.flush_if_needed()
+
+
+def get_reactions(
+    message: Message, channel_id: int, channel_username: str
+) -> List[ReactionData]:
+    if not message.reactions:
+        return []
+    return [
+        ReactionData(message.id, channel_id, channel_username, emoticon, result.count)
+        for result in message.reactions.results
+        if (emoticon := get_reaction_emoticon(result.reaction)) is not None
+    ]
 
 
 async def check_and_save_reactions(
-    db: Database, message: Message, channel_id: int, channel_username: str
+    batch: MessageBatch, message: Message, channel_id: int, channel_username: str
 ) -> None:
-    if message.reactions:
-        reaction_results_list = message.reactions.to_dict()["results"]
-        for data in reaction_results_list:
-            emoticon = data["reaction"]["emoticon"]
-            count = data["count"]
-            logger.info("Saving emoticons to db")
-            await db.save_reactions(
-                message.id, channel_id, channel_username, emoticon, count
-            )
+    for reaction in get_reactions(message, channel_id, channel_username):
+        batch.add_reaction(reaction)
 
 
 async def check_and_save_photo(
-    client: TelegramClient,
-    db: Database,
-    message: Message,
-    channel_id: int,
-    channel_username: str,
+    batch: MessageBatch, context: ScrapeContext, message: Message
 ) -> None:
     """
-    Check if media needs to be downloaded and save it to the database if required.
+    Queue the photo of a message for the download workers. The photo is
+    downloaded later by save_photo, so slow downloads do not hold up messages.
+    Photos the channel already has in the db are linked to their stored blob
+    instead.
 
     Args:
-        :param client (TelegramClient): The Telegram client instance.
-        :param db (Database): The database instance for storing media.
+        :param batch (MessageBatch): The batch the download job is added to.
+        :param context (ScrapeContext): The channel identity and known photos of this run.
         :param message (Message): The Telegram message to check for media.
-        :param channel_username: The Telegram name
-        :param channel_id: The Telegram channel id
     """
-
-    try:
-        if message.media and isinstance(message.media, MessageMediaPhoto):
-            photo_id: int = message.media.photo.id
+    if message.media and isinstance(message.media, MessageMediaPhoto):
+        photo = message.media.photo
+        blob_sha256 = context.known_photos.get(photo.id)
+        if blob_sha256 is not None:
             logger.info(
-                "Checking if %s for message %s is in db." % (photo_id, message.id)
+                "Photo %s of message %s is already in the db. Skipping download."
+                % (photo.id, message.id)
             )
-            is_image_in_db = await db.is_image_in_db(message.id, photo_id)
-            if not is_image_in_db:
-                logger.info("Saving %s for message %s to db." % (photo_id, message.id))
-            blob = await client.download_media(
-                message, bytes, progress_callback=callback_photo
-            )  # Download to memory
-            await db.save_image_blob(
-                channel_id, channel_username, message.id, photo_id, blob
+            context.skipped_photos += 1
+            context.skipped_photo_bytes += get_photo_size(photo)
+            batch.add_image(
+                ImageData(
+                    context.channel_id,
+                    context.channel_username,
+                    message.id,
+                    photo.id,
+                    blob_sha256,
+                )
             )
-    except Exception as e:
-        logger.error("Error processing photo %s:" % str(e))
+            return
+
+        logger.info(
+            "Queueing photo %s of message %s for download." % (photo.id, message.id)
+        )
+        batch.add_download_job(
+            new_download_job(
+                JOB_PHOTO, context.channel_id, context.channel_username, message.id
+            )
+        )
 
 
 async def process_and_save_message(
-    client: TelegramClient, db: Database, channel: str, message: Message
+    client: TelegramClient,
+    db: Database,
+    batch: MessageBatch,
+    context: ScrapeContext,
+    message: Message,
 ) -> None:
     """
     Process and save a Telegram message to the database.
@@ -161,53 +232,37 @@ async def process_and_save_message(
     Args:
         client (TelegramClient): The Telegram client instance.
         db (Database): The database instance for storing messages.
-        channel (str): The name of the Telegram channel.
+        batch (MessageBatch): The batch the message data is added to.
+        context (ScrapeContext): The channel identity and high-water mark of this run.
         message (Message): The Telegram message to process and save.
     """
-    try:
-        channel_id = message.peer_id.channel_id
-        channel_username = await get_channel_username(client, channel_id)
-
-        last_message_id_in_db, from_channel = await db.get_last_message_record(channel)
-        logger.info(
-            "Last message id saved in the database is %s." % last_message_id_in_db
-        )
-        logger.info(
-            "Comparing message %s from the channel with last_message_id_in_db %s."
-            % (message.id, last_message_id_in_db)
-        )
-
-        if last_message_id_in_db == 0:
-            logger.info(
-                "No messages found in db. Starting to save all messages from the channel to db."
-            )
-            await saving_data_to_db(channel_id, channel_username, client, db, message)
-
-        if message.id > last_message_id_in_db:
-            logger.info(
-                "Some messages missing from the db. Downloading missing message with id %s from channel %s"
-                % (message.id, channel_username)
-            )
-            await saving_data_to_db(channel_id, channel_username, client, db, message)
+    logger.info(
+        "Comparing message %s from the channel with last message id %s."
+        % (message.id, context.last_message_id)
+    )
 
-        # all messages are in db
-        if message.id == last_message_id_in_db:
-            return
+    # all messages up to the high-water mark are in db
+    if message.id <= context.last_message_id:
+        return
 
-    except (FloodWaitError, ServerError, RPCError, BadRequestError) as e:
-        logger.error(
-            "Error processing message %s: %s" % (message.id, type(e).__name__),
-            exc_info=True,
-        )
+    logger.info(
+        "Saving message with id %s from channel %s"
+        % (message.id, context.channel_username)
+    )
+    # Errors propagate: the channel run fails and the next one resumes from
+    # the last flushed checkpoint, which never passes a failed message.
+    await saving_data_to_db(client, db, batch, context, message)
+    context.last_message_id = message.id
 
 
 async def saving_data_to_db(
-    channel_id: int,
-    channel_username: str,
     client: TelegramClient,
     db: Database,
+    batch: MessageBatch,
+    context: ScrapeContext,
     message: Message,
 ) -> None:
+    channel_id, channel_username = context.channel_id, context.channel_username
     fwd_from_channel_username, tg_link = (
         await get_fwd_channel_username(client, message)
         if message.fwd_from
@@ -217,178 +272,320 @@ async def saving_data_to_db(
         message, channel_id, channel_username, fwd_from_channel_username, tg_link
     )
     logger.info(
-        "Saving message %s from %s to the db."
+        "Adding message %s from %s to the batch."
         % (message_data.message_id, channel_username)
     )
-    await db.save_message_record(message_data)
-    await check_and_save_photo(client, db, message, channel_id, channel_username)
-    await check_and_save_reactions(db, message, channel_id, channel_username)
+    batch.add_message(message_data)
+    for entity in get_message_entities(message, channel_id):
+        batch.add_entity(entity)
+    await check_and_save_photo(batch, context, message)
+    await check_and_save_reactions(batch, message, channel_id, channel_username)
+
+
+async def iter_document_chunks(
+    client: TelegramClient, message: Message, progress_callback=None
+) -> AsyncIterator[bytes]:
+    document = message.media.document
+    downloaded = 0
+    async for chunk in client.iter_download(message.media, file_size=document.size):
+        downloaded += len(chunk)
+        if progress_callback:
+            progress_callback(downloaded, document.size)
+        yield chunk
+
+
+async def download_and_hash(
+    client: TelegramClient, message: Message, file_path: str, progress_callback=None
+) -> str:
+    """
+    Download the document of a message to file_path and return its SHA-256
+    hex digest, computed from the chunks as they arrive.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "wb") as file:
+        async for chunk in iter_document_chunks(client, message, progress_callback):
+            file.write(chunk)
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def is_legacy_large_file(db: Database, file_path: str, size: int) -> bool:
+    """
+    Whether file_path is a large file downloaded by a version without the
+    download manifest, which saved it under its bare file name and only
+    once it was complete. The file must have the size of the document and
+    must not be claimed by the manifest entry of another message.
+    """
+    return (
+        os.path.isfile(file_path)
+        and os.path.getsize(file_path) == size
+        and not await db.is_download_path_claimed(file_path)
+    )
 
 
 async def download_document(
     client: TelegramClient, db: Database, channel_id: int, channel_username: str
 ) -> None:
-    total_documents_in_channel = await client.get_messages(
-        channel_username, 0, filter=InputMessagesFilterDocument
-    )
-    dir_name = f"{channel_username}_downloads"
-    processed_messages = set()
-
-    with tqdm(total=total_documents_in_channel.total, unit=" documents") as pbar_total:
-        async for message in client.iter_messages(
-            channel_username, filter=InputMessagesFilterDocument
-        ):
-            if message.id in processed_messages:
-                continue  # Skip already processed messages
-            document = message.media.document
-            mime_type = get_mime_type(message)
-            file_size_in_mb = get_appropriated_part_size(document.size)
+    """
+    Queue download jobs for the documents posted since the last run. Large
+    files are also added to the download manifest, which tracks their segments.
+    """
+    dir_name_large = f"{channel_username}_downloads_big_files"
+    # Documents up to last_document_id were all queued by an earlier run.
+    scrape_state = await db.get_scrape_state(channel_id)
+    last_document_id = scrape_state.last_document_id
+    jobs = []
+
+    async for message in client.iter_messages(
+        channel_username,
+        filter=InputMessagesFilterDocument,
+        min_id=scrape_state.last_document_id,
+    ):
+        last_document_id = max(last_document_id, message.id)
+        document = message.media.document
+        file_size_in_mb = get_appropriated_part_size(document.size)
+
+        if file_size_in_mb < THRESHOLD_SIZE_IN_MB:
+            jobs.append(
+                new_download_job(JOB_DOCUMENT, channel_id, channel_username, message.id)
+            )
+        else:
+            logger.info(
+                "[Message %s] has file size %s MB bigger than %s MB. Process later."
+                % (message.id, file_size_in_mb, THRESHOLD_SIZE_IN_MB)
+            )
             file_name = get_document_name(message)
+            # Documents of different messages often share a file name.
+            file_path = os.path.join(dir_name_large, f"{message.id}_{file_name}")
+            range_bitmap, bytes_done = None, 0
+            legacy_path = os.path.join(dir_name_large, file_name)
+            if await is_legacy_large_file(db, legacy_path, document.size):
+                # Downloaded completely by a version without the manifest,
+                # download_large_file only verifies and stores it.
+                file_path, bytes_done = legacy_path, document.size
+                segments = split_into_segments(document.size, SEGMENT_SIZE)
+                range_bitmap = new_range_bitmap(len(segments))
+                for segment in segments:
+                    set_segment_done(range_bitmap, segment.index)
+                range_bitmap = bytes(range_bitmap)
+            await db.add_to_download_manifest(
+                channel_id,
+                message.id,
+                channel_username,
+                file_name,
+                file_path,
+                document.size,
+                SEGMENT_SIZE,
+                range_bitmap=range_bitmap,
+                bytes_done=bytes_done,
+            )
+            jobs.append(
+                new_download_job(JOB_LARGE_FILE, channel_id, channel_username, message.id)
+            )
 
-            if file_size_in_mb < THRESHOLD_SIZE_IN_MB:
-                os.makedirs(dir_name, exist_ok=True)
-                try:
-                    file_path = os.path.join(dir_name, file_name)
-                    if os.path.exists(file_path):
-                        logger.warning(
-                            "Channel [%s] message id [%s]File %s already exists at %s. Skipping download."
-                            % (channel_username, message.id, file_name, file_path)
-                        )
-                        continue
-
-                    await client.download_media(
-                        message, file=file_path, progress_callback=callback_document
-                    )
-                    pbar_total.update(1)
-                    logger.info(
-                        "Downloaded document %s to %s for message %s"
-                        % (file_name, file_path, message.id)
-                    )
-                    file_blob = read_binary_file(file_path)
-                    if file_blob is not None:
-                        await db.insert_document_blob(
-                            message.id,
-                            channel_id,
-                            channel_username,
-                            mime_type,
-                            file_name,
-                            file_blob,
-                        )
-                        logger.info(
-                            "Downloaded and saved document name [%s] to the db."
-                            % file_name
-                        )
-                    else:
-                        logger.warning(
-                            "Document with the name [%s] was not found for message %s. Skipping."
-                            % (file_name, message)
-                        )
-                except (FloodWaitError, ServerError, RPCError, BadRequestError) as e:
-                    logger.error(
-                        "Error downloading document from message %s: %s" %
-                        (message.id, type(e).__name__),
-                        exc_info=True,
-                    )
-
-            else:
-                logger.info(
-                    "[Message %s] has file size %s MB bigger than %s MB. Process later."
-                    % (message.id, file_size_in_mb, THRESHOLD_SIZE_IN_MB)
-                )
-                MESSAGES_WITH_BIG_FILES.setdefault(channel_username, []).append(
-                    message.id
-                )
+    logger.info("Queued %s documents of channel %s" % (len(jobs), channel_username))
+    if jobs:
+        await db.enqueue_download_jobs(jobs)
+    if last_document_id:
+        await db.update_last_document_id(
+            channel_id, channel_username, last_document_id
+        )
+
+
+async def save_photo(
+    client: TelegramClient, db: Database, job: DownloadJob, message: Message
+) -> None:
+    if not isinstance(message.media, MessageMediaPhoto):
+        logger.warning("Message %s has no photo anymore. Skipping." % message.id)
+        return
+    photo_id: int = message.media.photo.id
+    if await db.is_image_in_db(message.id, photo_id):
+        return
+    blob_sha256 = await db.get_image_blob_sha256(job.channel_id, photo_id)
+    if blob_sha256 is not None:
+        # Queued twice in one run, the first job already downloaded it.
+        await db.save_image_record(
+            job.channel_id, job.channel_name, message.id, photo_id, blob_sha256
+        )
+        return
+    blob = await client.download_media(
+        message, bytes, progress_callback=callback_photo
+    )  # Download to memory
+    if blob is not None:
+        logger.info("Saving %s for message %s to db." % (photo_id, message.id))
+        await db.save_image_blob(
+            job.channel_id, job.channel_name, message.id, photo_id, blob
+        )
+
+
+async def save_document(
+    client: TelegramClient, db: Database, job: DownloadJob, message: Message
+) -> None:
+    channel_id, channel_username = job.channel_id, job.channel_name
+    document = message.media.document
+    mime_type = get_mime_type(message)
+    file_name = get_document_name(message)
+
+    if await db.is_document_in_db(message.id, channel_id):
+        logger.warning(
+            "Channel [%s] message id [%s] document %s is already in the db. Skipping download."
+            % (channel_username, message.id, file_name)
+        )
+        return
+
+    if document.size <= db.blob_store.inline_max_bytes:
+        # Small enough to live in SQLite: stream it straight
+        # into the blob without a file on disk.
+        await db.insert_document_stream(
+            message.id,
+            channel_id,
+            channel_username,
+            file_name=file_name,
+            mime_type=mime_type,
+            size=document.size,
+            chunks=iter_document_chunks(
+                client, message, progress_callback=callback_document
+            ),
+        )
+        logger.info(
+            "Streamed document %s of message %s to the db." % (file_name, message.id)
+        )
+        return
+
+    dir_name = f"{channel_username}_downloads"
+    os.makedirs(dir_name, exist_ok=True)
+    # Documents of different messages often share a file name.
+    file_path = os.path.join(dir_name, f"{message.id}_{file_name}")
+    # A failed download leaves only the partial file behind, a retry starts over.
+    partial_path = file_path + ".part"
+    blob_sha256 = await download_and_hash(
+        client, message, partial_path, progress_callback=callback_document
+    )
+    os.replace(partial_path, file_path)
+    logger.info(
+        "Downloaded document %s to %s for message %s"
+        % (file_name, file_path, message.id)
+    )
+    await db.insert_document_file(
+        message.id,
+        channel_id,
+        channel_username,
+        file_name=file_name,
+        mime_type=mime_type,
+        file_path=file_path,
+        blob_sha256=blob_sha256,
+    )
+    logger.info("Downloaded and saved document name [%s] to the db." % file_name)
+
+
+async def save_large_file(
+    client: TelegramClient, db: Database, job: DownloadJob, message: Message
+) -> None:
+    entry = await db.get_download_manifest_entry(job.channel_id, job.message_id)
+    if entry is None or entry.status != "pending":
+        return
+    logger.info(
+        "Processing file with size %s, [message %s] from channel %s"
+        % (entry.expected_size, message.id, entry.channel_name)
+    )
+    os.makedirs(os.path.dirname(entry.file_path) or ".", exist_ok=True)
+    await download_large_file(client, db, message, entry)
+
+
+DOWNLOAD_JOB_HANDLERS = {
+    JOB_PHOTO: save_photo,
+    JOB_DOCUMENT: save_document,
+    JOB_LARGE_FILE: save_large_file,
+}
+
+
+async def run_download_job(
+    client: TelegramClient, db: Database, job: DownloadJob, message: Message
+) -> None:
+    """Handle one job of the download queue, see DownloadWorkerPool."""
+    await DOWNLOAD_JOB_HANDLERS[job.kind](client, db, job, message)
 
 
 async def download_large_file(
     client: TelegramClient,
-    message,
-    message_size: int,
-    local_file_path: str,
-    file_name: str,
+    db: Database,
+    message: Message,
+    entry: DownloadManifestEntry,
 ) -> None:
-    chunk_size = 256 * 1024
-    offset = 0
-    total_chunks = (message_size + chunk_size - 1) // chunk_size  # Calculate total chunks
-    chunks_downloaded = 0
+    """
+    Download the missing segments of a large file listed in the download
+    manifest. Every finished segment is recorded in the manifest, so a
+    restarted run continues where the last one stopped. The file is marked
+    complete only after its size and all segments are verified.
+    """
+    segments = split_into_segments(entry.expected_size, entry.segment_size)
+    range_bitmap = bytearray(entry.range_bitmap or new_range_bitmap(len(segments)))
+    missing_segments = [
+        segment for segment in segments if not is_segment_done(range_bitmap, segment.index)
+    ]
+    bytes_done = entry.expected_size - sum(s.end - s.start for s in missing_segments)
+
+    async def on_segment_done(segment: Segment) -> None:
+        nonlocal bytes_done
+        set_segment_done(range_bitmap, segment.index)
+        bytes_done += segment.end - segment.start
+        await db.update_download_progress(
+            entry.channel_id, entry.message_id, bytes(range_bitmap), bytes_done
+        )
 
-    logger.info("Saving message with id [%s] to %s" % (message.id, local_file_path))
+    logger.info("Saving message with id [%s] to %s" % (message.id, entry.file_path))
+    logger.info(
+        "[%s] Download started at %s with %s of %s bytes done"
+        % (
+            entry.file_name,
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
+            bytes_done,
+            entry.expected_size,
+        )
+    )
 
     tqdm_params = {
-        "desc": file_name,
-        "total": total_chunks,
-        "miniters": 1,
+        "desc": entry.file_name,
+        "total": entry.expected_size,
+        "initial": bytes_done,
         "unit": "B",
         "unit_scale": True,
         "unit_divisor": 1024,
     }
     with tqdm(**tqdm_params) as pbar:
-        while offset < message_size:
-            try:
-                logger.info(
-                    "[%s] Download started at %s"
-                    % (file_name, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()))
-                )
-                async for chunk in client.iter_download(
-                    message, offset=offset, chunk_size=chunk_size
-                ):
-                    with open(local_file_path, "ab") as file:
-                        file.write(chunk)
-                        offset += len(chunk)
-                        chunks_downloaded += 1
-                        pbar.update(1)
-                        print(
-                            f"Downloaded {chunks_downloaded}/{total_chunks} chunks ({offset}/{message_size} bytes)"
-                        )
-
-            except (TimeoutError, ConnectionError) as e:
-                logger.exception(
-                    "Exception %s occurred while downloading large file. Sleeping." %
-                    type(e).__name__,
-                )
-                await asyncio.sleep(0.3)
-                continue
-
-            # If offset is greater than or equal to the total file size, the download is complete.
-            if offset >= message_size:
-                end_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-                logger.info(
-                    "[%s] Successfully downloaded message %s size of %s to %s at %s"
-                    % (message.id, message_size, file_name, local_file_path, end_time)
-                )
-                break
+        downloader = ParallelDownloader(
+            client, segment_size=entry.segment_size, on_segment_done=on_segment_done
+        )
+        await downloader.download(
+            message.media,
+            entry.expected_size,
+            entry.file_path,
+            segments=missing_segments,
+            progress=pbar,
+        )
 
+    file_size = os.path.getsize(entry.file_path)
+    if file_size != entry.expected_size or not all(
+        is_segment_done(range_bitmap, segment.index) for segment in segments
+    ):
+        raise ValueError(
+            "Large file %s has %s of %s bytes after download"
+            % (entry.file_path, file_size, entry.expected_size)
+        )
+    blob_sha256 = await asyncio.to_thread(file_sha256_hex, entry.file_path)
+    await db.insert_document_file(
+        message.id,
+        entry.channel_id,
+        entry.channel_name,
+        file_name=entry.file_name,
+        mime_type=get_mime_type(message),
+        file_path=entry.file_path,
+        blob_sha256=blob_sha256,
+    )
+    await db.complete_download(entry.channel_id, entry.message_id, blob_sha256)
 
-async def download_large_media(client: TelegramClient, channel_name: str) -> None:
-    if channel_name in MESSAGES_WITH_BIG_FILES:
-        message_ids: list = MESSAGES_WITH_BIG_FILES[channel_name]
-        dir_name_large = f"{channel_name}_downloads_big_files"
-        os.makedirs(dir_name_large, exist_ok=True)
-        async for message in client.iter_messages(channel_name, ids=message_ids):
-            document = message.media.document
-            message_size = document.size
-            logger.info(
-                "Processing file with size %s, [message %s] from channel %s"
-                % (message_size, message.id, channel_name)
-            )
-            try:
-                file_name = get_document_name(message)
-                file_path = os.path.join(dir_name_large, file_name)
-                if os.path.exists(file_path):
-                    logger.info(
-                        "File %s already exists at %s. Skipping large download."
-                        % (file_name, file_path)
-                    )
-                    continue
-                logger.info("Start to download large file in chunks")
-                await download_large_file(
-                    client, message, message_size, file_path, file_name
-                )
-            except (Exception, AttributeError) as e:
-                logger.exception(
-                    "Exception %s occurred calling download_large_file func, in message" %
-                    str(e),
-                    message,
-                )
-    else:
-        logger("Channel %s has no large files. Nothing to download" % channel_name)
+    end_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+    logger.info(
+        "[%s] Successfully downloaded message %s size of %s to %s at %s"
+        % (message.id, entry.expected_size, entry.file_name, entry.file_path, end_time)
+    )
@@ -0,0 +1,327 @@
+import base64
+import json
+import os
+from collections import namedtuple
+from itertools import islice
+from typing import IO, Iterable, Iterator, List, Optional, Sequence
+
+from src.db import Database
+from src.jobs import JOB_DOCUMENT, JOB_PHOTO, JOB_PRIORITIES
+from src.logging_config import logger
+
+try:
+    import zstandard
+except ImportError:
+    # Optional, only needed for .jsonl.zst archives.
+    zstandard = None
+
+ARCHIVE_CHUNK_ROWS = 10000
+IMPORT_BATCH_ROWS = 5000
+# Inline blobs are up to BLOB_INLINE_MAX_BYTES each, a few MiB per row in JSON.
+BLOB_BATCH_ROWS = 100
+ARCHIVE_SUFFIX = ".jsonl"
+ZSTD_SUFFIX = ".zst"
+
+# insert_sql takes the columns as named parameters and skips rows the
+# database already has (scrape_state keeps the higher checkpoint), so
+# importing the same archive twice changes nothing. where_sql limits the
+# exported rows, binary_columns are written as base64 and batch_rows
+# replaces ARCHIVE_CHUNK_ROWS and IMPORT_BATCH_ROWS for tables of large rows.
+# download_job_sql runs with the same parameters after insert_sql.
+ArchiveTable = namedtuple(
+    "ArchiveTable",
+    [
+        "name", "columns", "insert_sql", "where_sql", "binary_columns", "batch_rows",
+        "download_job_sql",
+    ],
+    defaults=["", (), None, None],
+)
+
+ArchiveStats = namedtuple("ArchiveStats", ["table", "path", "rows"])
+
+
+def insert_or_ignore_sql(table: str, columns: Sequence[str]) -> str:
+    return "INSERT OR IGNORE INTO %s (%s) VALUES (%s)" % (
+        table, ", ".join(columns), ", ".join(":" + c for c in columns)
+    )
+
+
+def insert_if_missing_sql(table: str, columns: Sequence[str], key: Sequence[str]) -> str:
+    """For tables without a unique key: insert unless a row with the same key exists."""
+    return "INSERT INTO %s (%s) SELECT %s WHERE NOT EXISTS (SELECT 1 FROM %s WHERE %s)" % (
+        table,
+        ", ".join(columns),
+        ", ".join(":" + c for c in columns),
+        table,
+        " AND ".join("%s IS :%s" % (c, c) for c in key),
+    )
+
+
+def insert_media_sql(table: str, columns: Sequence[str], key: Sequence[str]) -> str:
+    """Like insert_if_missing_sql, but only for rows whose blob the database has."""
+    return insert_if_missing_sql(table, columns, key) + (
+        " AND EXISTS (SELECT 1 FROM blobs WHERE sha256 = :blob_sha256)"
+    )
+
+
+def download_job_sql(table: str, key: Sequence[str], kind: str) -> str:
+    """
+    Queue a download job for a media row insert_media_sql skipped because
+    the database does not have its blob, unless it has media for that key.
+    """
+    return (
+        "INSERT OR IGNORE INTO download_jobs (kind, channel_id, channel_name, message_id, priority) "
+        "SELECT '%s', :channel_id, :channel_name, :message_id, %d "
+        "WHERE NOT EXISTS (SELECT 1 FROM blobs WHERE sha256 = :blob_sha256) "
+        "AND NOT EXISTS (SELECT 1 FROM %s WHERE %s)"
+        % (kind, JOB_PRIORITIES[kind], table, " AND ".join("%s IS :%s" % (c, c) for c in key))
+    )
+
+
+CHANNEL_COLUMNS = (
+    "channel_id", "channel_url", "channel_title", "channel_name", "user_count", "date",
+    "scam", "has_link", "fake",
+)
+MESSAGE_COLUMNS = (
+    "message_id", "channel_id", "channel_name", "message_date", "message_pinned",
+    "message_text", "message_media", "message_views", "message_forwards",
+    "message_edit_date", "url_in_message", "message_fwd_from", "message_fwd_from_date",
+    "message_fwd_from_channel_id", "message_fwd_from_channel_username",
+    "message_fwd_from_channel_link", "last_refreshed_at", "deleted_at",
+)
+REACTION_COLUMNS = ("message_id", "channel_id", "channel_name", "emoticon", "emoticon_count")
+IMAGE_COLUMNS = ("channel_id", "channel_name", "message_id", "photo_id", "blob_sha256")
+DOCUMENT_COLUMNS = (
+    "message_id", "channel_id", "channel_name", "mime_type", "file_name", "blob_sha256",
+)
+MESSAGE_ENTITY_COLUMNS = ("message_id", "channel_id", "entity_type", "value", "domain")
+SCRAPE_STATE_COLUMNS = ("channel_id", "channel_name", "last_processed_message_id")
+BLOB_COLUMNS = ("sha256", "size", "data")
+
+# In import order. Inline blobs are part of the archive, blobs on the
+# filesystem are not: media rows are only imported when the database has
+# their blob, for the others a download job is queued.
+ARCHIVE_TABLES = {
+    table.name: table
+    for table in (
+        ArchiveTable("channels", CHANNEL_COLUMNS, insert_or_ignore_sql("channels", CHANNEL_COLUMNS)),
+        ArchiveTable("messages", MESSAGE_COLUMNS, insert_or_ignore_sql("messages", MESSAGE_COLUMNS)),
+        ArchiveTable("reactions", REACTION_COLUMNS, insert_or_ignore_sql("reactions", REACTION_COLUMNS)),
+        ArchiveTable(
+            "message_entities",
+            MESSAGE_ENTITY_COLUMNS,
+            insert_or_ignore_sql("message_entities", MESSAGE_ENTITY_COLUMNS),
+        ),
+        ArchiveTable(
+            "blobs",
+            BLOB_COLUMNS,
+            insert_or_ignore_sql("blobs", BLOB_COLUMNS),
+            # Not the rows a crashed insert_document_stream left behind.
+            "WHERE storage = 'inline' AND sha256 NOT LIKE 'pending:%'",
+            ("data",),
+            BLOB_BATCH_ROWS,
+        ),
+        ArchiveTable(
+            "images",
+            IMAGE_COLUMNS,
+            insert_media_sql("images", IMAGE_COLUMNS, ("channel_id", "message_id", "photo_id")),
+            download_job_sql=download_job_sql("images", ("channel_id", "message_id", "photo_id"), JOB_PHOTO),
+        ),
+        ArchiveTable(
+            "documents",
+            DOCUMENT_COLUMNS,
+            insert_media_sql("documents", DOCUMENT_COLUMNS, ("channel_id", "message_id")),
+            # Large files too: save_document streams them to a file.
+            download_job_sql=download_job_sql("documents", ("channel_id", "message_id"), JOB_DOCUMENT),
+        ),
+        # Both instances have every message up to their checkpoint, so the
+        # merged archive has every message up to the higher one. A channel
+        # with an unfinished backfill keeps its checkpoint, the backfill is
+        # only resumed while it is 0.
+        ArchiveTable(
+            "scrape_state",
+            SCRAPE_STATE_COLUMNS,
+            """
+            INSERT INTO scrape_state (channel_id, channel_name, last_processed_message_id)
+            SELECT :channel_id, :channel_name, :last_processed_message_id
+            WHERE NOT EXISTS (
+                SELECT 1 FROM backfill_ranges
+                WHERE channel_id = :channel_id AND completed_at IS NULL
+            )
+            ON CONFLICT (channel_id) DO UPDATE SET
+                last_processed_message_id = excluded.last_processed_message_id,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE excluded.last_processed_message_id > last_processed_message_id
+            """,
+        ),
+    )
+}
+
+
+def open_archive(path: str, mode: str, compressed: Optional[bool] = None) -> IO[str]:
+    """
+    Open a JSONL archive file as text. It is zstd-compressed if compressed is
+    set, by default if its name ends with .zst.
+    """
+    if compressed is None:
+        compressed = path.endswith(ZSTD_SUFFIX)
+    if compressed:
+        if zstandard is None:
+            raise RuntimeError(
+                "Compressed archives need zstandard: python3 -m pip install zstandard"
+            )
+        return zstandard.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def archive_path(directory: str, table_name: str, compress: bool = False) -> str:
+    return os.path.join(
+        directory, table_name + ARCHIVE_SUFFIX + (ZSTD_SUFFIX if compress else "")
+    )
+
+
+def find_archive_file(directory: str, table_name: str) -> Optional[str]:
+    for compress in (True, False):
+        path = archive_path(directory, table_name, compress)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def to_json_lines(table: ArchiveTable, rows: Iterable[tuple]) -> Iterator[str]:
+    for row in rows:
+        values = dict(zip(table.columns, row))
+        for column in table.binary_columns:
+            if values[column] is not None:
+                values[column] = base64.b64encode(values[column]).decode("ascii")
+        yield json.dumps(values, ensure_ascii=False) + "\n"
+
+
+def to_parameters(table: ArchiveTable, lines: Iterable[str]) -> Iterator[dict]:
+    """Insert parameters of the non-empty lines. Columns missing from a line are NULL."""
+    for line in lines:
+        if line.strip():
+            values = json.loads(line)
+            parameters = {column: values.get(column) for column in table.columns}
+            for column in table.binary_columns:
+                if parameters[column] is not None:
+                    parameters[column] = base64.b64decode(parameters[column])
+            yield parameters
+
+
+def chunked(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+async def export_table(db: Database, table: ArchiveTable, path: str) -> int:
+    """
+    Write all rows of a table to a JSONL file, ARCHIVE_CHUNK_ROWS at a time.
+    The file is written next to path and renamed at the end.
+    """
+    temp_path = path + ".tmp"
+    rows = 0
+    with open_archive(temp_path, "w", path.endswith(ZSTD_SUFFIX)) as file:
+        async with db.db_cursor() as cursor:
+            await cursor.execute(
+                "SELECT %s FROM %s %s ORDER BY rowid"
+                % (", ".join(table.columns), table.name, table.where_sql)
+            )
+            while chunk := await cursor.fetchmany(table.batch_rows or ARCHIVE_CHUNK_ROWS):
+                file.writelines(to_json_lines(table, chunk))
+                rows += len(chunk)
+    os.replace(temp_path, path)
+    return rows
+
+
+async def get_import_offset(db: Database, source: str, table_name: str) -> int:
+    async with db.db_cursor() as cursor:
+        result = await cursor.execute(
+            "SELECT lines FROM archive_imports WHERE source = ? AND table_name = ?",
+            (source, table_name),
+        )
+        row = await result.fetchone()
+    return row[0] if row else 0
+
+
+async def import_table(
+    db: Database, table: ArchiveTable, path: str, restart: bool = False
+) -> int:
+    """
+    Insert the rows of a JSONL file, IMPORT_BATCH_ROWS lines per transaction,
+    and return how many were new.
+
+    The number of lines imported is saved with every batch, so an interrupted
+    import continues after the last committed batch. restart imports the
+    file from its first line again.
+    """
+    source = os.path.abspath(path)
+    offset = 0 if restart else await get_import_offset(db, source, table.name)
+    rows = 0
+    with open_archive(path, "r") as file:
+        for lines in chunked(islice(file, offset, None), table.batch_rows or IMPORT_BATCH_ROWS):
+            offset += len(lines)
+            parameters = list(to_parameters(table, lines))
+            async with db.db_cursor() as cursor:
+                await cursor.executemany(table.insert_sql, parameters)
+                inserted = cursor.rowcount
+                if table.download_job_sql:
+                    await cursor.executemany(table.download_job_sql, parameters)
+                    if cursor.rowcount:
+                        logger.info(
+                            "Queued %s downloads of %s without their blob" % (cursor.rowcount, table.name)
+                        )
+                await cursor.execute(
+                    """
+                    INSERT INTO archive_imports (source, table_name, lines) VALUES (?, ?, ?)
+                    ON CONFLICT (source, table_name) DO UPDATE SET
+                        lines = excluded.lines,
+                        updated_at = CURRENT_TIMESTAMP
+                    """,
+                    (source, table.name, offset),
+                )
+            rows += inserted
+    return rows
+
+
+async def export_archive(
+    db: Database,
+    directory: str,
+    table_names: Sequence[str] = tuple(ARCHIVE_TABLES),
+    compress: bool = False,
+) -> List[ArchiveStats]:
+    """Export tables to <table>.jsonl files, or <table>.jsonl.zst if compress is set."""
+    os.makedirs(directory, exist_ok=True)
+    stats = []
+    for name in table_names:
+        path = archive_path(directory, name, compress)
+        stats.append(ArchiveStats(name, path, await export_table(db, ARCHIVE_TABLES[name], path)))
+        logger.info("Exported %s" % (stats[-1],))
+    return stats
+
+
+async def import_archive(
+    db: Database,
+    directory: str,
+    table_names: Sequence[str] = tuple(ARCHIVE_TABLES),
+    restart: bool = False,
+) -> List[ArchiveStats]:
+    """
+    Merge an archive written by export_archive into this database. Rows the
+    database already has are kept, tables without a file are skipped.
+    """
+    stats = []
+    for name in table_names:
+        path = find_archive_file(directory, name)
+        if path is None:
+            continue
+        stats.append(
+            ArchiveStats(name, path, await import_table(db, ARCHIVE_TABLES[name], path, restart))
+        )
+        logger.info("Imported %s" % (stats[-1],))
+    return stats
+
+
+def format_archive_stats(stats: List[ArchiveStats]) -> str:
+    return "\n".join("%s: %s rows, %s" % (s.table, s.rows, s.path) for s in stats)
@@ -0,0 +1,143 @@
+import asyncio
+import dataclasses
+from collections import deque, namedtuple
+from typing import Awaitable, Callable, List, Tuple
+
+from telethon import TelegramClient
+from telethon.tl.types import Message
+
+from src.batch import MessageBatch
+from src.channel import ScrapeContext
+from src.db import BackfillRange, Database
+from src.logging_config import logger
+from src.message import get_last_message_id
+
+# Message ids per backfill range, i.e. 100 history requests for a dense range.
+BACKFILL_RANGE_SIZE = 10000
+# Ranges of one channel fetched at the same time. They share the "messages"
+# bucket of the RateLimiter, so this overlaps request latency, not the budget.
+BACKFILL_CONCURRENCY = 3
+# Telethon sleeps a second between history requests of long iterations. The
+# RateLimiter already paces them, so that sleep only slows the backfill down.
+BACKFILL_WAIT_TIME = 0
+
+BackfillStats = namedtuple("BackfillStats", ["ranges", "messages"])
+
+MessageHandler = Callable[
+    [TelegramClient, Database, MessageBatch, ScrapeContext, Message], Awaitable[None]
+]
+
+
+def split_id_range(first_id: int, last_id: int, range_size: int) -> List[Tuple[int, int]]:
+    """Split the message ids first_id..last_id into (min_id, max_id) ranges, both inclusive."""
+    return [
+        (min_id, min(min_id + range_size - 1, last_id))
+        for min_id in range(first_id, last_id + 1, range_size)
+    ]
+
+
+async def backfill_range(
+    client: TelegramClient,
+    db: Database,
+    context: ScrapeContext,
+    backfill_range: BackfillRange,
+    handle_message: MessageHandler,
+    wait_time: float = BACKFILL_WAIT_TIME,
+) -> int:
+    """
+    Store the messages of one range, oldest first, and mark the range
+    completed. Progress is saved with every batch, an interrupted range
+    continues after its last stored message.
+    """
+    channel = context.channel_username
+    # Message handlers advance last_message_id of their context, so every
+    # range needs its own. The known photos stay shared.
+    range_context = dataclasses.replace(
+        context,
+        last_message_id=max(backfill_range.min_id - 1, backfill_range.last_message_id),
+        skipped_photos=0,
+        skipped_photo_bytes=0,
+    )
+    messages = 0
+    try:
+        async with MessageBatch(
+            db, context.channel_id, channel, backfill_range_id=backfill_range.id
+        ) as batch:
+            # min_id and max_id are exclusive.
+            async for message in client.iter_messages(
+                channel,
+                reverse=True,
+                min_id=range_context.last_message_id,
+                max_id=backfill_range.max_id + 1,
+                wait_time=wait_time,
+            ):
+                await handle_message(client, db, batch, range_context, message)
+                batch.checkpoint(message.id)
+                await batch.flush_if_needed()
+                messages += 1
+    finally:
+        context.skipped_photos += range_context.skipped_photos
+        context.skipped_photo_bytes += range_context.skipped_photo_bytes
+    await db.complete_backfill_range(backfill_range.id)
+    return messages
+
+
+async def backfill_channel(
+    client: TelegramClient,
+    db: Database,
+    context: ScrapeContext,
+    handle_message: MessageHandler,
+    range_size: int = BACKFILL_RANGE_SIZE,
+    concurrency: int = BACKFILL_CONCURRENCY,
+    wait_time: float = BACKFILL_WAIT_TIME,
+) -> BackfillStats:
+    """
+    Store the whole history of a channel up to its latest message.
+
+    The id space is split into ranges saved in backfill_ranges, and up to
+    concurrency ranges are fetched at once. A backfill that was interrupted
+    resumes with the ranges that are not completed yet. The channel
+    checkpoint is only set once every range is done, so a later scrape never
+    skips a range that is still missing.
+    """
+    ranges = await db.get_backfill_ranges(context.channel_id)
+    if not ranges:
+        last_message_id = await get_last_message_id(client, context.channel_username)
+        if not last_message_id:
+            return BackfillStats(0, 0)
+        await db.create_backfill_ranges(
+            context.channel_id, split_id_range(1, last_message_id, range_size)
+        )
+        ranges = await db.get_backfill_ranges(context.channel_id)
+
+    pending = deque(r for r in ranges if r.completed_at is None)
+    stats = BackfillStats(len(pending), 0)
+    logger.info(
+        "Backfilling %s of %s ranges of channel %s"
+        % (len(pending), len(ranges), context.channel_username)
+    )
+
+    async def worker() -> None:
+        nonlocal stats
+        while pending:
+            messages = await backfill_range(
+                client, db, context, pending.popleft(), handle_message, wait_time
+            )
+            stats = stats._replace(messages=stats.messages + messages)
+
+    workers = [
+        asyncio.create_task(worker()) for _ in range(min(concurrency, len(pending)))
+    ]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+
+    last_message_id = max(r.max_id for r in ranges)
+    await db.update_last_processed_message_id(
+        context.channel_id, context.channel_username, last_message_id
+    )
+    context.last_message_id = last_message_id
+    logger.info("Backfilled channel %s: %s" % (context.channel_username, stats))
+    return stats
@@ -0,0 +1,148 @@
+import time
+from collections import namedtuple
+from typing import List, Optional
+
+from src.db import Database
+from src.logging_config import logger
+from src.message import MessageData, MessageEntityData
+
+BATCH_SIZE = 500
+BATCH_FLUSH_INTERVAL_IN_SECONDS = 5
+
+# A photo whose blob is already stored, new photos are download jobs.
+ImageData = namedtuple(
+    "ImageData",
+    ["channel_id", "channel_name", "message_id", "photo_id", "sha256"],
+)
+
+ReactionData = namedtuple(
+    "ReactionData",
+    ["message_id", "channel_id", "channel_name", "emoticon", "count"],
+)
+
+
+class MessageBatch:
+    """
+    Buffer messages, photos, reactions, entities and media download jobs of
+    one channel and write them to the database in a single transaction once
+    the batch is full or too old.
+
+    Use it as an async context manager so the last partial batch is flushed:
+
+        async with MessageBatch(db, channel_id, channel) as batch:
+            batch.add_message(message_data)
+            await batch.flush_if_needed()
+
+    The checkpoint of a batch with a backfill_range_id is written to that
+    backfill range instead of the channel.
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        channel_id: int,
+        channel_name: str,
+        max_size: int = BATCH_SIZE,
+        flush_interval: float = BATCH_FLUSH_INTERVAL_IN_SECONDS,
+        backfill_range_id: Optional[int] = None,
+    ) -> None:
+        self.db = db
+        self.channel_id = channel_id
+        self.channel_name = channel_name
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.backfill_range_id = backfill_range_id
+        self.messages: List[MessageData] = []
+        self.images: List[ImageData] = []
+        self.reactions: List[ReactionData] = []
+        self.entities: List[MessageEntityData] = []
+        self.download_jobs: List[tuple] = []
+        self.last_message_id = None
+        self._started_at = None
+
+    def __len__(self) -> int:
+        return (
+            len(self.messages)
+            + len(self.images)
+            + len(self.reactions)
+            + len(self.entities)
+            + len(self.download_jobs)
+        )
+
+    def _touch(self) -> None:
+        if self._started_at is None:
+            self._started_at = time.monotonic()
+
+    def add_message(self, message_data: MessageData) -> None:
+        self._touch()
+        self.messages.append(message_data)
+
+    def add_image(self, image: ImageData) -> None:
+        self._touch()
+        self.images.append(image)
+
+    def add_reaction(self, reaction: ReactionData) -> None:
+        self._touch()
+        self.reactions.append(reaction)
+
+    def add_entity(self, entity: MessageEntityData) -> None:
+        self._touch()
+        self.entities.append(entity)
+
+    def add_download_job(self, job: tuple) -> None:
+        self._touch()
+        self.download_jobs.append(job)
+
+    def checkpoint(self, message_id: int) -> None:
+        """Remember the last processed message id, written with the next flush."""
+        self._touch()
+        self.last_message_id = message_id
+
+    def is_due(self) -> bool:
+        if self._started_at is None:
+            return False
+        if len(self.messages) >= self.max_size:
+            return True
+        return time.monotonic() - self._started_at >= self.flush_interval
+
+    async def flush_if_needed(self) -> None:
+        if self.is_due():
+            await self.flush()
+
+    async def flush(self) -> None:
+        if self._started_at is None:
+            return
+        logger.info(
+            "Flushing %s messages, %s images, %s reactions and %s download jobs of channel %s to the db."
+            % (
+                len(self.messages),
+                len(self.images),
+                len(self.reactions),
+                len(self.download_jobs),
+                self.channel_name,
+            )
+        )
+        await self.db.save_messages_batch(
+            self.messages,
+            self.images,
+            self.reactions,
+            self.channel_id,
+            self.channel_name,
+            self.last_message_id,
+            self.download_jobs,
+            self.entities,
+            self.backfill_range_id,
+        )
+        self.messages = []
+        self.images = []
+        self.reactions = []
+        self.download_jobs = []
+        self.entities = []
+        self.last_message_id = None
+        self._started_at = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.flush()
@@ -0,0 +1,107 @@
+import io
+import mmap
+import os
+import shutil
+from collections import namedtuple
+from typing import BinaryIO, Optional
+
+DEFAULT_BLOB_STORE_DIR = "blobs"
+DEFAULT_BLOB_INLINE_MAX_BYTES = 1024 * 1024
+
+STORAGE_INLINE = "inline"
+STORAGE_FILE = "file"
+
+# One row of the blobs table. Inline blobs carry their bytes in data, file
+# blobs only the path of the file holding them, relative to the store root
+# so it does not depend on the working directory.
+BlobRow = namedtuple("BlobRow", ["sha256", "size", "data", "storage", "path"])
+
+
+class FilesystemBlobBackend:
+    """
+    Keep blobs as files in a directory tree sharded by the first bytes of their
+    SHA-256, e.g. ``blobs/ab/cd/abcd…``, so no directory grows too large.
+    """
+
+    def __init__(self, root: str = DEFAULT_BLOB_STORE_DIR) -> None:
+        self.root = root
+
+    @staticmethod
+    def relative_path(sha256: str) -> str:
+        return os.path.join(sha256[:2], sha256[2:4], sha256)
+
+    def path_for(self, sha256: str) -> str:
+        return os.path.join(self.root, self.relative_path(sha256))
+
+    def put_file(self, sha256: str, source_path: str) -> str:
+        """
+        Move the file at source_path into the store, so nothing else can
+        change the stored blob, and return its path relative to the root.
+        It is copied and removed when the store is on another filesystem,
+        and only removed when the store already has the blob.
+        """
+        path = self.path_for(sha256)
+        if os.path.exists(path):
+            os.remove(source_path)
+            return self.relative_path(sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        try:
+            os.replace(source_path, tmp_path)
+        except OSError:
+            shutil.copyfile(source_path, tmp_path)
+            os.remove(source_path)
+        os.replace(tmp_path, path)
+        return self.relative_path(sha256)
+
+    def put_bytes(self, sha256: str, data: bytes) -> str:
+        path = self.path_for(sha256)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+        return self.relative_path(sha256)
+
+    def open(self, path: str) -> BinaryIO:
+        with open(os.path.join(self.root, path), "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return io.BytesIO(b"")
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class BlobStore:
+    """
+    Decide where a blob lives: blobs up to inline_max_bytes stay in SQLite,
+    larger ones are handed to the large blob backend and only their path,
+    size and digest are stored in the database.
+    """
+
+    def __init__(
+        self,
+        root: str = DEFAULT_BLOB_STORE_DIR,
+        inline_max_bytes: int = DEFAULT_BLOB_INLINE_MAX_BYTES,
+        large_backend: Optional[FilesystemBlobBackend] = None,
+    ) -> None:
+        self.inline_max_bytes = inline_max_bytes
+        self.large_backend = large_backend or FilesystemBlobBackend(root)
+
+    def store_bytes(self, sha256: str, data: bytes) -> BlobRow:
+        if len(data) <= self.inline_max_bytes:
+            return BlobRow(sha256, len(data), data, STORAGE_INLINE, None)
+        path = self.large_backend.put_bytes(sha256, data)
+        return BlobRow(sha256, len(data), None, STORAGE_FILE, path)
+
+    def store_file(self, sha256: str, source_path: str) -> BlobRow:
+        size = os.path.getsize(source_path)
+        if size <= self.inline_max_bytes:
+            with open(source_path, "rb") as file:
+                return BlobRow(sha256, size, file.read(), STORAGE_INLINE, None)
+        path = self.large_backend.put_file(sha256, source_path)
+        return BlobRow(sha256, size, None, STORAGE_FILE, path)
+
+    def open(self, storage: str, data: Optional[bytes], path: Optional[str]) -> BinaryIO:
+        if storage == STORAGE_FILE:
+            return self.large_backend.open(path)
+        return io.BytesIO(data)
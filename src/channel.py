@@ -1,9 +1,11 @@
 import datetime
 from collections import namedtuple
-from typing import Union
+from dataclasses import dataclass, field
+from typing import Dict, Union
 
 from telethon import TelegramClient, hints
 
+from src.db import Database
 from src.logging_config import logger
 
 ChannelData = namedtuple(
@@ -22,6 +24,37 @@ ChannelData = namedtuple(
 )
 
 
+@dataclass
+class ScrapeContext:
+    """
+    Channel identity and database high-water mark of one channel run.
+
+    Both are resolved once before the message loop; last_message_id is then
+    advanced in memory as messages are added to the batch. known_photos maps
+    the photo ids already stored for the channel to their blob, so those
+    photos are never downloaded again.
+    """
+
+    channel_id: int
+    channel_username: str
+    last_message_id: int = 0
+    known_photos: Dict[int, str] = field(default_factory=dict)
+    skipped_photos: int = 0
+    skipped_photo_bytes: int = 0
+
+
+async def create_scrape_context(
+    db: Database, channel_entity: hints.Entity
+) -> ScrapeContext:
+    scrape_state = await db.get_scrape_state(channel_entity.id)
+    return ScrapeContext(
+        channel_id=channel_entity.id,
+        channel_username=channel_entity.username,
+        last_message_id=scrape_state.last_processed_message_id,
+        known_photos=await db.get_known_photos(channel_entity.id),
+    )
+
+
 async def get_channel_entity(
     client: TelegramClient, channel: hints.EntitiesLike
 ) -> hints.Entity:
@@ -1,34 +1,296 @@
+import asyncio
+import hashlib
+import sqlite3
+import uuid
+from collections import namedtuple
 from contextlib import asynccontextmanager
-from typing import List, Tuple
+from datetime import datetime
+from typing import (Any, AsyncIterator, BinaryIO, Callable, Dict, List,
+                    Optional, Sequence, Tuple)
 
 import aiosqlite
 from pkg_resources import resource_filename
 
+from src.blobstore import BlobRow, BlobStore
+from src.logging_config import logger
 from src.message import MessageData
+from src.migrations import MIGRATIONS, SCHEMA_VERSION
+from src.utils import row_hash, sha256_hex
+
+INSERT_MESSAGE_SQL = """
+    INSERT OR IGNORE INTO messages (
+        message_id, channel_id, channel_name, message_date, message_text, message_pinned,
+        message_fwd_from, message_fwd_from_date, message_fwd_from_channel_id,
+        message_fwd_from_channel_username, message_edit_date, message_views, message_forwards,
+        message_media, url_in_message, message_fwd_from_channel_link
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """
+
+INSERT_IMAGE_SQL = (
+    "INSERT OR IGNORE INTO images (channel_id, channel_name, message_id, photo_id, blob_sha256) "
+    "VALUES (?, ?, ?, ?, ?)"
+)
+
+# Blobs are content-addressed, the same bytes are stored once for all images
+# and documents that reference them.
+INSERT_BLOB_SQL = (
+    "INSERT OR IGNORE INTO blobs (sha256, size, data, storage, path) VALUES (?, ?, ?, ?, ?)"
+)
+
+INSERT_DOCUMENT_SQL = (
+    "INSERT INTO documents (message_id, channel_id, channel_name, file_name, mime_type, blob_sha256) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+
+# Reactions are unique per message and emoticon, a new observation only
+# updates the count.
+UPSERT_REACTION_SQL = """
+    INSERT INTO reactions (message_id, channel_id, channel_name, emoticon, emoticon_count)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (message_id, channel_id, emoticon) DO UPDATE SET
+        channel_name = excluded.channel_name,
+        emoticon_count = excluded.emoticon_count
+    WHERE emoticon_count IS NOT excluded.emoticon_count
+    """
+
+INSERT_REACTION_SNAPSHOT_SQL = (
+    "INSERT INTO reaction_snapshots (message_id, channel_id, emoticon, emoticon_count) "
+    "VALUES (?, ?, ?, ?)"
+)
+
+INSERT_MESSAGE_ENTITY_SQL = (
+    "INSERT OR IGNORE INTO message_entities (message_id, channel_id, entity_type, value, domain) "
+    "VALUES (?, ?, ?, ?, ?)"
+)
+
+# A media download waiting to be picked up by a download worker.
+INSERT_DOWNLOAD_JOB_SQL = (
+    "INSERT OR IGNORE INTO download_jobs (kind, channel_id, channel_name, message_id, priority) "
+    "VALUES (?, ?, ?, ?, ?)"
+)
+
+# Message columns that can change after a message was posted.
+REFRESHABLE_MESSAGE_COLUMNS = (
+    "message_text",
+    "message_pinned",
+    "message_views",
+    "message_forwards",
+    "message_edit_date",
+    "url_in_message",
+)
+
+# Applied to every new connection. WAL lets readers, e.g. analysts with the
+# sqlite3 shell, query the database while the scraper writes to it.
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    # In WAL mode NORMAL only syncs at checkpoints, a power loss can lose the
+    # last transactions but never corrupts the database.
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -65536",  # 64 MiB
+    "PRAGMA mmap_size = 268435456",  # 256 MiB
+    "PRAGMA temp_store = MEMORY",
+)
+
+UPSERT_LAST_PROCESSED_MESSAGE_ID_SQL = """
+    INSERT INTO scrape_state (channel_id, channel_name, last_processed_message_id)
+    VALUES (?, ?, ?)
+    ON CONFLICT (channel_id) DO UPDATE SET
+        channel_name = excluded.channel_name,
+        last_processed_message_id = max(last_processed_message_id, excluded.last_processed_message_id),
+        updated_at = CURRENT_TIMESTAMP
+    """
+
+ScrapeState = namedtuple(
+    "ScrapeState",
+    [
+        "channel_id",
+        "channel_name",
+        "last_processed_message_id",
+        "last_document_id",
+        "last_reaction_sync",
+        "last_reconciled_message_id",
+    ],
+)
+
+
+DownloadManifestEntry = namedtuple(
+    "DownloadManifestEntry",
+    [
+        "channel_id",
+        "message_id",
+        "channel_name",
+        "file_name",
+        "file_path",
+        "expected_size",
+        "segment_size",
+        "bytes_done",
+        "range_bitmap",
+        "sha256",
+        "status",
+    ],
+)
+
+DownloadJob = namedtuple(
+    "DownloadJob",
+    ["id", "kind", "channel_id", "channel_name", "message_id", "attempts"],
+)
+
+ForwardEdge = namedtuple(
+    "ForwardEdge",
+    [
+        "source_channel_id",
+        "source_channel_username",
+        "target_channel_id",
+        "target_channel_name",
+        "forwards",
+        "first_seen",
+        "last_seen",
+    ],
+)
+
+BackfillRange = namedtuple(
+    "BackfillRange",
+    ["id", "channel_id", "min_id", "max_id", "last_message_id", "completed_at"],
+)
+
+
+def kinds_filter(kinds: Optional[Sequence[str]]) -> Tuple[str, tuple]:
+    if not kinds:
+        return "", ()
+    return " AND kind IN (%s)" % ", ".join("?" * len(kinds)), tuple(kinds)
+
+
+def write_blob_chunk(connection: sqlite3.Connection, rowid: int, offset: int, chunk: bytes) -> None:
+    with connection.blobopen("blobs", "data", rowid) as blob:
+        blob.seek(offset)
+        blob.write(chunk)
+
+
+def message_row(message_data: MessageData) -> tuple:
+    return (
+        message_data.message_id,
+        message_data.channel_id,
+        message_data.channel_name,
+        message_data.message_date,
+        message_data.message_text,
+        message_data.message_pinned,
+        message_data.message_fwd_from,
+        message_data.message_fwd_from_date,
+        message_data.message_fwd_from_channel_id,
+        message_data.message_fwd_from_channel_username,
+        message_data.message_edit_date,
+        message_data.message_views,
+        message_data.message_forwards,
+        message_data.message_media,
+        message_data.url_in_message,
+        message_data.message_fwd_from_channel_link,
+    )
 
 
 class Database:
-    def __init__(self, db_name: str) -> None:
+    def __init__(
+            self,
+            db_name: str,
+            blob_store: Optional[BlobStore] = None,
+            reaction_snapshots: bool = False,
+    ) -> None:
         self.db_name = db_name
+        self.blob_store = blob_store or BlobStore()
+        # Also append every reaction count seen to reaction_snapshots.
+        self.reaction_snapshots = reaction_snapshots
         self._connection = None
+        # One connection is shared by all channel tasks, so each cursor scope
+        # owns it (and its transaction) until it commits or rolls back.
+        self._lock = asyncio.Lock()
 
     @asynccontextmanager
     async def db_cursor(self):
-        if self._connection is None:
-            self._connection = await aiosqlite.connect(self.db_name, timeout=5, isolation_level='EXCLUSIVE')
-        async with self._connection.cursor() as cursor:
-            try:
-                yield cursor
-                await self._connection.commit()
-            except Exception:
-                await self._connection.rollback()
-                raise
+        async with self._lock:
+            if self._connection is None:
+                # IMMEDIATE takes the write lock when a transaction starts
+                # but, unlike EXCLUSIVE, leaves WAL readers unblocked.
+                self._connection = await aiosqlite.connect(self.db_name, timeout=5, isolation_level='IMMEDIATE')
+                for pragma in CONNECTION_PRAGMAS:
+                    await self._connection.execute(pragma)
+                await self._connection.create_function(
+                    "sha256", 1, sha256_hex, deterministic=True
+                )
+                await self._connection.create_function(
+                    "row_hash", -1, row_hash, deterministic=True
+                )
+            async with self._connection.cursor() as cursor:
+                try:
+                    yield cursor
+                    await self._connection.commit()
+                except Exception:
+                    await self._connection.rollback()
+                    raise
 
     async def create_schema(self) -> None:
         with open(resource_filename(__name__, "db_schema.sql")) as schema_file:
             schema_sql = schema_file.read()
             async with self.db_cursor() as cursor:
+                await cursor.execute(
+                    "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'messages'"
+                )
+                is_new_database = (await cursor.fetchone())[0] == 0
                 await cursor.executescript(schema_sql)
+        await self.apply_migrations(is_new_database)
+        async with self.db_cursor() as cursor:
+            # Left by insert_document_stream when the process stopped
+            # mid-download. GLOB, unlike LIKE, uses the primary key index.
+            await cursor.execute("DELETE FROM blobs WHERE sha256 GLOB 'pending:*'")
+        await self.offload_inline_blobs()
+
+    async def apply_migrations(self, is_new_database: bool = False) -> None:
+        """Bring an existing database up to SCHEMA_VERSION; new ones start there."""
+        async with self.db_cursor() as cursor:
+            await cursor.execute("PRAGMA user_version")
+            version = (await cursor.fetchone())[0]
+            if not is_new_database:
+                for number, statements in enumerate(
+                        MIGRATIONS[version:], start=version + 1
+                ):
+                    logger.info("Applying database migration %s" % number)
+                    for statement in statements:
+                        try:
+                            await cursor.execute(statement)
+                        except sqlite3.OperationalError as e:
+                            # db_schema.sql creates missing tables in their
+                            # latest shape, so the column can already be there.
+                            if "duplicate column name" not in str(e):
+                                raise
+            if version != SCHEMA_VERSION:
+                await cursor.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+
+    async def offload_inline_blobs(self) -> int:
+        """
+        Move inline blobs above the inline size cutoff to the large blob
+        backend, one per transaction, and return how many were moved. They
+        were stored before the cutoff existed or while it was higher.
+        """
+        async with self.db_cursor() as cursor:
+            # size comes before data in the row, so small blobs are skipped
+            # without reading their bytes.
+            result = await cursor.execute(
+                "SELECT rowid FROM blobs WHERE size > ? AND data IS NOT NULL",
+                (self.blob_store.inline_max_bytes,),
+            )
+            rowids = [row[0] for row in await result.fetchall()]
+        for rowid in rowids:
+            async with self.db_cursor() as cursor:
+                result = await cursor.execute(
+                    "SELECT sha256, data FROM blobs WHERE rowid = ?", (rowid,)
+                )
+                sha256, data = await result.fetchone()
+                blob_row = await asyncio.to_thread(self.blob_store.store_bytes, sha256, data)
+                await cursor.execute(
+                    "UPDATE blobs SET data = NULL, storage = ?, path = ? WHERE rowid = ?",
+                    (blob_row.storage, blob_row.path, rowid),
+                )
+        if rowids:
+            logger.info("Moved %s inline blobs to %s" % (len(rowids), self.blob_store.large_backend.root))
+        return len(rowids)
 
     async def is_channel_in_database(self, channel_name: str) -> bool:
         async with self.db_cursor() as cursor:
@@ -64,23 +326,174 @@ class Database:
             file_name,
             mime_type,
             file_blob: bytes,
+            blob_sha256: Optional[str] = None,
     ) -> None:
+        blob_row = await asyncio.to_thread(
+            self.blob_store.store_bytes, blob_sha256 or sha256_hex(file_blob), file_blob
+        )
+        await self.insert_document(
+            message_id, channel_id, channel_username, file_name, mime_type, blob_row
+        )
+
+    async def insert_document_file(
+            self,
+            message_id: int,
+            channel_id: int,
+            channel_username: str,
+            file_name,
+            mime_type,
+            file_path: str,
+            blob_sha256: str,
+    ) -> None:
+        """Save a downloaded document, large files are never read into memory."""
+        blob_row = await asyncio.to_thread(
+            self.blob_store.store_file, blob_sha256, file_path
+        )
+        await self.insert_document(
+            message_id, channel_id, channel_username, file_name, mime_type, blob_row
+        )
+
+    async def insert_document_stream(
+            self,
+            message_id: int,
+            channel_id: int,
+            channel_username: str,
+            file_name,
+            mime_type,
+            size: int,
+            chunks: AsyncIterator[bytes],
+    ) -> str:
+        """
+        Stream a document of a known size into an inline blob and return its
+        SHA-256. The blob is allocated with zeroblob(size) and filled through
+        SQLite incremental BLOB I/O, so only one chunk is held in memory.
+        """
+        # The digest, and so the final key, is only known after the download.
+        pending_key = "pending:%s" % uuid.uuid4().hex
         async with self.db_cursor() as cursor:
             await cursor.execute(
-                "SELECT 1 FROM documents WHERE message_id = ?", (message_id,)
+                "INSERT INTO blobs (sha256, size, data, storage) VALUES (?, ?, zeroblob(?), 'inline')",
+                (pending_key, size, size),
             )
+            rowid = cursor.lastrowid
+
+        digest = hashlib.sha256()
+        offset = 0
+        try:
+            async for chunk in chunks:
+                if offset + len(chunk) > size:
+                    raise ValueError(
+                        "Document of message %s is larger than %s bytes" % (message_id, size)
+                    )
+                await self._run_on_connection_thread(write_blob_chunk, rowid, offset, chunk)
+                digest.update(chunk)
+                offset += len(chunk)
+            if offset != size:
+                raise ValueError(
+                    "Document of message %s ended after %s of %s bytes"
+                    % (message_id, offset, size)
+                )
+        except BaseException:
+            async with self.db_cursor() as cursor:
+                await cursor.execute("DELETE FROM blobs WHERE rowid = ?", (rowid,))
+            raise
+
+        blob_sha256 = digest.hexdigest()
+        async with self.db_cursor() as cursor:
+            await cursor.execute("SELECT 1 FROM blobs WHERE sha256 = ?", (blob_sha256,))
             if await cursor.fetchone() is None:
                 await cursor.execute(
-                    "INSERT INTO documents (message_id, channel_id,  channel_name,file_name,mime_type, file_blob) VALUES (?, ?, ?, ?,?,?)",
+                    "UPDATE blobs SET sha256 = ? WHERE rowid = ?", (blob_sha256, rowid)
+                )
+            else:
+                await cursor.execute("DELETE FROM blobs WHERE rowid = ?", (rowid,))
+            await cursor.execute(
+                "SELECT 1 FROM documents WHERE message_id = ? AND channel_id = ?",
+                (message_id, channel_id),
+            )
+            if await cursor.fetchone() is None:
+                await cursor.execute(
+                    INSERT_DOCUMENT_SQL,
                     (
                         message_id,
                         channel_id,
                         channel_username,
                         file_name,
                         mime_type,
-                        file_blob,
+                        blob_sha256,
                     ),
                 )
+        return blob_sha256
+
+    async def _run_on_connection_thread(self, function: Callable, *args):
+        """
+        Call function(connection, *args) with the sqlite3 connection on the
+        aiosqlite thread that owns it, for sqlite3 APIs aiosqlite does not
+        wrap, like incremental BLOB I/O. There is no public API for that, so
+        this is the one place using the private Connection._execute and
+        Connection._conn; aiosqlite is pinned in requirements.txt and both
+        must be checked when upgrading it. The connection must be open, and
+        it must not be called inside db_cursor, it takes the same lock.
+        """
+        connection = self._connection
+        async with self._lock:
+            return await connection._execute(function, connection._conn, *args)
+
+    async def is_document_in_db(self, message_id: int, channel_id: int) -> bool:
+        async with self.db_cursor() as cursor:
+            result = await cursor.execute(
+                "SELECT 1 FROM documents WHERE message_id = ? AND channel_id = ?",
+                (message_id, channel_id),
+            )
+            return (await result.fetchone()) is not None
+
+    async def insert_document(
+            self,
+            message_id: int,
+            channel_id: int,
+            channel_username: str,
+            file_name,
+            mime_type,
+            blob_row: BlobRow,
+    ) -> None:
+        blob_sha256 = blob_row.sha256
+        async with self.db_cursor() as cursor:
+            await cursor.execute(
+                "SELECT 1 FROM documents WHERE message_id = ? AND channel_id = ?",
+                (message_id, channel_id),
+            )
+            if await cursor.fetchone() is None:
+                await cursor.execute(INSERT_BLOB_SQL, blob_row)
+                await cursor.execute(
+                    INSERT_DOCUMENT_SQL,
+                    (
+                        message_id,
+                        channel_id,
+                        channel_username,
+                        file_name,
+                        mime_type,
+                        blob_sha256,
+                    ),
+                )
+
+    async def open_blob(self, blob_sha256: str) -> Optional[BinaryIO]:
+        """
+        Open a blob for reading wherever it is stored. Inline blobs come back as
+        a BytesIO, blobs on the filesystem as a read-only memory map.
+        """
+        async with self.db_cursor() as cursor:
+            result = await cursor.execute(
+                "SELECT storage, data, path FROM blobs WHERE sha256 = ?", (blob_sha256,)
+            )
+            row = await result.fetchone()
+        return self.blob_store.open(*row) if row else None
+
+    async def get_blob(self, blob_sha256: str) -> Optional[bytes]:
+        blob = await self.open_blob(blob_sha256)
+        if blob is None:
+            return None
+        with blob:
+            return blob.read()
 
     async def get_last_message_record(self, channel: str) -> Tuple[int, str]:
         async with self.db_cursor() as cursor:
@@ -94,45 +507,252 @@ class Database:
             else:
                 return 0, ""
 
+    async def get_scrape_state(self, channel_id: int) -> ScrapeState:
+        async with self.db_cursor() as cursor:
+            result = await cursor.execute(
+                "SELECT channel_id, channel_name, last_processed_message_id, last_document_id, "
+                "last_reaction_sync, last_reconciled_message_id FROM scrape_state WHERE channel_id = ?",
+                (channel_id,),
+            )
+            row = await result.fetchone()
+            if row:
+                return ScrapeState(*row)
+            else:
+                return ScrapeState(channel_id, "", 0, 0, None, 0)
+
     async def update_last_processed_message_id(
-            self, channel_name: str, message_id: int
+            self, channel_id: int, channel_name: str, message_id: int
     ) -> None:
         async with self.db_cursor() as cursor:
             await cursor.execute(
-                "UPDATE messages SET last_processed_message_id = ? WHERE channel_name = ?",
-                (message_id, channel_name),
+                UPSERT_LAST_PROCESSED_MESSAGE_ID_SQL,
+                (channel_id, channel_name, message_id),
             )
 
-    async def save_message_record(self, message_data: MessageData) -> None:
+    async def update_last_document_id(
+            self, channel_id: int, channel_name: str, message_id: int
+    ) -> None:
         async with self.db_cursor() as cursor:
-            insert_sql = """
-                INSERT OR IGNORE INTO messages (
-                    message_id, channel_id, channel_name, message_date, message_text, message_pinned,
-                    message_fwd_from, message_fwd_from_date, message_fwd_from_channel_id,
-                    message_fwd_from_channel_username, message_edit_date, message_views, message_forwards,
-                    message_media, url_in_message, message_fwd_from_channel_link
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            await cursor.execute(
                 """
+                INSERT INTO scrape_state (channel_id, channel_name, last_document_id)
+                VALUES (?, ?, ?)
+                ON CONFLICT (channel_id) DO UPDATE SET
+                    channel_name = excluded.channel_name,
+                    last_document_id = max(last_document_id, excluded.last_document_id),
+                    updated_at = CURRENT_TIMESTAMP
+                """,
+                (channel_id, channel_name, message_id),
+            )
+
+    async def update_last_reconciled_message_id(
+            self, channel_id: int, channel_name: str, message_id: int
+    ) -> None:
+        # Not max(): the cursor starts over at 0 after the last stored message.
+        async with self.db_cursor() as cursor:
+            await cursor.execute(
+                """
+                INSERT INTO scrape_state (channel_id, channel_name, last_reconciled_message_id)
+                VALUES (?, ?, ?)
+                ON CONFLICT (channel_id) DO UPDATE SET
+                    channel_name = excluded.channel_name,
+                    last_reconciled_message_id = excluded.last_reconciled_message_id,
+                    updated_at = CURRENT_TIMESTAMP
+                """,
+                (channel_id, channel_name, message_id),
+            )
+
+    async def save_message_record(self, message_data: MessageData) -> None:
+        async with self.db_cursor() as cursor:
+            await cursor.execute(INSERT_MESSAGE_SQL, message_row(message_data))
+
+    async def save_messages_batch(
+            self,
+            messages: List[MessageData],
+            images: List[tuple],
+            reactions: List[tuple],
+            channel_id: int,
+            channel_name: str,
+            last_message_id: Optional[int] = None,
+            download_jobs: Optional[List[tuple]] = None,
+            entities: Optional[List[tuple]] = None,
+            backfill_range_id: Optional[int] = None,
+    ) -> None:
+        """
+        Write a batch of messages, their images, reactions, urls, mentions and
+        hashtags and the download jobs for their media in one transaction.
+        last_message_id is the checkpoint of the channel, or of the backfill
+        range with backfill_range_id.
+        """
+        async with self.db_cursor() as cursor:
+            if messages:
+                await cursor.executemany(
+                    INSERT_MESSAGE_SQL, [message_row(m) for m in messages]
+                )
+            if images:
+                await cursor.executemany(INSERT_IMAGE_SQL, images)
+            if reactions:
+                await self._save_reactions(cursor, reactions)
+            if entities:
+                await cursor.executemany(INSERT_MESSAGE_ENTITY_SQL, entities)
+            if download_jobs:
+                await cursor.executemany(INSERT_DOWNLOAD_JOB_SQL, download_jobs)
+            if last_message_id is not None and backfill_range_id is not None:
+                await cursor.execute(
+                    "UPDATE backfill_ranges SET last_message_id = max(last_message_id, ?) WHERE id = ?",
+                    (last_message_id, backfill_range_id),
+                )
+            elif last_message_id is not None:
+                await cursor.execute(
+                    UPSERT_LAST_PROCESSED_MESSAGE_ID_SQL,
+                    (channel_id, channel_name, last_message_id),
+                )
+
+    async def create_backfill_ranges(
+            self, channel_id: int, ranges: List[Tuple[int, int]]
+    ) -> None:
+        async with self.db_cursor() as cursor:
+            await cursor.executemany(
+                "INSERT OR IGNORE INTO backfill_ranges (channel_id, min_id, max_id) VALUES (?, ?, ?)",
+                [(channel_id, min_id, max_id) for min_id, max_id in ranges],
+            )
+
+    async def get_backfill_ranges(self, channel_id: int) -> List[BackfillRange]:
+        async with self.db_cursor() as cursor:
+            result = await cursor.execute(
+                "SELECT id, channel_id, min_id, max_id, last_message_id, completed_at "
+                "FROM backfill_ranges WHERE channel_id = ? ORDER BY min_id",
+                (channel_id,),
+            )
+            return [BackfillRange(*row) for row in await result.fetchall()]
+
+    async def complete_backfill_range(self, range_id: int) -> None:
+        async with self.db_cursor() as cursor:
+            await cursor.execute(
+                "UPDATE backfill_ranges SET completed_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (range_id,),
+            )
+
+    async def get_forward_edges(self) -> List[ForwardEdge]:
+        """Every (source, target) pair of the forward graph, most forwards first."""
+        async with self.db_cursor() as cursor:
+            result = await cursor.execute(
+                "SELECT %s FROM forward_edges ORDER BY forwards DESC, source_channel_id, target_channel_id"
+                % ", ".join(ForwardEdge._fields)
+            )
+            return [ForwardEdge(*row) for row in await result.fetchall()]
+
+    async def get_export_watermarks(self, destination: str, table_name: str) -> Dict[str, str]:
+        async with self.db_cursor() as cursor:
+            result = await cursor.execute(
+                "SELECT partition_key, fingerprint FROM export_watermarks "
+                "WHERE destination = ? AND table_name = ?",
+                (destination, table_name),
+            )
+            return dict(await result.fetchall())
+
+    async def save_export_watermark(
+            self, destination: str, table_name: str, partition_key: str, fingerprint: str
+    ) -> None:
+        async with self.db_cursor() as cursor:
             await cursor.execute(
-                insert_sql,
-                (
-                    message_data.message_id,
-                    message_data.channel_id,
-                    message_data.channel_name,
-                    message_data.message_date,
-                    message_data.message_text,
-                    message_data.message_pinned,
-                    message_data.message_fwd_from,
-                    message_data.message_fwd_from_date,
-                    message_data.message_fwd_from_channel_id,
-                    message_data.message_fwd_from_channel_username,
-                    message_data.message_edit_date,
-                    message_data.message_views,
-                    message_data.message_forwards,
-                    message_data.message_media,
-                    message_data.url_in_message,
-                    message_data.message_fwd_from_channel_link,
-                ),
+                """
+                INSERT INTO export_watermarks (destination, table_name, partition_key, fingerprint)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (destination, table_name, partition_key) DO UPDATE SET
+                    fingerprint = excluded.fingerprint,
+                    exported_at = CURRENT_TIMESTAMP
+                """,
+                (destination, table_name, partition_key, fingerprint),
+            )
+
+    async def get_recent_messages(self, channel_id: int, since: datetime) -> List[tuple]:
+        """
+        (message_id, message_date, last_refreshed_at, *REFRESHABLE_MESSAGE_COLUMNS)
+        of the messages of a channel posted since the given date.
+        """
+        async with self.db_cursor() as cursor:
+            result = await cursor.execute(
+                "SELECT message_id, message_date, last_refreshed_at, %s FROM messages "
+                "WHERE channel_id = ? AND message_date >= ? ORDER BY message_id"
+                % ", ".join(REFRESHABLE_MESSAGE_COLUMNS),
+                (channel_id, since),
+            )
+            return await result.fetchall()
+
+    async def save_refreshed_messages(
+            self,
+            channel_id: int,
+            channel_name: str,
+            changes: List[Tuple[int, Dict[str, Any]]],
+            refreshed_message_ids: List[int],
+            refreshed_at: float,
+            reactions: List[tuple],
+            entities: Optional[List[tuple]] = None,
+    ) -> None:
+        """
+        Write the changed columns of refreshed messages and their reactions in
+        one transaction. The entities of messages whose text changed replace
+        the stored ones. Refreshing messages syncs their reactions, so it is
+        recorded as the channel's last_reaction_sync.
+        """
+        async with self.db_cursor() as cursor:
+            edited_ids = {
+                message_id for message_id, columns in changes if "message_text" in columns
+            }
+            if edited_ids:
+                await cursor.executemany(
+                    "DELETE FROM message_entities WHERE channel_id = ? AND message_id = ?",
+                    [(channel_id, message_id) for message_id in edited_ids],
+                )
+                await cursor.executemany(
+                    INSERT_MESSAGE_ENTITY_SQL,
+                    [entity for entity in entities or [] if entity.message_id in edited_ids],
+                )
+            for message_id, columns in changes:
+                await cursor.execute(
+                    "UPDATE messages SET %s WHERE channel_id = ? AND message_id = ?"
+                    % ", ".join("%s = ?" % column for column in columns),
+                    (*columns.values(), channel_id, message_id),
+                )
+            await cursor.executemany(
+                "UPDATE messages SET last_refreshed_at = ? WHERE channel_id = ? AND message_id = ?",
+                [(refreshed_at, channel_id, message_id) for message_id in refreshed_message_ids],
+            )
+            if reactions:
+                await self._save_reactions(cursor, reactions)
+            if refreshed_message_ids:
+                await cursor.execute(
+                    """
+                    INSERT INTO scrape_state (channel_id, channel_name, last_reaction_sync)
+                    VALUES (?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT (channel_id) DO UPDATE SET
+                        channel_name = excluded.channel_name,
+                        last_reaction_sync = excluded.last_reaction_sync,
+                        updated_at = CURRENT_TIMESTAMP
+                    """,
+                    (channel_id, channel_name),
+                )
+
+    async def get_stored_message_ids(
+            self, channel_id: int, after_message_id: int, limit: int
+    ) -> List[int]:
+        """Ids of stored messages not known to be deleted, in order, after the given id."""
+        async with self.db_cursor() as cursor:
+            result = await cursor.execute(
+                "SELECT message_id FROM messages WHERE channel_id = ? AND message_id > ? "
+                "AND deleted_at IS NULL ORDER BY message_id LIMIT ?",
+                (channel_id, after_message_id, limit),
+            )
+            return [row[0] for row in await result.fetchall()]
+
+    async def mark_messages_deleted(self, channel_id: int, message_ids: List[int]) -> None:
+        """Record when stored messages were found deleted in the channel, rows are kept."""
+        async with self.db_cursor() as cursor:
+            await cursor.executemany(
+                "UPDATE messages SET deleted_at = CURRENT_TIMESTAMP "
+                "WHERE channel_id = ? AND message_id = ? AND deleted_at IS NULL",
+                [(channel_id, message_id) for message_id in message_ids],
             )
 
     async def is_image_in_db(self, message_id: int, photo_id: int) -> bool:
@@ -143,6 +763,41 @@ class Database:
             )
             return (await result.fetchone()) is not None
 
+    async def get_known_photos(self, channel_id: int) -> Dict[int, str]:
+        """Map the photo ids stored for a channel to the SHA-256 of their blob, if it is stored."""
+        async with self.db_cursor() as cursor:
+            result = await cursor.execute(
+                "SELECT photo_id, blob_sha256 FROM images JOIN blobs ON blobs.sha256 = images.blob_sha256 "
+                "WHERE channel_id = ?",
+                (channel_id,),
+            )
+            return dict(await result.fetchall())
+
+    async def get_image_blob_sha256(self, channel_id: int, photo_id: int) -> Optional[str]:
+        async with self.db_cursor() as cursor:
+            result = await cursor.execute(
+                "SELECT blob_sha256 FROM images JOIN blobs ON blobs.sha256 = images.blob_sha256 "
+                "WHERE channel_id = ? AND photo_id = ? LIMIT 1",
+                (channel_id, photo_id),
+            )
+            row = await result.fetchone()
+            return row[0] if row else None
+
+    async def save_image_record(
+            self,
+            channel_id: int,
+            channel_username: str,
+            message_id: int,
+            photo_id: int,
+            blob_sha256: str,
+    ) -> None:
+        """Save an image whose bytes are already in the blobs table."""
+        async with self.db_cursor() as cursor:
+            await cursor.execute(
+                INSERT_IMAGE_SQL,
+                (channel_id, channel_username, message_id, photo_id, blob_sha256),
+            )
+
     async def save_image_blob(
             self,
             channel_id: int,
@@ -151,39 +806,229 @@ class Database:
             photo_id: int,
             image_data: bytes,
     ):
+        blob_row = await asyncio.to_thread(
+            self.blob_store.store_bytes, sha256_hex(image_data), image_data
+        )
+        blob_sha256 = blob_row.sha256
         async with self.db_cursor() as cursor:
+            await cursor.execute(INSERT_BLOB_SQL, blob_row)
             await cursor.execute(
-                "INSERT OR IGNORE INTO images (channel_id, channel_name, message_id,photo_id, image_data) VALUES (?, ?, ?, ?, ?)",
-                (channel_id, channel_username, message_id, photo_id, image_data),
+                INSERT_IMAGE_SQL,
+                (channel_id, channel_username, message_id, photo_id, blob_sha256),
             )
 
-    async def save_reactions(
+    async def save_reactions(self, reactions: List[tuple]) -> None:
+        """Upsert the (message_id, channel_id, channel_name, emoticon, count) reactions of a message."""
+        async with self.db_cursor() as cursor:
+            await self._save_reactions(cursor, reactions)
+
+    async def _save_reactions(self, cursor, reactions: List[tuple]) -> None:
+        await cursor.executemany(UPSERT_REACTION_SQL, reactions)
+        if self.reaction_snapshots:
+            await cursor.executemany(
+                INSERT_REACTION_SNAPSHOT_SQL,
+                [
+                    (message_id, channel_id, emoticon, count)
+                    for message_id, channel_id, _, emoticon, count in reactions
+                ],
+            )
+
+    async def add_to_download_manifest(
             self,
-            message_id: int,
             channel_id: int,
-            channel_username: str,
-            emoticon,
-            count: int,
-    ):
+            message_id: int,
+            channel_name: str,
+            file_name: str,
+            file_path: str,
+            expected_size: int,
+            segment_size: int,
+            range_bitmap: Optional[bytes] = None,
+            bytes_done: int = 0,
+    ) -> None:
         async with self.db_cursor() as cursor:
-            # Check if the reaction already exists in the database
-            existing_reaction = await cursor.execute(
-                "SELECT id FROM reactions WHERE message_id = ? AND channel_id = ? AND emoticon = ?",
-                (message_id, channel_id, emoticon),
+            await cursor.execute(
+                "INSERT OR IGNORE INTO download_manifest (channel_id, message_id, channel_name, file_name, "
+                "file_path, expected_size, segment_size, range_bitmap, bytes_done) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (channel_id, message_id, channel_name, file_name, file_path, expected_size, segment_size,
+                 range_bitmap, bytes_done),
             )
 
-            reactions_ = await existing_reaction.fetchone()
+    async def is_download_path_claimed(self, file_path: str) -> bool:
+        async with self.db_cursor() as cursor:
+            result = await cursor.execute(
+                "SELECT 1 FROM download_manifest WHERE file_path = ? LIMIT 1", (file_path,)
+            )
+            return await result.fetchone() is not None
 
-            if reactions_ is None:
-                await cursor.execute(
-                    "INSERT INTO reactions (message_id, channel_id, channel_name, emoticon, emoticon_count) VALUES ("
-                    "?, ?, ?, ?, ?)",
-                    (message_id, channel_id, channel_username, emoticon, count),
-                )
+    async def get_pending_downloads(self, channel_id: int) -> List[DownloadManifestEntry]:
+        async with self.db_cursor() as cursor:
+            result = await cursor.execute(
+                "SELECT %s FROM download_manifest WHERE channel_id = ? AND status = 'pending' "
+                "ORDER BY message_id" % ", ".join(DownloadManifestEntry._fields),
+                (channel_id,),
+            )
+            return [DownloadManifestEntry(*row) for row in await result.fetchall()]
+
+    async def update_download_progress(
+            self, channel_id: int, message_id: int, range_bitmap: bytes, bytes_done: int
+    ) -> None:
+        async with self.db_cursor() as cursor:
+            await cursor.execute(
+                "UPDATE download_manifest SET range_bitmap = ?, bytes_done = ?, updated_at = CURRENT_TIMESTAMP "
+                "WHERE channel_id = ? AND message_id = ?",
+                (range_bitmap, bytes_done, channel_id, message_id),
+            )
+
+    async def complete_download(
+            self, channel_id: int, message_id: int, sha256: str
+    ) -> None:
+        async with self.db_cursor() as cursor:
+            await cursor.execute(
+                # The file was moved into the blob store.
+                "UPDATE download_manifest SET sha256 = ?, status = 'complete', bytes_done = expected_size, "
+                "file_path = NULL, updated_at = CURRENT_TIMESTAMP WHERE channel_id = ? AND message_id = ?",
+                (sha256, channel_id, message_id),
+            )
+
+    async def get_download_manifest_entry(
+            self, channel_id: int, message_id: int
+    ) -> Optional[DownloadManifestEntry]:
+        async with self.db_cursor() as cursor:
+            result = await cursor.execute(
+                "SELECT %s FROM download_manifest WHERE channel_id = ? AND message_id = ?"
+                % ", ".join(DownloadManifestEntry._fields),
+                (channel_id, message_id),
+            )
+            row = await result.fetchone()
+            return DownloadManifestEntry(*row) if row else None
+
+    async def enqueue_download_jobs(self, jobs: List[tuple]) -> None:
+        """Add (kind, channel_id, channel_name, message_id, priority) jobs, known ones are kept."""
+        async with self.db_cursor() as cursor:
+            await cursor.executemany(INSERT_DOWNLOAD_JOB_SQL, jobs)
+
+    async def claim_download_jobs(
+            self, limit: int, kinds: Optional[Sequence[str]] = None
+    ) -> List[DownloadJob]:
+        """
+        Mark up to limit pending jobs as running and return them. The jobs all
+        belong to the channel of the most urgent pending job, so their messages
+        can be fetched with one request.
+        """
+        kind_sql, kind_params = kinds_filter(kinds)
+        async with self.db_cursor() as cursor:
+            result = await cursor.execute(
+                "SELECT channel_id FROM download_jobs WHERE status = 'pending'%s "
+                "ORDER BY priority DESC, id LIMIT 1" % kind_sql,
+                kind_params,
+            )
+            row = await result.fetchone()
+            if row is None:
+                return []
+            result = await cursor.execute(
+                "SELECT id, kind, channel_id, channel_name, message_id, attempts + 1 FROM download_jobs "
+                "WHERE status = 'pending' AND channel_id = ?%s ORDER BY priority DESC, id LIMIT ?"
+                % kind_sql,
+                (row[0],) + kind_params + (limit,),
+            )
+            jobs = [DownloadJob(*row) for row in await result.fetchall()]
+            await cursor.executemany(
+                "UPDATE download_jobs SET status = 'running', attempts = attempts + 1, "
+                "updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                [(job.id,) for job in jobs],
+            )
+            return jobs
+
+    async def complete_download_job(self, job_id: int) -> None:
+        async with self.db_cursor() as cursor:
+            await cursor.execute(
+                "UPDATE download_jobs SET status = 'done', last_error = NULL, "
+                "updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (job_id,),
+            )
+
+    async def fail_download_job(self, job_id: int, error: str, max_attempts: int) -> None:
+        """Put a failed job back in the queue, or mark it failed after max_attempts."""
+        async with self.db_cursor() as cursor:
+            await cursor.execute(
+                "UPDATE download_jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "last_error = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (max_attempts, error, job_id),
+            )
+
+    async def requeue_running_download_jobs(
+            self, kinds: Optional[Sequence[str]] = None
+    ) -> None:
+        """Return jobs left running by an interrupted run to the queue."""
+        kind_sql, kind_params = kinds_filter(kinds)
+        async with self.db_cursor() as cursor:
+            await cursor.execute(
+                "UPDATE download_jobs SET status = 'pending', updated_at = CURRENT_TIMESTAMP "
+                "WHERE status = 'running'%s" % kind_sql,
+                kind_params,
+            )
+
+    async def requeue_pending_large_files(self) -> None:
+        """
+        Queue the large files still pending in the download manifest whose job
+        failed or is missing, with fresh attempts. A large file is retried on
+        every run until it is complete.
+        """
+        async with self.db_cursor() as cursor:
+            await cursor.execute(
+                """
+                INSERT INTO download_jobs (kind, channel_id, channel_name, message_id)
+                SELECT 'large_file', channel_id, channel_name, message_id
+                FROM download_manifest
+                WHERE status = 'pending'
+                ON CONFLICT (kind, channel_id, message_id) DO UPDATE SET
+                    status = 'pending',
+                    attempts = 0,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE status = 'failed'
+                """
+            )
+
+    async def count_download_jobs(self) -> Dict[str, int]:
+        async with self.db_cursor() as cursor:
+            result = await cursor.execute(
+                "SELECT status, COUNT(*) FROM download_jobs GROUP BY status"
+            )
+            return dict(await result.fetchall())
+
+    async def get_cached_entity(self, cache_key: str) -> Optional[tuple]:
+        async with self.db_cursor() as cursor:
+            result = await cursor.execute(
+                "SELECT entity, error, fetched_at FROM entity_cache WHERE cache_key = ?",
+                (cache_key,),
+            )
+            return await result.fetchone()
+
+    async def save_cached_entity(
+            self,
+            cache_keys: List[str],
+            entity_id: Optional[int],
+            username: Optional[str],
+            entity: Optional[bytes],
+            error: Optional[str],
+            fetched_at: float,
+    ) -> None:
+        async with self.db_cursor() as cursor:
+            await cursor.executemany(
+                "INSERT OR REPLACE INTO entity_cache (cache_key, entity_id, username, entity, error, fetched_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (cache_key, entity_id, username, entity, error, fetched_at)
+                    for cache_key in cache_keys
+                ],
+            )
 
     async def __aenter__(self):
         return self
 
     async def __aexit__(self, exc_type, exc_value, traceback):
         if self._connection is not None:
+            # Let SQLite refresh the statistics of tables that changed a lot.
+            await self._connection.execute("PRAGMA optimize")
             await self._connection.close()
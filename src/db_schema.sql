@@ -34,10 +34,15 @@ CREATE TABLE IF NOT EXISTS messages
     message_fwd_from_channel_username TEXT           DEFAULT NULL,
     message_fwd_from_channel_link     TEXT           DEFAULT NULL,
     last_processed_message_id         INTEGER        DEFAULT 0,
+    last_refreshed_at                 REAL           DEFAULT NULL,
+    deleted_at                        TIMESTAMPTZ(0) DEFAULT NULL,
     UNIQUE (message_id, channel_id)
 
 );
 
+CREATE INDEX IF NOT EXISTS idx_messages_channel_date ON messages (channel_id, message_date);
+CREATE INDEX IF NOT EXISTS idx_messages_channel_message ON messages (channel_id, message_id);
+
 
 
 CREATE TABLE IF NOT EXISTS images
@@ -47,9 +52,14 @@ CREATE TABLE IF NOT EXISTS images
     channel_name TEXT,
     message_id   INTEGER,
     photo_id     INTEGER,
-    image_data   BLOB
+    image_data   BLOB,
+    blob_sha256  TEXT,
+    UNIQUE (channel_id, message_id, photo_id)
 );
 
+CREATE INDEX IF NOT EXISTS idx_images_channel_photo ON images (channel_id, photo_id);
+CREATE INDEX IF NOT EXISTS idx_images_message_photo ON images (message_id, photo_id);
+
 
 CREATE TABLE IF NOT EXISTS reactions
 (
@@ -59,9 +69,23 @@ CREATE TABLE IF NOT EXISTS reactions
     channel_name   TEXT,
     emoticon       TEXT    DEFAULT NULL,
     emoticon_count INTEGER DEFAULT NULL,
+    UNIQUE (message_id, channel_id, emoticon),
     FOREIGN KEY (message_id, channel_id) REFERENCES messages (message_id, channel_id)
 );
 
+CREATE TABLE IF NOT EXISTS reaction_snapshots
+(
+    id             INTEGER PRIMARY KEY,
+    message_id     INTEGER,
+    channel_id     INTEGER,
+    emoticon       TEXT,
+    emoticon_count INTEGER,
+    observed_at    TIMESTAMPTZ(0) DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_reaction_snapshots_message
+    ON reaction_snapshots (channel_id, message_id, observed_at);
+
 CREATE TABLE IF NOT EXISTS documents
 (
     id           INTEGER PRIMARY KEY,
@@ -70,5 +94,184 @@ CREATE TABLE IF NOT EXISTS documents
     channel_name TEXT,
     mime_type    TEXT,
     file_name    TEXT,
-    file_blob    BLOB
-)
+    file_blob    BLOB,
+    blob_sha256  TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_documents_message ON documents (message_id, channel_id);
+
+CREATE TABLE IF NOT EXISTS blobs
+(
+    sha256  TEXT PRIMARY KEY,
+    size    INTEGER,
+    data    BLOB,
+    storage TEXT DEFAULT 'inline',
+    path    TEXT
+);
+
+CREATE TABLE IF NOT EXISTS scrape_state
+(
+    channel_id                INTEGER PRIMARY KEY,
+    channel_name              TEXT,
+    last_processed_message_id INTEGER        DEFAULT 0,
+    last_document_id          INTEGER        DEFAULT 0,
+    last_reaction_sync        TIMESTAMPTZ(0) DEFAULT NULL,
+    last_reconciled_message_id INTEGER       DEFAULT 0,
+    updated_at                TIMESTAMPTZ(0) DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS entity_cache
+(
+    cache_key  TEXT PRIMARY KEY,
+    entity_id  INTEGER,
+    username   TEXT,
+    entity     BLOB,
+    error      TEXT,
+    fetched_at REAL
+);
+
+CREATE TABLE IF NOT EXISTS download_manifest
+(
+    channel_id    INTEGER,
+    message_id    INTEGER,
+    channel_name  TEXT,
+    file_name     TEXT,
+    file_path     TEXT,
+    expected_size INTEGER,
+    segment_size  INTEGER,
+    bytes_done    INTEGER        DEFAULT 0,
+    range_bitmap  BLOB           DEFAULT NULL,
+    sha256        TEXT           DEFAULT NULL,
+    status        TEXT           DEFAULT 'pending',
+    updated_at    TIMESTAMPTZ(0) DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (channel_id, message_id)
+);
+
+CREATE TABLE IF NOT EXISTS download_jobs
+(
+    id           INTEGER PRIMARY KEY,
+    kind         TEXT,
+    channel_id   INTEGER,
+    channel_name TEXT,
+    message_id   INTEGER,
+    priority     INTEGER        DEFAULT 0,
+    status       TEXT           DEFAULT 'pending',
+    attempts     INTEGER        DEFAULT 0,
+    last_error   TEXT           DEFAULT NULL,
+    created_at   TIMESTAMPTZ(0) DEFAULT CURRENT_TIMESTAMP,
+    updated_at   TIMESTAMPTZ(0) DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (kind, channel_id, message_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_download_jobs_status_priority
+    ON download_jobs (status, priority DESC, id);
+
+CREATE TABLE IF NOT EXISTS backfill_ranges
+(
+    id              INTEGER PRIMARY KEY,
+    channel_id      INTEGER,
+    min_id          INTEGER,
+    max_id          INTEGER,
+    last_message_id INTEGER        DEFAULT 0,
+    completed_at    TIMESTAMPTZ(0) DEFAULT NULL,
+    UNIQUE (channel_id, min_id)
+);
+
+-- Fingerprint of every partition written by the Parquet export, so the
+-- next export to the same destination skips partitions that did not change.
+CREATE TABLE IF NOT EXISTS export_watermarks
+(
+    destination   TEXT,
+    table_name    TEXT,
+    partition_key TEXT,
+    fingerprint   TEXT,
+    exported_at   TIMESTAMPTZ(0) DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (destination, table_name, partition_key)
+);
+
+-- Lines of a JSONL archive file already imported, to resume an interrupted import.
+CREATE TABLE IF NOT EXISTS archive_imports
+(
+    source     TEXT,
+    table_name TEXT,
+    lines      INTEGER,
+    updated_at TIMESTAMPTZ(0) DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (source, table_name)
+);
+
+CREATE TABLE IF NOT EXISTS message_entities
+(
+    id          INTEGER PRIMARY KEY,
+    message_id  INTEGER,
+    channel_id  INTEGER,
+    entity_type TEXT,
+    value       TEXT,
+    domain      TEXT DEFAULT NULL,
+    UNIQUE (message_id, channel_id, entity_type, value)
+);
+
+CREATE INDEX IF NOT EXISTS idx_message_entities_domain ON message_entities (domain, channel_id);
+CREATE INDEX IF NOT EXISTS idx_message_entities_value ON message_entities (value, channel_id);
+
+-- Full-text index of message text and urls, stored in the messages table
+-- itself (external content) and kept in sync by the triggers below.
+-- remove_diacritics 2 folds accents in Latin and Cyrillic alike.
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5
+(
+    message_text,
+    url_in_message,
+    content = 'messages',
+    content_rowid = 'id',
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+BEGIN
+    INSERT INTO messages_fts (rowid, message_text, url_in_message)
+    VALUES (new.id, new.message_text, new.url_in_message);
+END;
+
+CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, message_text, url_in_message)
+    VALUES ('delete', old.id, old.message_text, old.url_in_message);
+END;
+
+CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message_text, url_in_message ON messages
+BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, message_text, url_in_message)
+    VALUES ('delete', old.id, old.message_text, old.url_in_message);
+    INSERT INTO messages_fts (rowid, message_text, url_in_message)
+    VALUES (new.id, new.message_text, new.url_in_message);
+END;
+
+-- Channels forwarding from other channels: one row per (source, target)
+-- pair, counted by the trigger below as the forwards are stored.
+CREATE TABLE IF NOT EXISTS forward_edges
+(
+    source_channel_id       INTEGER,
+    target_channel_id       INTEGER,
+    source_channel_username TEXT           DEFAULT NULL,
+    target_channel_name     TEXT           DEFAULT NULL,
+    forwards                INTEGER        DEFAULT 0,
+    first_seen              TIMESTAMPTZ(0) DEFAULT NULL,
+    last_seen               TIMESTAMPTZ(0) DEFAULT NULL,
+    PRIMARY KEY (source_channel_id, target_channel_id)
+);
+
+CREATE TRIGGER IF NOT EXISTS messages_forward_edges AFTER INSERT ON messages
+    WHEN new.message_fwd_from_channel_id IS NOT NULL
+        AND new.message_fwd_from_channel_id != 0
+        AND new.message_fwd_from_channel_id != new.channel_id
+BEGIN
+    INSERT INTO forward_edges (source_channel_id, target_channel_id, source_channel_username,
+                               target_channel_name, forwards, first_seen, last_seen)
+    VALUES (new.message_fwd_from_channel_id, new.channel_id, new.message_fwd_from_channel_username,
+            new.channel_name, 1, new.message_date, new.message_date)
+    ON CONFLICT (source_channel_id, target_channel_id) DO UPDATE SET
+        source_channel_username = coalesce(excluded.source_channel_username, source_channel_username),
+        target_channel_name     = coalesce(excluded.target_channel_name, target_channel_name),
+        forwards                = forwards + 1,
+        first_seen              = coalesce(min(first_seen, excluded.first_seen), first_seen, excluded.first_seen),
+        last_seen               = coalesce(max(last_seen, excluded.last_seen), last_seen, excluded.last_seen);
+END;
@@ -0,0 +1,151 @@
+import asyncio
+import os
+import time
+from collections import namedtuple
+from typing import Awaitable, Callable, Iterable, List, Optional
+
+from telethon import TelegramClient
+from telethon.client.downloads import MAX_CHUNK_SIZE
+from tqdm import tqdm
+
+from src.logging_config import logger
+
+DEFAULT_CONNECTIONS = 4
+# Segments are aligned to 1 MiB: Telegram rejects requests crossing a 1 MiB
+# boundary, and every power of two part size up to that divides it.
+SEGMENT_SIZE = 8 * 1024 * 1024
+MIN_PART_SIZE = 64 * 1024
+START_PART_SIZE = 128 * 1024
+# Telegram serves up to 1 MiB per request, Telethon caps requests at 512 KiB.
+MAX_PART_SIZE = MAX_CHUNK_SIZE
+FAST_REQUEST_IN_SECONDS = 0.5
+SLOW_REQUEST_IN_SECONDS = 2
+RETRY_SLEEP_IN_SECONDS = 0.3
+
+Segment = namedtuple("Segment", ["index", "start", "end"])
+
+
+def split_into_segments(size: int, segment_size: int = SEGMENT_SIZE) -> List[Segment]:
+    return [
+        Segment(index, start, min(start + segment_size, size))
+        for index, start in enumerate(range(0, size, segment_size))
+    ]
+
+
+def new_range_bitmap(segment_count: int) -> bytearray:
+    return bytearray((segment_count + 7) // 8)
+
+
+def is_segment_done(range_bitmap: bytes, index: int) -> bool:
+    return bool(range_bitmap[index // 8] & (1 << (index % 8)))
+
+
+def set_segment_done(range_bitmap: bytearray, index: int) -> None:
+    range_bitmap[index // 8] |= 1 << (index % 8)
+
+
+class ParallelDownloader:
+    """
+    Download one file in segments fetched by several concurrent requests.
+
+    The output file is preallocated and every chunk is written at its own
+    offset, so segments can finish in any order. The part size per request
+    grows while requests are fast and shrinks when they get slow.
+    """
+
+    def __init__(
+        self,
+        client: TelegramClient,
+        connections: int = DEFAULT_CONNECTIONS,
+        segment_size: int = SEGMENT_SIZE,
+        on_segment_done: Optional[Callable[[Segment], Awaitable[None]]] = None,
+    ) -> None:
+        self.client = client
+        self.connections = connections
+        self.segment_size = segment_size
+        self.on_segment_done = on_segment_done
+        self.part_size = START_PART_SIZE
+
+    def _adapt_part_size(self, seconds_per_request: float) -> None:
+        if seconds_per_request < FAST_REQUEST_IN_SECONDS:
+            self.part_size = min(self.part_size * 2, MAX_PART_SIZE)
+        elif seconds_per_request > SLOW_REQUEST_IN_SECONDS:
+            self.part_size = max(self.part_size // 2, MIN_PART_SIZE)
+
+    async def download(
+        self,
+        media,
+        size: int,
+        file_path: str,
+        segments: Optional[Iterable[Segment]] = None,
+        progress: Optional[tqdm] = None,
+    ) -> None:
+        """Download the given segments (default: the whole file) of media to file_path."""
+        if segments is None:
+            segments = split_into_segments(size, self.segment_size)
+        queue: asyncio.Queue = asyncio.Queue()
+        for segment in segments:
+            queue.put_nowait(segment)
+
+        fd = os.open(file_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+            workers = [
+                asyncio.create_task(self._worker(queue, media, size, fd, progress))
+                for _ in range(min(self.connections, queue.qsize()))
+            ]
+            try:
+                await asyncio.gather(*workers)
+            except BaseException:
+                for worker in workers:
+                    worker.cancel()
+                raise
+        finally:
+            os.close(fd)
+
+    async def _worker(self, queue: asyncio.Queue, media, size: int, fd: int, progress) -> None:
+        while not queue.empty():
+            segment = queue.get_nowait()
+            await self._download_segment(segment, media, size, fd, progress)
+            if self.on_segment_done:
+                await self.on_segment_done(segment)
+
+    async def _download_segment(self, segment: Segment, media, size: int, fd: int, progress) -> None:
+        offset = segment.start
+        while offset < segment.end:
+            part_size = self.part_size
+            # Start every request on a multiple of its size.
+            while offset % part_size:
+                part_size //= 2
+            requests = (segment.end - offset + part_size - 1) // part_size
+            started_at = time.monotonic()
+            try:
+                async for chunk in self.client.iter_download(
+                    media,
+                    offset=offset,
+                    limit=requests,
+                    request_size=part_size,
+                    file_size=size,
+                ):
+                    chunk = chunk[: segment.end - offset]
+                    os.pwrite(fd, chunk, offset)
+                    offset += len(chunk)
+                    if progress is not None:
+                        progress.update(len(chunk))
+                    if offset >= segment.end:
+                        break
+            except (TimeoutError, ConnectionError) as e:
+                logger.warning(
+                    "Exception %s occurred while downloading bytes %s-%s. Retrying."
+                    % (type(e).__name__, offset, segment.end)
+                )
+                self.part_size = max(self.part_size // 2, MIN_PART_SIZE)
+                await asyncio.sleep(RETRY_SLEEP_IN_SECONDS)
+                continue
+            if offset < segment.end and requests:
+                raise ConnectionError(
+                    "Download ended at byte %s of segment %s-%s"
+                    % (offset, segment.start, segment.end)
+                )
+            self._adapt_part_size((time.monotonic() - started_at) / max(requests, 1))
@@ -0,0 +1,173 @@
+import time
+from collections import OrderedDict, namedtuple
+from typing import Dict, List, Optional
+
+from telethon import TelegramClient, hints
+from telethon.errors import (ChannelInvalidError, ChannelPrivateError,
+                             UsernameInvalidError, UsernameNotOccupiedError)
+from telethon.extensions import BinaryReader
+from telethon.tl.types import PeerChannel
+
+from src.db import Database
+from src.logging_config import logger
+
+ENTITY_CACHE_SIZE = 4096
+ENTITY_CACHE_TTL_IN_SECONDS = 24 * 60 * 60
+NEGATIVE_ENTITY_CACHE_TTL_IN_SECONDS = 60 * 60
+
+# Errors that say the entity is not reachable for us. They are cached like
+# entities, so a private source channel is not asked for again on every forward.
+NEGATIVE_RESULT_ERRORS = {
+    error.__name__: error
+    for error in (
+        ChannelPrivateError,
+        ChannelInvalidError,
+        UsernameInvalidError,
+        UsernameNotOccupiedError,
+    )
+}
+
+CacheEntry = namedtuple("CacheEntry", ["entity", "error", "fetched_at"])
+
+
+def get_cache_key(peer: hints.EntityLike) -> Optional[str]:
+    """Cache key for a channel id or username, None if the peer is not cacheable."""
+    if isinstance(peer, bool):
+        return None
+    if isinstance(peer, int):
+        return "id:%d" % peer
+    if isinstance(peer, PeerChannel):
+        return "id:%d" % peer.channel_id
+    if isinstance(peer, str):
+        username = peer.strip()
+        for prefix in ("https://", "http://", "www.", "t.me/", "telegram.me/", "@"):
+            if username.startswith(prefix):
+                username = username[len(prefix):]
+        if not username or "/" in username or username.startswith("+"):
+            # invite links and message links are not usernames
+            return None
+        return "username:%s" % username.lower()
+    return None
+
+
+def get_entity_cache_keys(entity: hints.Entity) -> List[str]:
+    keys = ["id:%d" % entity.id]
+    if getattr(entity, "username", None):
+        keys.append("username:%s" % entity.username.lower())
+    return keys
+
+
+class EntityCache:
+    """
+    Two-tier cache of resolved entities keyed by channel id and username.
+
+    Entities are kept in an in-memory LRU and, if a database is given, in the
+    entity_cache table so they survive restarts. Entries older than their TTL
+    are resolved again. Errors from NEGATIVE_RESULT_ERRORS are cached too and
+    raised again on a hit.
+    """
+
+    def __init__(
+        self,
+        db: Optional[Database] = None,
+        max_size: int = ENTITY_CACHE_SIZE,
+        ttl: float = ENTITY_CACHE_TTL_IN_SECONDS,
+        negative_ttl: float = NEGATIVE_ENTITY_CACHE_TTL_IN_SECONDS,
+    ) -> None:
+        self.db = db
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "persistent_hits": self.persistent_hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+        }
+
+    def _is_fresh(self, entry: CacheEntry) -> bool:
+        ttl = self.negative_ttl if entry.error else self.ttl
+        return time.time() - entry.fetched_at < ttl
+
+    def _remember(self, cache_key: str, entry: CacheEntry) -> None:
+        self._entries[cache_key] = entry
+        self._entries.move_to_end(cache_key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def _lookup(self, cache_key: str) -> Optional[CacheEntry]:
+        entry = self._entries.get(cache_key)
+        if entry is not None and self._is_fresh(entry):
+            self._entries.move_to_end(cache_key)
+            self.hits += 1
+            return entry
+
+        if self.db is not None:
+            row = await self.db.get_cached_entity(cache_key)
+            if row is not None:
+                entity_bytes, error, fetched_at = row
+                entity = BinaryReader(entity_bytes).tgread_object() if entity_bytes else None
+                entry = CacheEntry(entity, error, fetched_at)
+                if self._is_fresh(entry):
+                    self._remember(cache_key, entry)
+                    self.persistent_hits += 1
+                    return entry
+        return None
+
+    async def _store(self, cache_keys: List[str], entry: CacheEntry) -> None:
+        for cache_key in cache_keys:
+            self._remember(cache_key, entry)
+        if self.db is not None:
+            await self.db.save_cached_entity(
+                cache_keys,
+                entry.entity.id if entry.entity else None,
+                getattr(entry.entity, "username", None),
+                bytes(entry.entity) if entry.entity else None,
+                entry.error,
+                entry.fetched_at,
+            )
+
+    async def get_entity(self, get_entity, peer: hints.EntityLike) -> hints.Entity:
+        """Return the cached entity for peer or resolve it with get_entity(peer)."""
+        cache_key = get_cache_key(peer)
+        if cache_key is None:
+            return await get_entity(peer)
+
+        entry = await self._lookup(cache_key)
+        if entry is None:
+            self.misses += 1
+            try:
+                entity = await get_entity(peer)
+            except tuple(NEGATIVE_RESULT_ERRORS.values()) as e:
+                logger.info("Caching %s for entity %s" % (type(e).__name__, peer))
+                await self._store([cache_key], CacheEntry(None, type(e).__name__, time.time()))
+                raise
+            entry = CacheEntry(entity, None, time.time())
+            cache_keys = get_entity_cache_keys(entity)
+            if cache_key not in cache_keys:
+                cache_keys.append(cache_key)
+            await self._store(cache_keys, entry)
+
+        if entry.error:
+            raise NEGATIVE_RESULT_ERRORS[entry.error](request=None)
+        return entry.entity
+
+
+class EntityCachingClient:
+    """TelegramClient wrapper that resolves get_entity through an EntityCache."""
+
+    def __init__(self, client: TelegramClient, cache: EntityCache) -> None:
+        self.client = client
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    async def get_entity(self, entity: hints.EntitiesLike):
+        return await self.cache.get_entity(self.client.get_entity, entity)
@@ -0,0 +1,276 @@
+import os
+from collections import namedtuple
+from typing import List, Optional, Sequence, Tuple
+
+from src.db import Database
+from src.logging_config import logger
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # Optional, only the export command needs it.
+    pa = pq = None
+
+EXPORT_CHUNK_ROWS = 50000
+PARQUET_COMPRESSION = "zstd"
+PARQUET_FILE_NAME = "part-0.parquet"
+# Month partition of rows without a date.
+UNKNOWN_MONTH = "unknown"
+
+# type is one of int, float, text, bool and timestamp. Timestamps are read
+# as unix seconds and written as UTC timestamps.
+ExportColumn = namedtuple("ExportColumn", ["name", "sql", "type"])
+
+# Tables with a channel_column are partitioned by channel and by the month of
+# date_column. fingerprint lists aggregates of a partition that change
+# whenever one of its rows is added, updated or deleted. Tables without a
+# change marker use content_fingerprint.
+ExportTable = namedtuple(
+    "ExportTable", ["name", "source", "channel_column", "date_column", "fingerprint", "columns"]
+)
+
+ExportStats = namedtuple("ExportStats", ["table", "partitions", "written", "rows"])
+
+
+def column(name: str, column_type: str, table_alias: str = "") -> ExportColumn:
+    sql = table_alias + name
+    if column_type == "timestamp":
+        sql = "CAST(strftime('%%s', %s) AS INTEGER)" % sql
+    return ExportColumn(name, sql, column_type)
+
+
+def content_fingerprint(columns: List[ExportColumn]) -> str:
+    """Row count and the sum of a hash of the exported columns of every row."""
+    return "COUNT(*), SUM(row_hash(%s))" % ", ".join(c.sql for c in columns)
+
+
+REACTION_COLUMNS = [
+    column("message_id", "int", "r."),
+    column("channel_id", "int", "r."),
+    column("channel_name", "text", "r."),
+    column("emoticon", "text", "r."),
+    column("emoticon_count", "int", "r."),
+]
+
+CHANNEL_COLUMNS = [
+    column("channel_id", "int"),
+    column("channel_url", "text"),
+    column("channel_title", "text"),
+    column("channel_name", "text"),
+    column("user_count", "int"),
+    column("date", "timestamp"),
+    column("scam", "bool"),
+    column("has_link", "bool"),
+    column("fake", "bool"),
+]
+
+
+EXPORT_TABLES = {
+    "messages": ExportTable(
+        name="messages",
+        source="messages",
+        channel_column="channel_id",
+        date_column="message_date",
+        fingerprint="COUNT(*), MAX(id), MAX(coalesce(last_refreshed_at, 0)), COUNT(deleted_at)",
+        columns=[
+            column("message_id", "int"),
+            column("channel_id", "int"),
+            column("channel_name", "text"),
+            column("message_date", "timestamp"),
+            column("message_pinned", "bool"),
+            column("message_text", "text"),
+            column("message_media", "bool"),
+            column("message_views", "int"),
+            column("message_forwards", "int"),
+            column("message_edit_date", "timestamp"),
+            column("url_in_message", "text"),
+            column("message_fwd_from", "bool"),
+            column("message_fwd_from_date", "timestamp"),
+            column("message_fwd_from_channel_id", "int"),
+            column("message_fwd_from_channel_username", "text"),
+            column("message_fwd_from_channel_link", "text"),
+            column("last_refreshed_at", "float"),
+            column("deleted_at", "timestamp"),
+        ],
+    ),
+    # Reactions go to the partition of their message. Upserts only change
+    # emoticon_count, so the content is hashed.
+    "reactions": ExportTable(
+        name="reactions",
+        source="reactions r LEFT JOIN messages m "
+               "ON m.channel_id = r.channel_id AND m.message_id = r.message_id",
+        channel_column="r.channel_id",
+        date_column="m.message_date",
+        fingerprint=content_fingerprint(REACTION_COLUMNS),
+        columns=REACTION_COLUMNS,
+    ),
+    # One row per channel, small enough for a single file.
+    "channels": ExportTable(
+        name="channels",
+        source="channels",
+        channel_column=None,
+        date_column=None,
+        fingerprint=content_fingerprint(CHANNEL_COLUMNS),
+        columns=CHANNEL_COLUMNS,
+    ),
+}
+
+
+def require_pyarrow() -> None:
+    if pa is None:
+        raise RuntimeError(
+            "The Parquet export needs pyarrow: python3 -m pip install pyarrow"
+        )
+
+
+def storage_type(column_type: str):
+    """Arrow type of the values as SQLite returns them."""
+    return {"float": pa.float64(), "text": pa.string()}.get(column_type, pa.int64())
+
+
+def arrow_type(column_type: str):
+    return {
+        "bool": pa.bool_(),
+        "timestamp": pa.timestamp("s", tz="UTC"),
+    }.get(column_type) or storage_type(column_type)
+
+
+def arrow_schema(table: ExportTable):
+    return pa.schema([(c.name, arrow_type(c.type)) for c in table.columns])
+
+
+def to_record_batch(table: ExportTable, rows: List[tuple], schema):
+    """One Arrow array per column of the rows, cast to the types of the schema."""
+    arrays = [
+        pa.array(values, type=storage_type(c.type)).cast(field.type)
+        for c, values, field in zip(table.columns, zip(*rows), schema)
+    ]
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def month_bounds(month: str) -> Tuple[str, str]:
+    """Date range of a YYYY-MM month as text bounds: start inclusive, end exclusive."""
+    year, month_number = map(int, month.split("-"))
+    if month_number == 12:
+        return month, "%04d-01" % (year + 1)
+    return month, "%04d-%02d" % (year, month_number + 1)
+
+
+def partition_key(channel_id: Optional[int], month: Optional[str]) -> str:
+    """Relative directory of a partition, in the Hive layout Arrow and Spark read."""
+    if channel_id is None:
+        return ""
+    return "channel=%s/month=%s" % (channel_id, month)
+
+
+def partitions_query(table: ExportTable) -> str:
+    if table.channel_column is None:
+        return "SELECT NULL, NULL, %s FROM %s" % (table.fingerprint, table.source)
+    return (
+        "SELECT %s, coalesce(substr(%s, 1, 7), '%s') AS month, %s FROM %s GROUP BY 1, 2"
+        % (table.channel_column, table.date_column, UNKNOWN_MONTH, table.fingerprint, table.source)
+    )
+
+
+def rows_query(
+    table: ExportTable, channel_id: Optional[int], month: Optional[str]
+) -> Tuple[str, tuple]:
+    sql = "SELECT %s FROM %s" % (", ".join(c.sql for c in table.columns), table.source)
+    if table.channel_column is None:
+        return sql, ()
+    if month == UNKNOWN_MONTH:
+        return (
+            sql + " WHERE %s = ? AND %s IS NULL" % (table.channel_column, table.date_column),
+            (channel_id,),
+        )
+    # A range on the date instead of its month, so the (channel_id, message_date) index is used.
+    return (
+        sql + " WHERE %s = ? AND %s >= ? AND %s < ?"
+        % (table.channel_column, table.date_column, table.date_column),
+        (channel_id, *month_bounds(month)),
+    )
+
+
+async def write_partition(
+    db: Database, table: ExportTable, sql: str, params: tuple, path: str
+) -> int:
+    """
+    Stream the rows of a partition into a Parquet file, EXPORT_CHUNK_ROWS at a
+    time. The file is written next to path and renamed at the end, readers
+    never see a partial file.
+    """
+    schema = arrow_schema(table)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + ".tmp"
+    rows = 0
+    writer = pq.ParquetWriter(temp_path, schema, compression=PARQUET_COMPRESSION)
+    try:
+        async with db.db_cursor() as cursor:
+            await cursor.execute(sql, params)
+            while chunk := await cursor.fetchmany(EXPORT_CHUNK_ROWS):
+                writer.write_batch(to_record_batch(table, chunk, schema))
+                rows += len(chunk)
+    finally:
+        writer.close()
+    os.replace(temp_path, path)
+    return rows
+
+
+async def export_table(
+    db: Database, table: ExportTable, destination: str, full: bool = False
+) -> ExportStats:
+    """
+    Write the partitions of a table that changed since the last export to
+    destination, or all of them if full is set.
+    """
+    async with db.db_cursor() as cursor:
+        result = await cursor.execute(partitions_query(table))
+        partitions = await result.fetchall()
+    watermarks = {} if full else await db.get_export_watermarks(destination, table.name)
+
+    written = rows = 0
+    for channel_id, month, *aggregates in partitions:
+        if not aggregates[0]:
+            continue
+        key = partition_key(channel_id, month)
+        fingerprint = ",".join(map(str, aggregates))
+        if watermarks.get(key) == fingerprint:
+            continue
+        sql, params = rows_query(table, channel_id, month)
+        path = os.path.join(destination, table.name, key, PARQUET_FILE_NAME)
+        rows += await write_partition(db, table, sql, params, path)
+        await db.save_export_watermark(destination, table.name, key, fingerprint)
+        written += 1
+
+    stats = ExportStats(table.name, len(partitions), written, rows)
+    logger.info("Exported %s" % (stats,))
+    return stats
+
+
+async def export_parquet(
+    db: Database,
+    destination: str,
+    table_names: Sequence[str] = tuple(EXPORT_TABLES),
+    full: bool = False,
+) -> List[ExportStats]:
+    """
+    Export tables of the archive to Parquet files under destination, laid out
+    as <table>/channel=<id>/month=<YYYY-MM>/part-0.parquet. Only partitions
+    that changed since the last export to the same destination are written
+    again, unless full is set.
+    """
+    require_pyarrow()
+    destination = os.path.abspath(destination)
+    return [
+        await export_table(db, EXPORT_TABLES[name], destination, full)
+        for name in table_names
+    ]
+
+
+def format_export_stats(stats: List[ExportStats]) -> str:
+    return "\n".join(
+        "%s: %s of %s partitions written, %s rows"
+        % (s.table, s.written, s.partitions, s.rows)
+        for s in stats
+    )
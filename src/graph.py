@@ -0,0 +1,95 @@
+import csv
+from collections import defaultdict, namedtuple
+from typing import Dict, List, TextIO
+
+from src.db import ForwardEdge
+
+DEFAULT_DAMPING = 0.85
+PAGERANK_ITERATIONS = 100
+# Stop iterating once the ranks change by less than this per channel.
+PAGERANK_TOLERANCE = 1e-10
+DEFAULT_TOP_CHANNELS = 20
+
+ChannelRank = namedtuple(
+    "ChannelRank", ["channel_id", "channel_name", "rank", "forwarded_by", "forwards"]
+)
+
+
+def pagerank(
+    edges: List[ForwardEdge],
+    damping: float = DEFAULT_DAMPING,
+    iterations: int = PAGERANK_ITERATIONS,
+    tolerance: float = PAGERANK_TOLERANCE,
+) -> Dict[int, float]:
+    """
+    Weighted PageRank of the channels in the forward graph.
+
+    Forwarding from a channel counts as a vote for it, weighted by how often
+    the forwarding channel did so. A channel is influential when influential
+    channels amplify it. Channels that forward nothing spread their rank
+    evenly, so the ranks always add up to 1.
+    """
+    forwards_by_target: Dict[int, int] = defaultdict(int)
+    channels = set()
+    for edge in edges:
+        channels.update((edge.source_channel_id, edge.target_channel_id))
+        forwards_by_target[edge.target_channel_id] += edge.forwards
+    if not channels:
+        return {}
+
+    links = [
+        (edge.target_channel_id, edge.source_channel_id,
+         edge.forwards / forwards_by_target[edge.target_channel_id])
+        for edge in edges
+    ]
+    dangling = [channel for channel in channels if channel not in forwards_by_target]
+    count = len(channels)
+    rank = dict.fromkeys(channels, 1 / count)
+    for _ in range(iterations):
+        base = (1 - damping + damping * sum(rank[c] for c in dangling)) / count
+        new_rank = dict.fromkeys(channels, base)
+        for forwarder, source, weight in links:
+            new_rank[source] += damping * rank[forwarder] * weight
+        change = sum(abs(new_rank[c] - rank[c]) for c in channels)
+        rank = new_rank
+        if change < count * tolerance:
+            break
+    return rank
+
+
+def rank_channels(
+    edges: List[ForwardEdge], damping: float = DEFAULT_DAMPING
+) -> List[ChannelRank]:
+    """Channels of the forward graph by PageRank, most influential first."""
+    names: Dict[int, str] = {}
+    forwarded_by: Dict[int, int] = defaultdict(int)
+    forwards: Dict[int, int] = defaultdict(int)
+    for edge in edges:
+        names.setdefault(edge.source_channel_id, edge.source_channel_username)
+        names[edge.target_channel_id] = edge.target_channel_name
+        forwarded_by[edge.source_channel_id] += 1
+        forwards[edge.source_channel_id] += edge.forwards
+    return sorted(
+        (
+            ChannelRank(channel_id, names.get(channel_id), rank,
+                        forwarded_by[channel_id], forwards[channel_id])
+            for channel_id, rank in pagerank(edges, damping).items()
+        ),
+        key=lambda channel: (-channel.rank, channel.channel_id),
+    )
+
+
+def write_edges_csv(edges: List[ForwardEdge], file: TextIO) -> None:
+    """Write the forward graph as a CSV edge list, one row per (source, target) pair."""
+    writer = csv.writer(file)
+    writer.writerow(ForwardEdge._fields)
+    writer.writerows(edges)
+
+
+def format_channel_ranks(ranks: List[ChannelRank]) -> str:
+    return "\n".join(
+        "%3d. %s (%s)  rank %.4f, forwarded by %s channels, %s times"
+        % (position, channel.channel_name, channel.channel_id, channel.rank,
+           channel.forwarded_by, channel.forwards)
+        for position, channel in enumerate(ranks, 1)
+    )
@@ -0,0 +1,135 @@
+import asyncio
+from typing import Awaitable, Callable, List, Optional, Sequence
+
+from telethon import TelegramClient
+from telethon.tl.types import Message
+
+from src.db import Database, DownloadJob
+from src.logging_config import logger
+
+JOB_PHOTO = "photo"
+JOB_DOCUMENT = "document"
+JOB_LARGE_FILE = "large_file"
+
+# Higher priorities are claimed first. Photos are small and complete the
+# messages they belong to, large files can take hours.
+JOB_PRIORITIES = {
+    JOB_PHOTO: 20,
+    JOB_DOCUMENT: 10,
+    JOB_LARGE_FILE: 0,
+}
+DEFAULT_DOWNLOAD_WORKERS = 4
+DEFAULT_LARGE_FILE_WORKERS = 1
+MAX_JOB_ATTEMPTS = 3
+# Jobs claimed at once by one worker, their messages are fetched in one request.
+JOB_BATCH_SIZE = 20
+IDLE_POLL_INTERVAL_IN_SECONDS = 1
+
+
+def new_download_job(kind: str, channel_id: int, channel_name: str, message_id: int) -> tuple:
+    return kind, channel_id, channel_name, message_id, JOB_PRIORITIES[kind]
+
+
+class DownloadWorkerPool:
+    """
+    Workers that drain the download_jobs table independently of message
+    scraping.
+
+    Each worker claims a batch of jobs of one channel, fetches their messages
+    again (file references of old messages expire) and hands every job to
+    handle_job. Failed jobs go back to the queue until they used up their
+    attempts, large files get new attempts on every run. After close() the
+    workers stop once the queue is empty.
+    """
+
+    def __init__(
+        self,
+        client: TelegramClient,
+        db: Database,
+        handle_job: Callable[[DownloadJob, Message], Awaitable[None]],
+        concurrency: int = DEFAULT_DOWNLOAD_WORKERS,
+        kinds: Optional[Sequence[str]] = None,
+        batch_size: int = JOB_BATCH_SIZE,
+        max_attempts: int = MAX_JOB_ATTEMPTS,
+        poll_interval: float = IDLE_POLL_INTERVAL_IN_SECONDS,
+    ) -> None:
+        self.client = client
+        self.db = db
+        self.handle_job = handle_job
+        self.concurrency = concurrency
+        self.kinds = kinds
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.completed = 0
+        self.failed = 0
+        self._closed = False
+
+    def close(self) -> None:
+        """No more jobs will be enqueued, let the workers exit when idle."""
+        self._closed = True
+
+    async def run(self) -> None:
+        await self.db.requeue_running_download_jobs(self.kinds)
+        if self.kinds is None or JOB_LARGE_FILE in self.kinds:
+            await self.db.requeue_pending_large_files()
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            for worker in workers:
+                worker.cancel()
+            raise
+
+    async def _worker(self) -> None:
+        while True:
+            jobs = await self.db.claim_download_jobs(self.batch_size, self.kinds)
+            if jobs:
+                await self._run_jobs(jobs)
+            elif self._closed:
+                return
+            else:
+                await asyncio.sleep(self.poll_interval)
+
+    async def _run_jobs(self, jobs: List[DownloadJob]) -> None:
+        channel_name = jobs[0].channel_name
+        try:
+            messages = await self.client.get_messages(
+                channel_name, ids=[job.message_id for job in jobs]
+            )
+        except Exception as e:
+            logger.error(
+                "Error fetching messages of %s download jobs from %s: %s"
+                % (len(jobs), channel_name, type(e).__name__)
+            )
+            for job in jobs:
+                await self._fail(job, e)
+            return
+
+        for job, message in zip(jobs, messages):
+            if message is None or not message.media:
+                logger.warning(
+                    "Message %s of %s has no media anymore. Dropping %s job."
+                    % (job.message_id, channel_name, job.kind)
+                )
+                self.failed += 1
+                await self.db.fail_download_job(job.id, "message has no media", 0)
+                continue
+            try:
+                await self.handle_job(job, message)
+            except Exception as e:
+                logger.exception(
+                    "Exception %s occurred running %s job of message %s"
+                    % (str(e), job.kind, job.message_id)
+                )
+                await self._fail(job, e)
+                continue
+            self.completed += 1
+            await self.db.complete_download_job(job.id)
+
+    async def _fail(self, job: DownloadJob, error: Exception) -> None:
+        if job.attempts >= self.max_attempts:
+            self.failed += 1
+        await self.db.fail_download_job(
+            job.id, "%s: %s" % (type(error).__name__, error), self.max_attempts
+        )
@@ -0,0 +1,166 @@
+import asyncio
+import time
+from typing import Dict, List
+
+from telethon import TelegramClient, events, hints
+from telethon.utils import resolve_id
+
+from src.app import (download_messages, get_reactions, process_channel,
+                     saving_data_to_db)
+from src.batch import MessageBatch
+from src.channel import ScrapeContext, create_scrape_context
+from src.db import Database
+from src.logging_config import logger
+from src.message import create_message_data, get_message_entities
+from src.refresh import get_refreshable_columns
+
+LIVE_FLUSH_INTERVAL_IN_SECONDS = 1
+GAP_FILL_INTERVAL_IN_SECONDS = 5 * 60
+
+
+def get_event_channel_id(event) -> int:
+    return resolve_id(event.chat_id)[0]
+
+
+class LiveScraper:
+    """
+    Keep the configured channels up to date from Telegram update events.
+
+    New messages go through the same pipeline as a scrape run and are written
+    in micro-batches, edits and deletions are applied to the stored rows right
+    away. Events do not move the checkpoint: a gap fill from the checkpoint
+    runs at start and then periodically, stores whatever was missed while
+    disconnected and advances the checkpoint in message order. It stores
+    the messages events already stored again, which changes nothing.
+
+    Events of a channel wait while its gap fill runs, so both never write the
+    same channel at once.
+    """
+
+    def __init__(
+        self,
+        client: TelegramClient,
+        db: Database,
+        flush_interval: float = LIVE_FLUSH_INTERVAL_IN_SECONDS,
+        gap_fill_interval: float = GAP_FILL_INTERVAL_IN_SECONDS,
+    ) -> None:
+        self.client = client
+        self.db = db
+        self.flush_interval = flush_interval
+        self.gap_fill_interval = gap_fill_interval
+        self.entities: List[hints.Entity] = []
+        self.contexts: Dict[int, ScrapeContext] = {}
+        self.batches: Dict[int, MessageBatch] = {}
+        self.locks: Dict[int, asyncio.Lock] = {}
+
+    async def add_channel(self, channel: str) -> None:
+        channel_entity = await self.client.get_entity(channel)
+        await process_channel(self.client, channel, channel_entity, self.db)
+        context = await create_scrape_context(self.db, channel_entity)
+        self.entities.append(channel_entity)
+        self.contexts[context.channel_id] = context
+        self.batches[context.channel_id] = MessageBatch(
+            self.db,
+            context.channel_id,
+            context.channel_username,
+            flush_interval=self.flush_interval,
+        )
+        self.locks[context.channel_id] = asyncio.Lock()
+
+    def register_handlers(self) -> None:
+        for handler, event in (
+            (self.on_new_message, events.NewMessage),
+            (self.on_message_edited, events.MessageEdited),
+            (self.on_message_deleted, events.MessageDeleted),
+        ):
+            self.client.add_event_handler(handler, event(chats=self.entities))
+
+    async def on_new_message(self, event) -> None:
+        channel_id = get_event_channel_id(event)
+        context = self.contexts.get(channel_id)
+        if context is None:
+            return
+        async with self.locks[channel_id]:
+            logger.info(
+                "New message %s in channel %s" % (event.message.id, context.channel_username)
+            )
+            await saving_data_to_db(
+                self.client, self.db, self.batches[channel_id], context, event.message
+            )
+
+    async def on_message_edited(self, event) -> None:
+        channel_id = get_event_channel_id(event)
+        context = self.contexts.get(channel_id)
+        if context is None:
+            return
+        message = event.message
+        message_data = create_message_data(
+            message, channel_id, context.channel_username, None, None
+        )
+        async with self.locks[channel_id]:
+            # The edited message may still be waiting in the batch.
+            await self.batches[channel_id].flush()
+            await self.db.save_refreshed_messages(
+                channel_id,
+                context.channel_username,
+                [(message.id, get_refreshable_columns(message_data))],
+                [message.id],
+                time.time(),
+                get_reactions(message, channel_id, context.channel_username),
+                get_message_entities(message, channel_id),
+            )
+
+    async def on_message_deleted(self, event) -> None:
+        channel_id = get_event_channel_id(event)
+        if channel_id not in self.contexts:
+            return
+        async with self.locks[channel_id]:
+            await self.batches[channel_id].flush()
+            await self.db.mark_messages_deleted(channel_id, event.deleted_ids)
+
+    async def flush_due_batches(self) -> None:
+        for channel_id, batch in self.batches.items():
+            if batch.is_due():
+                async with self.locks[channel_id]:
+                    await batch.flush()
+
+    async def gap_fill(self) -> None:
+        for channel_id, context in self.contexts.items():
+            async with self.locks[channel_id]:
+                await self.batches[channel_id].flush()
+                try:
+                    await download_messages(self.client, self.db, context)
+                except Exception as e:
+                    logger.exception(
+                        "Exception %s occurred filling the gap of channel %s"
+                        % (type(e).__name__, context.channel_username)
+                    )
+
+    async def _repeat(self, func, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await func()
+            except Exception as e:
+                logger.exception(
+                    "Exception %s occurred in %s, retrying in %s seconds"
+                    % (type(e).__name__, func.__name__, interval)
+                )
+
+    async def run(self, channels: List[str]) -> None:
+        """Follow the channels until the client disconnects."""
+        for channel in channels:
+            await self.add_channel(channel)
+        self.register_handlers()
+        await self.gap_fill()
+        tasks = [
+            asyncio.create_task(self._repeat(self.flush_due_batches, self.flush_interval)),
+            asyncio.create_task(self._repeat(self.gap_fill, self.gap_fill_interval)),
+        ]
+        try:
+            await self.client.run_until_disconnected()
+        finally:
+            for task in tasks:
+                task.cancel()
+            for batch in self.batches.values():
+                await batch.flush()
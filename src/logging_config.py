@@ -16,3 +16,6 @@ def get_logger(logger_name: str) -> logging.Logger:
     logger.addHandler(file_handler)
 
     return logger
+
+
+logger = get_logger("spylegram")
@@ -1,13 +1,18 @@
 import logging
+from collections import namedtuple
 from dataclasses import dataclass
 from datetime import datetime
 from typing import List, Optional, Tuple, Union
+from urllib.parse import urlsplit
 
 from telethon import TelegramClient
 from telethon.errors import ChannelPrivateError
-from telethon.tl.types import (Message, MessageEntityTextUrl,
+from telethon.tl.types import (Message, MessageEntityHashtag,
+                               MessageEntityMention, MessageEntityTextUrl,
                                MessageEntityUnknown, MessageEntityUrl,
-                               MessageService, PeerChannel)
+                               MessageService, PeerChannel,
+                               ReactionCustomEmoji, ReactionEmoji,
+                               ReactionPaid, TypeReaction)
 
 logging.basicConfig(
     format="[%(levelname) 5s/%(asctime)s] %(name)s: %(message)s", level=logging.INFO
@@ -15,6 +20,17 @@ logging.basicConfig(
 
 TypeMessageEntity = Union[MessageEntityUnknown, MessageEntityUrl]
 
+ENTITY_URL = "url"
+ENTITY_TEXT_URL = "text_url"
+ENTITY_MENTION = "mention"
+ENTITY_HASHTAG = "hashtag"
+
+# One url, mention or hashtag of a message, a row of message_entities.
+MessageEntityData = namedtuple(
+    "MessageEntityData",
+    ["message_id", "channel_id", "entity_type", "value", "domain"],
+)
+
 
 @dataclass
 class MessageData:
@@ -62,6 +78,56 @@ def get_url(message_entity: Optional[List["TypeMessageEntity"]]) -> str:
     return str(list_of_entities)
 
 
+def get_reaction_emoticon(reaction: TypeReaction) -> Optional[str]:
+    """
+    Key of a reaction in the emoticon column. Custom emoji have no emoticon,
+    they are stored as ``custom:<document id>``.
+    """
+    if isinstance(reaction, ReactionEmoji):
+        return reaction.emoticon
+    if isinstance(reaction, ReactionCustomEmoji):
+        return "custom:%d" % reaction.document_id
+    if isinstance(reaction, ReactionPaid):
+        return "paid"
+    return None
+
+
+def get_domain(url: str) -> Optional[str]:
+    """Lower-case host of a url without a leading www., None if it has none."""
+    if "://" not in url:
+        url = "http://" + url
+    try:
+        host = urlsplit(url).hostname
+    except ValueError:
+        return None
+    if host and host.startswith("www."):
+        host = host[len("www."):]
+    return host or None
+
+
+def get_message_entities(message: Message, channel_id: int) -> List[MessageEntityData]:
+    """
+    Urls, link targets, mentions and hashtags of a message. Mentions and
+    hashtags are lower-cased, as Telegram matches them case-insensitively.
+    """
+    if not message.entities:
+        return []
+    entities = []
+    for entity, text in message.get_entities_text():
+        if isinstance(entity, MessageEntityTextUrl):
+            entities.append((ENTITY_TEXT_URL, entity.url, get_domain(entity.url)))
+        elif isinstance(entity, MessageEntityUrl):
+            entities.append((ENTITY_URL, text, get_domain(text)))
+        elif isinstance(entity, MessageEntityMention):
+            entities.append((ENTITY_MENTION, text.lower(), None))
+        elif isinstance(entity, MessageEntityHashtag):
+            entities.append((ENTITY_HASHTAG, text.lower(), None))
+    return [
+        MessageEntityData(message.id, channel_id, entity_type, value, domain)
+        for entity_type, value, domain in entities
+    ]
+
+
 def get_telegram_link(fwd_channel_username: str) -> str:
     return f"https://t.me/{fwd_channel_username}"
 
@@ -0,0 +1,131 @@
+"""
+Versioned data migrations for existing databases.
+
+``db_schema.sql`` always describes the latest schema and is safe to run on any
+database. Steps that have to move or rewrite data that is already stored go
+here. Each entry is one schema version; its statements run in a single
+transaction and ``PRAGMA user_version`` records how many entries were applied.
+Append new migrations at the end and never reorder or edit released ones.
+Besides the SQLite built-ins, migrations can use the functions registered on
+the connection by Database, such as ``sha256(blob)``.
+"""
+from typing import List, Tuple
+
+MIGRATIONS: List[Tuple[str, ...]] = [
+    # 1: fill the per-channel checkpoint table from the stored messages
+    (
+        """
+        INSERT OR IGNORE INTO scrape_state (channel_id, channel_name, last_processed_message_id)
+        SELECT channel_id, channel_name, max(MAX(message_id), MAX(last_processed_message_id))
+        FROM messages
+        WHERE channel_id IS NOT NULL
+        GROUP BY channel_id
+        """,
+    ),
+    # 2: move image and document bytes into the content-addressed blobs table
+    (
+        "ALTER TABLE images ADD COLUMN blob_sha256 TEXT",
+        "ALTER TABLE documents ADD COLUMN blob_sha256 TEXT",
+        """
+        INSERT OR IGNORE INTO blobs (sha256, size, data)
+        SELECT sha256(image_data), length(image_data), image_data
+        FROM images
+        WHERE image_data IS NOT NULL
+        """,
+        """
+        UPDATE images SET blob_sha256 = sha256(image_data), image_data = NULL
+        WHERE image_data IS NOT NULL
+        """,
+        """
+        INSERT OR IGNORE INTO blobs (sha256, size, data)
+        SELECT sha256(file_blob), length(file_blob), file_blob
+        FROM documents
+        WHERE file_blob IS NOT NULL
+        """,
+        """
+        UPDATE documents SET blob_sha256 = sha256(file_blob), file_blob = NULL
+        WHERE file_blob IS NOT NULL
+        """,
+    ),
+    # 3: blobs above the inline size cutoff live on the filesystem
+    (
+        "ALTER TABLE blobs ADD COLUMN storage TEXT DEFAULT 'inline'",
+        "ALTER TABLE blobs ADD COLUMN path TEXT",
+    ),
+    # 4: large files waiting in the download manifest become download jobs
+    (
+        """
+        INSERT OR IGNORE INTO download_jobs (kind, channel_id, channel_name, message_id)
+        SELECT 'large_file', channel_id, channel_name, message_id
+        FROM download_manifest
+        WHERE status = 'pending'
+        """,
+    ),
+    # 5: one row per reaction of a message, so counts can be upserted
+    (
+        """
+        DELETE FROM reactions WHERE id NOT IN (
+            SELECT MAX(id) FROM reactions GROUP BY message_id, channel_id, emoticon
+        )
+        """,
+        "DROP INDEX IF EXISTS idx_reactions_message_emoticon",
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_reactions_message_emoticon
+            ON reactions (message_id, channel_id, emoticon)
+        """,
+    ),
+    # 6: views, forwards and edits of recent messages are refreshed
+    (
+        "ALTER TABLE messages ADD COLUMN last_refreshed_at REAL DEFAULT NULL",
+    ),
+    # 7: messages deleted in the channel are kept and marked
+    (
+        "ALTER TABLE messages ADD COLUMN deleted_at TIMESTAMPTZ(0) DEFAULT NULL",
+    ),
+    # 8: deletion checks continue where the last pass stopped
+    (
+        "ALTER TABLE scrape_state ADD COLUMN last_reconciled_message_id INTEGER DEFAULT 0",
+    ),
+    # 9: index the messages stored before the full-text index existed
+    (
+        "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')",
+    ),
+    # 10: count the forwards stored before forward_edges existed
+    (
+        "DELETE FROM forward_edges",
+        """
+        INSERT INTO forward_edges (source_channel_id, target_channel_id, source_channel_username,
+                                   target_channel_name, forwards, first_seen, last_seen)
+        SELECT message_fwd_from_channel_id, channel_id, MAX(message_fwd_from_channel_username),
+               MAX(channel_name), COUNT(*), MIN(message_date), MAX(message_date)
+        FROM messages
+        WHERE message_fwd_from_channel_id IS NOT NULL
+            AND message_fwd_from_channel_id != 0
+            AND message_fwd_from_channel_id != channel_id
+        GROUP BY message_fwd_from_channel_id, channel_id
+        """,
+    ),
+    # 11: file blob paths are relative to the blob store root; the layout
+    # is fixed, so the path follows from the digest
+    (
+        """
+        UPDATE blobs SET path = substr(sha256, 1, 2) || '/' || substr(sha256, 3, 2) || '/' || sha256
+        WHERE storage = 'file'
+        """,
+        "UPDATE download_manifest SET file_path = NULL WHERE status = 'complete'",
+    ),
+    # 12: one row per photo of a message, so storing a message twice adds no images
+    (
+        """
+        DELETE FROM images WHERE id NOT IN (
+            SELECT MAX(id) FROM images GROUP BY channel_id, message_id, photo_id
+        )
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_images_channel_message_photo
+            ON images (channel_id, message_id, photo_id)
+        """,
+    ),
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
@@ -0,0 +1,184 @@
+import asyncio
+import time
+from collections import namedtuple
+from typing import AsyncIterator, Dict, Optional
+
+from telethon import TelegramClient
+from telethon.errors import FloodWaitError
+
+from src.logging_config import logger
+
+RateLimit = namedtuple("RateLimit", ["requests_per_second", "burst"])
+
+# Request classes share one bucket each. Telegram does not publish its limits,
+# these are conservative values for a single user account.
+DEFAULT_RATE_LIMITS: Dict[str, RateLimit] = {
+    "entity": RateLimit(requests_per_second=2, burst=5),
+    "messages": RateLimit(requests_per_second=3, burst=10),
+    "download": RateLimit(requests_per_second=10, burst=20),
+}
+MAX_FLOOD_WAIT_RETRIES = 5
+FLOOD_WAIT_MARGIN_IN_SECONDS = 1
+# iter_messages fetches history in pages of up to 100 messages per request.
+MESSAGES_PER_REQUEST = 100
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+
+class RateLimiter:
+    """
+    Shared request budget of one Telegram account.
+
+    Every request waits for a token of its request class. A FloodWaitError
+    seen by any worker pauses all workers until Telegram allows requests
+    again, after which the failed request is retried.
+    """
+
+    def __init__(
+        self,
+        rate_limits: Optional[Dict[str, RateLimit]] = None,
+        max_retries: int = MAX_FLOOD_WAIT_RETRIES,
+        flood_wait_margin: float = FLOOD_WAIT_MARGIN_IN_SECONDS,
+    ) -> None:
+        self.buckets = {
+            request_class: TokenBucket(limit.requests_per_second, limit.burst)
+            for request_class, limit in (rate_limits or DEFAULT_RATE_LIMITS).items()
+        }
+        self.max_retries = max_retries
+        self.flood_wait_margin = flood_wait_margin
+        self.resume_at = 0.0
+        self.flood_waits = 0
+
+    async def wait(self, request_class: str) -> None:
+        while (delay := self.resume_at - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+        bucket = self.buckets.get(request_class)
+        if bucket is not None:
+            await bucket.acquire()
+
+    def flood_wait(self, error: FloodWaitError, attempt: int) -> None:
+        self.flood_waits += 1
+        if attempt >= self.max_retries:
+            raise error
+        logger.warning(
+            "FloodWaitError: pausing all requests for %s seconds" % error.seconds
+        )
+        self.resume_at = max(
+            self.resume_at, time.monotonic() + error.seconds + self.flood_wait_margin
+        )
+
+    async def call(self, request_class: str, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            await self.wait(request_class)
+            try:
+                return await func(*args, **kwargs)
+            except FloodWaitError as e:
+                attempt += 1
+                self.flood_wait(e, attempt)
+
+
+class RateLimitedClient:
+    """
+    TelegramClient wrapper that sends every request the scraper makes through
+    a RateLimiter. Iterators resume after a flood wait from the last item they
+    yielded instead of starting over. Other attributes go to the wrapped client.
+    """
+
+    def __init__(self, client: TelegramClient, limiter: RateLimiter) -> None:
+        self.client = client
+        self.limiter = limiter
+        # Flood waits are handled here for all workers at once, so the client
+        # must not sleep through them on its own.
+        client.flood_sleep_threshold = 0
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    async def get_entity(self, *args, **kwargs):
+        return await self.limiter.call("entity", self.client.get_entity, *args, **kwargs)
+
+    async def get_messages(self, *args, **kwargs):
+        return await self.limiter.call(
+            "messages", self.client.get_messages, *args, **kwargs
+        )
+
+    async def download_media(self, *args, **kwargs):
+        return await self.limiter.call(
+            "download", self.client.download_media, *args, **kwargs
+        )
+
+    async def iter_messages(self, entity, limit=None, **kwargs) -> AsyncIterator:
+        ids = kwargs.pop("ids", None)
+        if ids is not None and not isinstance(ids, (list, tuple)):
+            ids = [ids]
+        reverse = kwargs.get("reverse", False)
+        yielded = 0
+        attempt = 0
+        while True:
+            await self.limiter.wait("messages")
+            if ids is not None:
+                kwargs["ids"] = ids[yielded:]
+            try:
+                async for message in self.client.iter_messages(
+                    entity, limit=None if limit is None else limit - yielded, **kwargs
+                ):
+                    yielded += 1
+                    attempt = 0
+                    if ids is None and message is not None:
+                        # Continue after this message if we have to start over.
+                        if reverse:
+                            kwargs["min_id"] = message.id
+                        else:
+                            kwargs["max_id"] = message.id
+                            kwargs.pop("offset_id", None)
+                    yield message
+                    if yielded % MESSAGES_PER_REQUEST == 0:
+                        await self.limiter.wait("messages")
+                return
+            except FloodWaitError as e:
+                attempt += 1
+                self.limiter.flood_wait(e, attempt)
+
+    async def iter_download(self, file, offset: int = 0, limit=None, **kwargs) -> AsyncIterator:
+        chunks = 0
+        attempt = 0
+        while True:
+            await self.limiter.wait("download")
+            try:
+                async for chunk in self.client.iter_download(
+                    file,
+                    offset=offset,
+                    limit=None if limit is None else limit - chunks,
+                    **kwargs,
+                ):
+                    offset += len(chunk)
+                    chunks += 1
+                    attempt = 0
+                    yield chunk
+                    if limit is None or chunks < limit:
+                        await self.limiter.wait("download")
+                return
+            except FloodWaitError as e:
+                attempt += 1
+                self.limiter.flood_wait(e, attempt)
@@ -0,0 +1,58 @@
+from collections import namedtuple
+
+from telethon import TelegramClient
+
+from src.db import Database
+from src.logging_config import logger
+from src.refresh import MAX_IDS_PER_REQUEST
+
+# Stored messages checked per channel and pass, i.e. 100 requests.
+RECONCILE_IDS_PER_PASS = 100 * MAX_IDS_PER_REQUEST
+
+ReconcileStats = namedtuple("ReconcileStats", ["checked", "deleted", "finished_round"])
+
+
+async def reconcile_channel(
+    client: TelegramClient,
+    db: Database,
+    channel: str,
+    ids_per_pass: int = RECONCILE_IDS_PER_PASS,
+) -> ReconcileStats:
+    """
+    Check which stored messages of a channel were deleted since they were
+    scraped. Stored ids are fetched again in chunks of MAX_IDS_PER_REQUEST,
+    ids Telegram no longer returns get a deleted_at timestamp.
+
+    One pass checks up to ids_per_pass messages after the cursor saved in
+    scrape_state, the next pass continues there. After the last stored message
+    the cursor starts over, so every message is checked again in later rounds.
+    """
+    channel_entity = await client.get_entity(channel)
+    channel_id, channel_username = channel_entity.id, channel_entity.username
+    cursor_id = (await db.get_scrape_state(channel_id)).last_reconciled_message_id
+
+    checked = deleted = 0
+    finished_round = False
+    while checked < ids_per_pass:
+        ids = await db.get_stored_message_ids(
+            channel_id, cursor_id, min(MAX_IDS_PER_REQUEST, ids_per_pass - checked)
+        )
+        if not ids:
+            finished_round = True
+            cursor_id = 0
+            await db.update_last_reconciled_message_id(channel_id, channel_username, 0)
+            break
+        messages = await client.get_messages(channel_entity, ids=ids)
+        deleted_ids = [
+            message_id for message_id, message in zip(ids, messages) if message is None
+        ]
+        if deleted_ids:
+            await db.mark_messages_deleted(channel_id, deleted_ids)
+        cursor_id = ids[-1]
+        await db.update_last_reconciled_message_id(channel_id, channel_username, cursor_id)
+        checked += len(ids)
+        deleted += len(deleted_ids)
+
+    stats = ReconcileStats(checked, deleted, finished_round)
+    logger.info("Reconciled channel %s: %s" % (channel_username, stats))
+    return stats
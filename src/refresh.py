@@ -0,0 +1,116 @@
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from telethon import TelegramClient
+
+from src.app import get_reactions
+from src.db import REFRESHABLE_MESSAGE_COLUMNS, Database
+from src.logging_config import logger
+from src.message import (MessageData, create_message_data,
+                         get_message_entities)
+
+# get_messages accepts up to 100 ids per request.
+MAX_IDS_PER_REQUEST = 100
+
+# (message age up to, time between refreshes) in seconds. Views and reactions
+# of a post grow fast in its first hours and barely change after a week.
+REFRESH_SCHEDULE = (
+    (60 * 60, 10 * 60),
+    (24 * 60 * 60, 60 * 60),
+    (7 * 24 * 60 * 60, 12 * 60 * 60),
+)
+REFRESH_WINDOW_IN_SECONDS = REFRESH_SCHEDULE[-1][0]
+
+RefreshStats = namedtuple("RefreshStats", ["refreshed", "changed", "missing"])
+
+
+def get_refresh_interval(age_in_seconds: float) -> Optional[float]:
+    """Seconds between refreshes of a message of this age, None once it is too old."""
+    for max_age, interval in REFRESH_SCHEDULE:
+        if age_in_seconds <= max_age:
+            return interval
+    return None
+
+
+def is_refresh_due(
+    message_date: datetime, last_refreshed_at: Optional[float], now: float
+) -> bool:
+    interval = get_refresh_interval(now - message_date.timestamp())
+    if interval is None:
+        return False
+    if last_refreshed_at is None:
+        return True
+    return now - last_refreshed_at >= interval
+
+
+def to_db_value(value: Any) -> Any:
+    # sqlite3 stores datetimes as ISO text, compare them the same way.
+    if isinstance(value, datetime):
+        return value.isoformat(" ")
+    return value
+
+
+def get_refreshable_columns(message_data: MessageData) -> Dict[str, Any]:
+    return {column: getattr(message_data, column) for column in REFRESHABLE_MESSAGE_COLUMNS}
+
+
+def get_changed_columns(stored: Dict[str, Any], message_data: MessageData) -> Dict[str, Any]:
+    return {
+        column: value
+        for column, value in get_refreshable_columns(message_data).items()
+        if to_db_value(value) != stored[column]
+    }
+
+
+async def refresh_channel(client: TelegramClient, db: Database, channel: str) -> RefreshStats:
+    """
+    Fetch the messages of a channel that are due for a refresh again and
+    update the columns that changed since they were stored, as well as their
+    reactions. Young messages are due often, older ones rarely, see
+    REFRESH_SCHEDULE.
+    """
+    channel_entity = await client.get_entity(channel)
+    channel_id, channel_username = channel_entity.id, channel_entity.username
+    now = time.time()
+    since = datetime.now(timezone.utc) - timedelta(seconds=REFRESH_WINDOW_IN_SECONDS)
+
+    stored_messages = {}
+    for message_id, message_date, last_refreshed_at, *values in await db.get_recent_messages(
+        channel_id, since
+    ):
+        if is_refresh_due(datetime.fromisoformat(message_date), last_refreshed_at, now):
+            stored_messages[message_id] = dict(zip(REFRESHABLE_MESSAGE_COLUMNS, values))
+
+    due_ids = list(stored_messages)
+    refreshed = changed = missing = 0
+    for start in range(0, len(due_ids), MAX_IDS_PER_REQUEST):
+        ids = due_ids[start:start + MAX_IDS_PER_REQUEST]
+        messages = await client.get_messages(channel_entity, ids=ids)
+        changes = []
+        refreshed_ids: List[int] = []
+        reactions = []
+        entities = []
+        for message_id, message in zip(ids, messages):
+            if message is None:
+                missing += 1
+                continue
+            message_data = create_message_data(
+                message, channel_id, channel_username, None, None
+            )
+            columns = get_changed_columns(stored_messages[message_id], message_data)
+            if columns:
+                changes.append((message_id, columns))
+            refreshed_ids.append(message_id)
+            reactions.extend(get_reactions(message, channel_id, channel_username))
+            entities.extend(get_message_entities(message, channel_id))
+        await db.save_refreshed_messages(
+            channel_id, channel_username, changes, refreshed_ids, time.time(), reactions, entities
+        )
+        refreshed += len(refreshed_ids)
+        changed += len(changes)
+
+    stats = RefreshStats(refreshed, changed, missing)
+    logger.info("Refreshed channel %s: %s" % (channel_username, stats))
+    return stats
@@ -0,0 +1,78 @@
+import asyncio
+import time
+from collections import namedtuple
+from typing import Awaitable, Callable, List
+
+from src.logging_config import logger
+
+DEFAULT_MAX_CONCURRENT_CHANNELS = 4
+
+ChannelTiming = namedtuple(
+    "ChannelTiming", ["channel", "duration_in_seconds", "succeeded"]
+)
+
+
+class ChannelScheduler:
+    """
+    Run a channel pipeline for many channels with a bounded pool of workers.
+
+    Every worker takes the next channel from a shared queue and runs its
+    pipeline from start to end, so the steps of one channel keep their order
+    while up to ``max_concurrent_channels`` channels are scraped at once.
+    A failing channel is logged and does not stop the other workers.
+    """
+
+    def __init__(
+        self,
+        pipeline: Callable[[str], Awaitable[None]],
+        max_concurrent_channels: int = DEFAULT_MAX_CONCURRENT_CHANNELS,
+    ) -> None:
+        self.pipeline = pipeline
+        self.max_concurrent_channels = max(1, max_concurrent_channels)
+        self.timings: List[ChannelTiming] = []
+
+    async def run(self, channels: List[str]) -> List[ChannelTiming]:
+        queue: asyncio.Queue = asyncio.Queue()
+        for channel in channels:
+            queue.put_nowait(channel)
+
+        workers = [
+            asyncio.create_task(self._worker(queue))
+            for _ in range(min(self.max_concurrent_channels, len(channels)))
+        ]
+        await asyncio.gather(*workers)
+        return self.timings
+
+    async def _worker(self, queue: asyncio.Queue) -> None:
+        while not queue.empty():
+            channel = queue.get_nowait()
+            started_at = time.monotonic()
+            succeeded = True
+            try:
+                await self.pipeline(channel)
+            except Exception as e:
+                succeeded = False
+                logger.exception(
+                    "Exception %s occurred while scraping channel %s"
+                    % (type(e).__name__, channel)
+                )
+            timing = ChannelTiming(channel, time.monotonic() - started_at, succeeded)
+            self.timings.append(timing)
+            logger.info(
+                "Channel %s finished in %.1f seconds" % (channel, timing.duration_in_seconds)
+            )
+
+    def format_timings(self) -> str:
+        """Per-channel report, slowest channel first, to tune the concurrency."""
+        lines = [
+            "%-40s %10.1f s%s"
+            % (
+                timing.channel,
+                timing.duration_in_seconds,
+                "" if timing.succeeded else "  FAILED",
+            )
+            for timing in sorted(
+                self.timings, key=lambda t: t.duration_in_seconds, reverse=True
+            )
+        ]
+        return "\n".join(lines)
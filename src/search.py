@@ -0,0 +1,78 @@
+from collections import namedtuple
+from typing import List, Optional, Sequence
+
+from src.db import Database
+
+DEFAULT_SEARCH_LIMIT = 20
+SNIPPET_TOKENS = 16
+# bm25 weights of the indexed columns: message_text, url_in_message
+BM25_WEIGHTS = (1.0, 0.5)
+
+SearchResult = namedtuple(
+    "SearchResult",
+    ["channel_name", "message_id", "message_date", "snippet", "rank"],
+)
+
+
+def to_fts_query(text: str) -> str:
+    """
+    Turn plain search words into an FTS5 query matching messages that contain
+    all of them. Every word is quoted, so dots and dashes in e.g. domains are
+    not read as query syntax.
+    """
+    return " ".join('"%s"' % word.replace('"', '""') for word in text.split())
+
+
+async def search_messages(
+    db: Database,
+    query: str,
+    channels: Optional[Sequence[str]] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    limit: int = DEFAULT_SEARCH_LIMIT,
+    raw: bool = False,
+) -> List[SearchResult]:
+    """
+    Full-text search over message text and urls, best matches first.
+
+    query is plain words unless raw is set, then it is passed to FTS5 as is
+    (phrases, OR, NEAR, prefix*). since and until are ISO dates, since is
+    inclusive and until exclusive.
+    """
+    conditions = ["messages_fts MATCH ?"]
+    params = [query if raw else to_fts_query(query)]
+    if channels:
+        conditions.append("m.channel_name IN (%s)" % ", ".join("?" * len(channels)))
+        params.extend(channels)
+    if since:
+        conditions.append("m.message_date >= ?")
+        params.append(since)
+    if until:
+        conditions.append("m.message_date < ?")
+        params.append(until)
+    params.append(limit)
+
+    async with db.db_cursor() as cursor:
+        result = await cursor.execute(
+            """
+            SELECT m.channel_name, m.message_id, m.message_date,
+                   snippet(messages_fts, -1, '[', ']', '…', %d),
+                   bm25(messages_fts, %s) AS rank
+            FROM messages_fts
+            JOIN messages m ON m.id = messages_fts.rowid
+            WHERE %s
+            ORDER BY rank
+            LIMIT ?
+            """
+            % (SNIPPET_TOKENS, ", ".join(map(str, BM25_WEIGHTS)), " AND ".join(conditions)),
+            params,
+        )
+        return [SearchResult(*row) for row in await result.fetchall()]
+
+
+def format_search_results(results: List[SearchResult]) -> str:
+    return "\n".join(
+        "%s/%s  %s\n    %s"
+        % (result.channel_name, result.message_id, result.message_date, result.snippet)
+        for result in results
+    )
@@ -1,4 +1,7 @@
-from telethon.tl.types import DocumentAttributeFilename, Message
+import hashlib
+
+from telethon.tl.types import (DocumentAttributeFilename, Message, Photo,
+                               PhotoSizeProgressive)
 from telethon.utils import get_extension
 
 from src.logging_config import logger
@@ -13,6 +16,40 @@ def read_binary_file(file_path: str) -> bytes | None:
         return None
 
 
+def sha256_hex(data: bytes | None) -> str | None:
+    return hashlib.sha256(data).hexdigest() if data is not None else None
+
+
+def row_hash(*values) -> int:
+    """
+    40 bit hash of a row of SQLite values. Small enough that SUM over millions
+    of rows does not overflow, so the sum works as an order independent
+    fingerprint of a table's content.
+    """
+    return int(hashlib.sha256(repr(values).encode()).hexdigest()[:10], 16)
+
+
+def file_sha256_hex(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        while chunk := file.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_photo_size(photo: Photo) -> int:
+    """Size in bytes of the largest version of a photo, the one download_media fetches."""
+    sizes = [0]
+    for photo_size in photo.sizes:
+        if isinstance(photo_size, PhotoSizeProgressive):
+            sizes.append(max(photo_size.sizes, default=0))
+        elif hasattr(photo_size, "size"):
+            sizes.append(photo_size.size)
+        elif hasattr(photo_size, "bytes"):
+            sizes.append(len(photo_size.bytes))
+    return max(sizes)
+
+
 def callback_photo(current: int, total: int) -> None:
     # logger.info('Downloaded', current, 'out of', total, 'bytes: {:.2%}'.format(current / total))
     percentage = (current / total) * 100
@@ -0,0 +1,265 @@
+import datetime
+import os
+from unittest.mock import AsyncMock
+
+import pytest
+from telethon.errors import RPCError
+from telethon.tl.types import (Document, DocumentAttributeFilename, Message,
+                               MessageMediaDocument, MessageMediaPhoto,
+                               PeerChannel, Photo, PhotoSize,
+                               PhotoSizeProgressive)
+
+from src import app
+from src.app import (check_and_save_photo, download_document,
+                     download_messages,
+                     download_large_file, process_and_save_message,
+                     save_document, save_large_file)
+from src.batch import MessageBatch
+from src.blobstore import BlobStore
+from src.channel import ScrapeContext
+from src.db import Database, DownloadJob
+from src.message import create_message_data
+from src.utils import sha256_hex
+
+
+@pytest.mark.asyncio
+async def test_process_and_save_message_saves_each_new_message_once(mocker):
+    saving_data_to_db = mocker.patch(
+        "src.app.saving_data_to_db", new_callable=AsyncMock
+    )
+    client, db, batch = AsyncMock(), AsyncMock(), mocker.Mock()
+    context = ScrapeContext(channel_id=123, channel_username="MyCoolChannel")
+
+    for message_id in (1, 2, 2):
+        message = Message(id=message_id, peer_id=PeerChannel(channel_id=123))
+        await process_and_save_message(client, db, batch, context, message)
+
+    assert saving_data_to_db.await_count == 2
+    assert context.last_message_id == 2
+    client.get_entity.assert_not_called()
+    db.get_scrape_state.assert_not_called()
+
+
+class FakeHistoryClient:
+    def __init__(self, message_ids):
+        self.message_ids = message_ids
+
+    async def iter_messages(self, channel, limit=None, min_id=0, reverse=False):
+        for message_id in self.message_ids:
+            if message_id > min_id:
+                yield Message(id=message_id, peer_id=PeerChannel(channel_id=123), message="Post")
+
+
+@pytest.mark.asyncio
+async def test_failed_message_is_not_checkpointed(tmp_path, mocker):
+    async def fail_on_message_12(client, db, batch, context, message):
+        if message.id == 12:
+            raise RPCError(None, "Telegram gave up")
+        batch.add_message(
+            create_message_data(message, context.channel_id, context.channel_username, None, None)
+        )
+
+    mocker.patch("src.app.saving_data_to_db", side_effect=fail_on_message_12)
+    context = ScrapeContext(channel_id=123, channel_username="MyCoolChannel", last_message_id=10)
+
+    async with Database(str(tmp_path / "test.db")) as db:
+        await db.create_schema()
+        with pytest.raises(RPCError):
+            await download_messages(FakeHistoryClient([11, 12, 13]), db, context)
+
+        # The next run starts again at message 12.
+        assert (await db.get_scrape_state(123)).last_processed_message_id == 11
+
+
+def make_photo_message(message_id: int, photo_id: int) -> Message:
+    return Message(
+        id=message_id,
+        peer_id=PeerChannel(channel_id=123),
+        media=MessageMediaPhoto(
+            photo=Photo(
+                id=photo_id,
+                access_hash=-photo_id,
+                file_reference=b"",
+                date=datetime.datetime(1999, 5, 1, 22, 22, 16, tzinfo=datetime.timezone.utc),
+                sizes=[
+                    PhotoSize(type="m", w=320, h=320, size=2000),
+                    PhotoSizeProgressive(type="y", w=1280, h=1280, sizes=[1000, 5000, 9000]),
+                ],
+                dc_id=2,
+            )
+        ),
+    )
+
+
+@pytest.mark.asyncio
+async def test_known_photos_are_linked_instead_of_downloaded():
+    context = ScrapeContext(
+        channel_id=123, channel_username="MyCoolChannel", known_photos={42: "abc"}
+    )
+    batch = MessageBatch(AsyncMock(), 123, "MyCoolChannel")
+
+    await check_and_save_photo(batch, context, make_photo_message(1, 42))
+    await check_and_save_photo(batch, context, make_photo_message(2, 43))
+
+    assert [(image.message_id, image.sha256) for image in batch.images] == [(1, "abc")]
+    assert [job[3] for job in batch.download_jobs] == [2]
+    assert (context.skipped_photos, context.skipped_photo_bytes) == (1, 9000)
+
+
+class FakeDownloadClient:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.offsets = []
+
+    async def iter_download(self, media, offset=0, limit=None, request_size=None, file_size=None):
+        for _ in range(limit):
+            self.offsets.append(offset)
+            yield self.data[offset:offset + request_size]
+            offset += request_size
+
+
+def make_document_message(message_id: int, size: int, document_id: int = 555) -> Message:
+    return Message(
+        id=message_id,
+        peer_id=PeerChannel(channel_id=123),
+        media=MessageMediaDocument(
+            document=Document(
+                id=document_id,
+                access_hash=-555,
+                file_reference=b"",
+                date=datetime.datetime(1999, 5, 1, 22, 22, 16, tzinfo=datetime.timezone.utc),
+                mime_type="application/zip",
+                size=size,
+                dc_id=2,
+                attributes=[DocumentAttributeFilename(file_name="leak.zip")],
+            )
+        ),
+    )
+
+
+@pytest.mark.asyncio
+async def test_large_file_download_resumes_from_manifest(tmp_path):
+    data = os.urandom(4 * 4096)
+    file_path = str(tmp_path / "leak.zip")
+    with open(file_path, "wb") as file:
+        file.write(data[:8192] + bytes(8192))
+    client = FakeDownloadClient(data)
+
+    async with Database(str(tmp_path / "test.db"), BlobStore(str(tmp_path / "blobs"), 0)) as db:
+        await db.create_schema()
+        await db.add_to_download_manifest(123, 7, "MyCoolChannel", "leak.zip", file_path, len(data), 4096)
+        # the first two segments finished before the restart
+        await db.update_download_progress(123, 7, bytes([0b0011]), 8192)
+        entry = (await db.get_pending_downloads(123))[0]
+
+        await download_large_file(client, db, make_document_message(7, len(data)), entry)
+
+        assert min(client.offsets) == 8192
+        # Moved into the blob store.
+        assert not os.path.exists(file_path)
+        assert await db.get_pending_downloads(123) == []
+        assert await db.is_document_in_db(7, 123)
+        assert await db.get_blob(sha256_hex(data)) == data
+
+
+class FakeChannelClient:
+    """Serves a channel of documents, each with its own content."""
+
+    def __init__(self, documents: dict):
+        self.messages = [
+            make_document_message(message_id, len(data), document_id=message_id)
+            for message_id, data in documents.items()
+        ]
+        self.documents = documents
+
+    async def iter_messages(self, entity, filter=None, min_id=0):
+        for message in reversed(self.messages):
+            yield message
+
+    async def iter_download(self, media, offset=0, limit=None, request_size=None, file_size=None):
+        data = self.documents[media.document.id]
+        for _ in range(limit):
+            yield data[offset:offset + request_size]
+            offset += request_size
+
+
+async def download_large_files(client: FakeChannelClient, db: Database) -> None:
+    await download_document(client, db, 123, "MyCoolChannel")
+    for message in client.messages:
+        job = DownloadJob(None, "large_file", 123, "MyCoolChannel", message.id, 0)
+        await save_large_file(client, db, job, message)
+
+
+@pytest.mark.asyncio
+async def test_large_files_with_the_same_name_get_their_own_path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(app, "THRESHOLD_SIZE_IN_MB", 0)
+    monkeypatch.setattr(app, "SEGMENT_SIZE", 4096)
+    # Both are called leak.zip and have the same size.
+    documents = {7: os.urandom(2 * 4096), 8: os.urandom(2 * 4096)}
+    client = FakeChannelClient(documents)
+
+    async with Database(str(tmp_path / "test.db"), BlobStore(str(tmp_path / "blobs"), 0)) as db:
+        await db.create_schema()
+        await download_large_files(client, db)
+
+        for message_id, data in documents.items():
+            entry = await db.get_download_manifest_entry(123, message_id)
+            assert entry.status == "complete"
+            assert entry.sha256 == sha256_hex(data)
+            assert await db.get_blob(sha256_hex(data)) == data
+
+
+@pytest.mark.asyncio
+async def test_complete_legacy_large_file_is_not_downloaded_again(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(app, "THRESHOLD_SIZE_IN_MB", 0)
+    monkeypatch.setattr(app, "SEGMENT_SIZE", 4096)
+    data = os.urandom(2 * 4096)
+    client = FakeChannelClient({7: data})
+    client.iter_download = None
+    # Saved under its bare name by a version without the download manifest.
+    os.makedirs("MyCoolChannel_downloads_big_files")
+    with open(os.path.join("MyCoolChannel_downloads_big_files", "leak.zip"), "wb") as file:
+        file.write(data)
+
+    async with Database(str(tmp_path / "test.db"), BlobStore(str(tmp_path / "blobs"), 0)) as db:
+        await db.create_schema()
+        await download_large_files(client, db)
+
+        assert (await db.get_download_manifest_entry(123, 7)).sha256 == sha256_hex(data)
+        assert await db.get_blob(sha256_hex(data)) == data
+
+
+class FailingOnceClient:
+    """Loses the connection halfway through the first download."""
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.downloads = 0
+
+    async def iter_download(self, media, file_size=None):
+        self.downloads += 1
+        yield self.data[:4096]
+        if self.downloads == 1:
+            raise ConnectionError("connection lost")
+        yield self.data[4096:]
+
+
+@pytest.mark.asyncio
+async def test_document_download_is_retried_after_a_partial_file(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    data = os.urandom(2 * 4096)
+    client = FailingOnceClient(data)
+    message = make_document_message(7, len(data))
+    job = DownloadJob(None, "document", 123, "MyCoolChannel", 7, 0)
+
+    async with Database(str(tmp_path / "test.db"), BlobStore(str(tmp_path / "blobs"), 0)) as db:
+        await db.create_schema()
+        with pytest.raises(ConnectionError):
+            await save_document(client, db, job, message)
+        await save_document(client, db, job, message)
+
+        assert client.downloads == 2
+        assert await db.is_document_in_db(7, 123)
+        assert await db.get_blob(sha256_hex(data)) == data
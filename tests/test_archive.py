@@ -0,0 +1,155 @@
+import datetime
+import json
+import os
+
+import pytest
+
+from src import archive
+from src.archive import export_archive, import_archive
+from src.batch import ReactionData
+from src.blobstore import BlobStore
+from src.db import Database
+from src.message import MessageData, MessageEntityData
+from src.utils import sha256_hex
+
+
+def make_message_data(message_id: int) -> MessageData:
+    return MessageData(
+        message_id=message_id,
+        channel_id=123,
+        channel_name="MyCoolChannel",
+        message_date=datetime.datetime(2023, 5, 1, 12, 0, 0, tzinfo=datetime.timezone.utc),
+        message_text="Сообщение %s" % message_id,
+    )
+
+
+async def count_rows(db: Database, table: str) -> int:
+    async with db.db_cursor() as cursor:
+        await cursor.execute("SELECT COUNT(*) FROM %s" % table)
+        return (await cursor.fetchone())[0]
+
+
+@pytest.mark.asyncio
+async def test_archive_round_trip_merges_into_another_database(tmp_path):
+    directory = str(tmp_path / "archive")
+    async with Database(str(tmp_path / "source.db")) as source:
+        await source.create_schema()
+        await source.save_image_blob(123, "MyCoolChannel", 1, 10, b"photo")
+        await source.save_messages_batch(
+            [make_message_data(1), make_message_data(2)],
+            [],
+            [ReactionData(1, 123, "MyCoolChannel", "👍", 7)],
+            123,
+            "MyCoolChannel",
+            last_message_id=2,
+            entities=[MessageEntityData(2, 123, "url", "https://example.org/a", "example.org")],
+        )
+        stats = await export_archive(source, directory)
+        assert {s.table: s.rows for s in stats}["messages"] == 2
+
+    async with Database(str(tmp_path / "target.db")) as target:
+        await target.create_schema()
+        await target.save_messages_batch([make_message_data(2), make_message_data(3)], [], [], 123,
+                                         "MyCoolChannel", last_message_id=1)
+
+        stats = await import_archive(target, directory)
+
+        assert {s.table: s.rows for s in stats} == {
+            "channels": 0, "messages": 1, "reactions": 1, "message_entities": 1, "blobs": 1, "images": 1,
+            "documents": 0, "scrape_state": 1,
+        }
+        assert await count_rows(target, "messages") == 3
+        assert await target.get_blob(sha256_hex(b"photo")) == b"photo"
+        assert await target.get_known_photos(123) == {10: sha256_hex(b"photo")}
+        async with target.db_cursor() as cursor:
+            await cursor.execute("SELECT message_id, domain FROM message_entities")
+            assert await cursor.fetchall() == [(2, "example.org")]
+        assert (await target.get_scrape_state(123)).last_processed_message_id == 2
+        # Imported messages are searchable like scraped ones.
+        async with target.db_cursor() as cursor:
+            await cursor.execute("SELECT rowid FROM messages_fts WHERE messages_fts MATCH 'сообщение'")
+            assert len(await cursor.fetchall()) == 3
+
+        stats = await import_archive(target, directory, restart=True)
+        assert all(s.rows == 0 for s in stats)
+
+
+@pytest.mark.asyncio
+async def test_media_without_their_blob_are_not_imported(tmp_path):
+    directory = str(tmp_path / "archive")
+    # The photo is larger than the inline cutoff, so its blob is a file.
+    async with Database(str(tmp_path / "source.db"), BlobStore(str(tmp_path / "blobs"), 4)) as source:
+        await source.create_schema()
+        await source.save_image_blob(123, "MyCoolChannel", 1, 10, b"photo")
+        await source.save_messages_batch([make_message_data(1)], [], [], 123, "MyCoolChannel")
+        await export_archive(source, directory)
+
+    async with Database(str(tmp_path / "target.db")) as target:
+        await target.create_schema()
+        stats = await import_archive(target, directory)
+
+        assert {s.table: s.rows for s in stats}["images"] == 0
+        assert await target.get_known_photos(123) == {}
+        # The target downloads the photo again.
+        jobs = await target.claim_download_jobs(10)
+        assert [(job.kind, job.message_id) for job in jobs] == [("photo", 1)]
+
+
+@pytest.mark.asyncio
+async def test_imported_checkpoint_does_not_hide_an_unfinished_backfill(tmp_path):
+    directory = tmp_path / "archive"
+    directory.mkdir()
+    (directory / "scrape_state.jsonl").write_text(
+        json.dumps({"channel_id": 123, "channel_name": "MyCoolChannel", "last_processed_message_id": 500})
+        + "\n"
+    )
+
+    async with Database(str(tmp_path / "target.db")) as target:
+        await target.create_schema()
+        await target.create_backfill_ranges(123, [(1, 100), (101, 200)])
+        await target.complete_backfill_range((await target.get_backfill_ranges(123))[0].id)
+
+        stats = await import_archive(target, str(directory))
+
+        assert stats[0].rows == 0
+        assert (await target.get_scrape_state(123)).last_processed_message_id == 0
+
+
+@pytest.mark.asyncio
+async def test_interrupted_import_resumes_after_last_batch(tmp_path, monkeypatch):
+    monkeypatch.setattr(archive, "IMPORT_BATCH_ROWS", 2)
+    directory = tmp_path / "archive"
+    directory.mkdir()
+    lines = [json.dumps({"message_id": i, "channel_id": 123}) for i in range(1, 7)]
+    lines[4] = "{broken"
+    path = directory / "messages.jsonl"
+    path.write_text("\n".join(lines) + "\n")
+
+    async with Database(str(tmp_path / "test.db")) as db:
+        await db.create_schema()
+        with pytest.raises(json.JSONDecodeError):
+            await import_archive(db, str(directory), ["messages"])
+        assert await count_rows(db, "messages") == 4
+
+        lines[4] = json.dumps({"message_id": 5, "channel_id": 123})
+        path.write_text("\n".join(lines) + "\n")
+        stats = await import_archive(db, str(directory), ["messages"])
+
+        assert stats[0].rows == 2
+        assert await count_rows(db, "messages") == 6
+
+
+@pytest.mark.asyncio
+async def test_compressed_archive(tmp_path):
+    pytest.importorskip("zstandard")
+    directory = str(tmp_path / "archive")
+    async with Database(str(tmp_path / "source.db")) as source:
+        await source.create_schema()
+        await source.save_messages_batch([make_message_data(1)], [], [], 123, "MyCoolChannel")
+        await export_archive(source, directory, ["messages"], compress=True)
+    assert os.listdir(directory) == ["messages.jsonl.zst"]
+
+    async with Database(str(tmp_path / "target.db")) as target:
+        await target.create_schema()
+        stats = await import_archive(target, directory, ["messages"])
+        assert stats[0].rows == 1
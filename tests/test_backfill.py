@@ -0,0 +1,92 @@
+import pytest
+from telethon.tl.types import Message, PeerChannel
+
+from src.backfill import backfill_channel, split_id_range
+from src.channel import ScrapeContext
+from src.db import Database
+from src.message import MessageData
+
+
+class FakeHistoryClient:
+    def __init__(self, message_ids):
+        self.message_ids = sorted(message_ids)
+        self.requests = []
+
+    async def iter_messages(self, entity, limit=None, min_id=0, max_id=0, reverse=False, wait_time=None):
+        if not reverse:
+            # get_last_message_id asks for the newest message.
+            for message_id in reversed(self.message_ids[-limit:]):
+                yield Message(id=message_id, peer_id=PeerChannel(channel_id=123))
+            return
+        self.requests.append((min_id, max_id))
+        for message_id in self.message_ids:
+            if min_id < message_id < max_id:
+                yield Message(id=message_id, peer_id=PeerChannel(channel_id=123))
+
+
+async def store_message(client, db, batch, context, message):
+    if message.id <= context.last_message_id:
+        return
+    batch.add_message(MessageData(message.id, context.channel_id, context.channel_username))
+    context.last_message_id = message.id
+
+
+async def get_stored_ids(db):
+    async with db.db_cursor() as cursor:
+        await cursor.execute("SELECT message_id FROM messages ORDER BY message_id")
+        return [row[0] for row in await cursor.fetchall()]
+
+
+def test_split_id_range():
+    assert split_id_range(1, 250, 100) == [(1, 100), (101, 200), (201, 250)]
+    assert split_id_range(1, 100, 100) == [(1, 100)]
+
+
+@pytest.mark.asyncio
+async def test_backfill_stores_the_whole_history(tmp_path):
+    message_ids = [i for i in range(1, 2501) if i % 7]
+    async with Database(str(tmp_path / "test.db")) as db:
+        await db.create_schema()
+        client = FakeHistoryClient(message_ids)
+        context = ScrapeContext(123, "MyCoolChannel")
+
+        stats = await backfill_channel(
+            client, db, context, store_message, range_size=1000, concurrency=2
+        )
+
+        assert (stats.ranges, stats.messages) == (3, len(message_ids))
+        assert await get_stored_ids(db) == message_ids
+        assert context.last_message_id == 2500
+        assert (await db.get_scrape_state(123)).last_processed_message_id == 2500
+        assert all(r.completed_at for r in await db.get_backfill_ranges(123))
+
+
+@pytest.mark.asyncio
+async def test_interrupted_backfill_resumes_after_stored_messages(tmp_path):
+    async with Database(str(tmp_path / "test.db")) as db:
+        await db.create_schema()
+        client = FakeHistoryClient(range(1, 251))
+
+        async def fail_at_150(client, db, batch, context, message):
+            if message.id == 150:
+                raise ConnectionError("disconnected")
+            await store_message(client, db, batch, context, message)
+
+        with pytest.raises(ConnectionError):
+            await backfill_channel(
+                client, db, ScrapeContext(123, "MyCoolChannel"), fail_at_150,
+                range_size=100, concurrency=1,
+            )
+        assert await get_stored_ids(db) == list(range(1, 150))
+        assert (await db.get_scrape_state(123)).last_processed_message_id == 0
+
+        client.requests = []
+        stats = await backfill_channel(
+            client, db, ScrapeContext(123, "MyCoolChannel"), store_message,
+            range_size=100, concurrency=1,
+        )
+
+        assert client.requests == [(149, 201), (200, 251)]
+        assert (stats.ranges, stats.messages) == (2, 101)
+        assert await get_stored_ids(db) == list(range(1, 251))
+        assert (await db.get_scrape_state(123)).last_processed_message_id == 250
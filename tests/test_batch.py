@@ -0,0 +1,74 @@
+import datetime
+
+import pytest
+
+from src.batch import ImageData, MessageBatch, ReactionData
+from src.db import Database
+from src.message import MessageData, MessageEntityData
+from src.utils import sha256_hex
+
+
+def make_message_data(message_id: int) -> MessageData:
+    return MessageData(
+        message_id=message_id,
+        channel_id=123,
+        channel_name="MyCoolChannel",
+        message_date=datetime.datetime(1999, 5, 1, 22, 26, 29),
+        message_text="Super important message!",
+    )
+
+
+@pytest.mark.asyncio
+async def test_batch_is_written_in_one_flush(tmp_path):
+    async with Database(str(tmp_path / "test.db")) as db:
+        await db.create_schema()
+        async with MessageBatch(db, 123, "MyCoolChannel", max_size=10) as batch:
+            for message_id in range(1, 4):
+                batch.add_message(make_message_data(message_id))
+            batch.add_image(ImageData(123, "MyCoolChannel", 1, 555, sha256_hex(b"photo")))
+            batch.add_image(ImageData(123, "MyCoolChannel", 2, 556, sha256_hex(b"photo")))
+            batch.add_reaction(ReactionData(1, 123, "MyCoolChannel", "👍", 7))
+            batch.add_reaction(ReactionData(1, 123, "MyCoolChannel", "👍", 7))
+            batch.checkpoint(3)
+            assert not batch.is_due()
+
+        async with db.db_cursor() as cursor:
+            await cursor.execute("SELECT COUNT(*) FROM messages")
+            assert (await cursor.fetchone())[0] == 3
+            await cursor.execute("SELECT COUNT(*) FROM images")
+            assert (await cursor.fetchone())[0] == 2
+            await cursor.execute("SELECT COUNT(*) FROM reactions")
+            assert (await cursor.fetchone())[0] == 1
+        assert (await db.get_scrape_state(123)).last_processed_message_id == 3
+        assert len(batch) == 0
+
+
+@pytest.mark.asyncio
+async def test_batch_is_due_by_count_and_time(tmp_path):
+    async with Database(str(tmp_path / "test.db")) as db:
+        batch = MessageBatch(db, 123, "MyCoolChannel", max_size=2, flush_interval=3600)
+        assert not batch.is_due()
+        batch.add_message(make_message_data(1))
+        assert not batch.is_due()
+        batch.add_message(make_message_data(2))
+        assert batch.is_due()
+
+        batch = MessageBatch(db, 123, "MyCoolChannel", max_size=100, flush_interval=0)
+        batch.add_message(make_message_data(1))
+        assert batch.is_due()
+
+
+@pytest.mark.asyncio
+async def test_batch_writes_message_entities(tmp_path):
+    async with Database(str(tmp_path / "test.db")) as db:
+        await db.create_schema()
+        async with MessageBatch(db, 123, "MyCoolChannel") as batch:
+            batch.add_message(make_message_data(1))
+            batch.add_entity(MessageEntityData(1, 123, "url", "leaks.example.org/x", "leaks.example.org"))
+            batch.add_entity(MessageEntityData(1, 123, "mention", "@cooladmin", None))
+
+        async with db.db_cursor() as cursor:
+            await cursor.execute(
+                "SELECT DISTINCT channel_id FROM message_entities WHERE domain = ?", ("leaks.example.org",)
+            )
+            assert await cursor.fetchall() == [(123,)]
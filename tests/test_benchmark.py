@@ -0,0 +1,20 @@
+from dataclasses import replace
+
+import pytest
+
+from benchmarks.run import SCENARIOS, run_benchmark
+
+
+@pytest.mark.asyncio
+async def test_benchmark_scrapes_synthetic_channels(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config = replace(SCENARIOS["small"], messages_per_channel=150, flood_wait_every=7)
+
+    metrics = await run_benchmark(config, str(tmp_path))
+
+    assert metrics["messages"] == 300
+    assert metrics["flood_waits"] > 0
+    # 1 in 5 messages has a photo, 1 in 50 a document instead.
+    assert metrics["download_jobs"] == {"done": 60}
+    assert metrics["bytes_downloaded"] > 0
+    assert metrics["db_commits"] > 0
@@ -0,0 +1,86 @@
+import os
+
+import pytest
+
+from src.blobstore import STORAGE_FILE, STORAGE_INLINE, BlobStore
+from src.db import Database
+from src.utils import sha256_hex
+
+
+def test_small_blob_stays_inline(tmp_path):
+    blob_store = BlobStore(str(tmp_path / "blobs"), inline_max_bytes=4)
+    row = blob_store.store_bytes(sha256_hex(b"tiny"), b"tiny")
+    assert row.storage == STORAGE_INLINE
+    assert row.data == b"tiny"
+    assert not os.path.exists(tmp_path / "blobs")
+
+
+def test_large_blob_goes_to_sharded_directory(tmp_path):
+    blob_store = BlobStore(str(tmp_path / "blobs"), inline_max_bytes=4)
+    source_path = tmp_path / "leak.zip"
+    source_path.write_bytes(b"large enough")
+    blob_sha256 = sha256_hex(b"large enough")
+
+    row = blob_store.store_file(blob_sha256, str(source_path))
+
+    assert row.storage == STORAGE_FILE
+    assert row.data is None
+    assert row.size == 12
+    # Relative to the store root, not to the working directory.
+    assert row.path == os.path.join(blob_sha256[:2], blob_sha256[2:4], blob_sha256)
+    assert (tmp_path / "blobs" / row.path).exists()
+    # Moved into the store, so nothing else writes to the stored file.
+    assert not source_path.exists()
+    with blob_store.open(row.storage, row.data, row.path) as blob:
+        assert blob.read() == b"large enough"
+
+
+def test_download_of_a_stored_blob_is_removed(tmp_path):
+    blob_store = BlobStore(str(tmp_path / "blobs"), inline_max_bytes=4)
+    blob_sha256 = sha256_hex(b"large enough")
+    for name in ("first.zip", "second.zip"):
+        (tmp_path / name).write_bytes(b"large enough")
+        blob_store.store_file(blob_sha256, str(tmp_path / name))
+
+    assert not (tmp_path / "first.zip").exists()
+    assert not (tmp_path / "second.zip").exists()
+
+
+@pytest.mark.asyncio
+async def test_open_blob_reads_inline_and_file_blobs(tmp_path):
+    blob_store = BlobStore(str(tmp_path / "blobs"), inline_max_bytes=4)
+    source_path = tmp_path / "leak.zip"
+    source_path.write_bytes(b"large enough")
+
+    async with Database(str(tmp_path / "test.db"), blob_store) as db:
+        await db.create_schema()
+        await db.insert_document_blob(1, 123, "MyCoolChannel", "a.txt", "txt", b"tiny")
+        await db.insert_document_file(
+            2, 123, "MyCoolChannel", "leak.zip", "zip", str(source_path), sha256_hex(b"large enough")
+        )
+
+        assert await db.get_blob(sha256_hex(b"tiny")) == b"tiny"
+        with await db.open_blob(sha256_hex(b"large enough")) as blob:
+            assert blob[:5] == b"large"
+        async with db.db_cursor() as cursor:
+            await cursor.execute("SELECT COUNT(*) FROM blobs WHERE data IS NULL AND path IS NOT NULL")
+            assert (await cursor.fetchone())[0] == 1
+
+
+@pytest.mark.asyncio
+async def test_inline_blobs_above_the_cutoff_move_to_the_filesystem(tmp_path):
+    async with Database(str(tmp_path / "test.db"), BlobStore(str(tmp_path / "blobs"))) as db:
+        await db.create_schema()
+        await db.insert_document_blob(1, 123, "MyCoolChannel", "a.txt", "txt", b"tiny")
+        await db.insert_document_blob(2, 123, "MyCoolChannel", "leak.zip", "zip", b"large enough")
+
+    async with Database(str(tmp_path / "test.db"), BlobStore(str(tmp_path / "blobs"), 4)) as db:
+        await db.create_schema()
+
+        async with db.db_cursor() as cursor:
+            await cursor.execute("SELECT sha256, storage FROM blobs ORDER BY size")
+            assert await cursor.fetchall() == [
+                (sha256_hex(b"tiny"), STORAGE_INLINE), (sha256_hex(b"large enough"), STORAGE_FILE),
+            ]
+        assert await db.get_blob(sha256_hex(b"large enough")) == b"large enough"
+        assert await db.offload_inline_blobs() == 0
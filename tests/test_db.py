@@ -0,0 +1,268 @@
+import aiosqlite
+import pytest
+
+from src.batch import ImageData
+from src.blobstore import BlobStore
+from src.db import Database
+from src.migrations import SCHEMA_VERSION
+from src.utils import sha256_hex
+
+
+async def get_user_version(db: Database) -> int:
+    async with db.db_cursor() as cursor:
+        await cursor.execute("PRAGMA user_version")
+        return (await cursor.fetchone())[0]
+
+
+@pytest.mark.asyncio
+async def test_new_database_starts_at_latest_schema_version(tmp_path):
+    async with Database(str(tmp_path / "test.db")) as db:
+        await db.create_schema()
+        assert await get_user_version(db) == SCHEMA_VERSION
+        state = await db.get_scrape_state(123)
+        assert state.last_processed_message_id == 0
+
+
+@pytest.mark.asyncio
+async def test_migration_fills_scrape_state_from_messages(tmp_path):
+    db_name = str(tmp_path / "test.db")
+    async with aiosqlite.connect(db_name) as connection:
+        await connection.execute(
+            "CREATE TABLE messages (id INTEGER PRIMARY KEY, message_id INTEGER, channel_id INTEGER, "
+            "channel_name TEXT, message_date TIMESTAMPTZ(0), message_text TEXT, url_in_message TEXT, "
+            "message_fwd_from_channel_id INTEGER, message_fwd_from_channel_username TEXT, "
+            "last_processed_message_id INTEGER DEFAULT 0, UNIQUE (message_id, channel_id))"
+        )
+        await connection.executemany(
+            "INSERT INTO messages (message_id, channel_id, channel_name) VALUES (?, ?, ?)",
+            [(1, 123, "first"), (7, 123, "first"), (3, 456, "second")],
+        )
+        await connection.commit()
+
+    async with Database(db_name) as db:
+        await db.create_schema()
+        assert (await db.get_scrape_state(123)).last_processed_message_id == 7
+        assert (await db.get_scrape_state(456)).channel_name == "second"
+        assert await get_user_version(db) == SCHEMA_VERSION
+
+
+@pytest.mark.asyncio
+async def test_checkpoint_never_moves_backwards(tmp_path):
+    async with Database(str(tmp_path / "test.db")) as db:
+        await db.create_schema()
+        await db.update_last_processed_message_id(123, "first", 10)
+        await db.update_last_processed_message_id(123, "first", 4)
+        await db.update_last_document_id(123, "first", 9)
+        state = await db.get_scrape_state(123)
+        assert state.last_processed_message_id == 10
+        assert state.last_document_id == 9
+
+
+@pytest.mark.asyncio
+async def test_migration_moves_media_bytes_into_blobs(tmp_path):
+    db_name = str(tmp_path / "test.db")
+    async with aiosqlite.connect(db_name) as connection:
+        await connection.executescript(
+            """
+            CREATE TABLE messages (id INTEGER PRIMARY KEY, message_id INTEGER, channel_id INTEGER,
+                channel_name TEXT, message_date TIMESTAMPTZ(0), message_text TEXT, url_in_message TEXT,
+                message_fwd_from_channel_id INTEGER, message_fwd_from_channel_username TEXT,
+                last_processed_message_id INTEGER DEFAULT 0);
+            CREATE TABLE images (id INTEGER PRIMARY KEY, channel_id INTEGER, channel_name TEXT,
+                message_id INTEGER, photo_id INTEGER, image_data BLOB);
+            CREATE TABLE documents (id INTEGER PRIMARY KEY, message_id INTEGER, channel_id INTEGER,
+                channel_name TEXT, mime_type TEXT, file_name TEXT, file_blob BLOB);
+            INSERT INTO images (message_id, photo_id, image_data)
+                VALUES (1, 10, x'0102'), (1, 10, x'0102'), (2, 20, x'0102');
+            INSERT INTO documents (message_id, file_blob) VALUES (3, x'0102');
+            """
+        )
+        await connection.commit()
+
+    async with Database(db_name) as db:
+        await db.create_schema()
+        async with db.db_cursor() as cursor:
+            await cursor.execute("SELECT COUNT(*), MIN(sha256) FROM blobs")
+            count, blob_sha256 = await cursor.fetchone()
+            await cursor.execute(
+                "SELECT COUNT(*) FROM images WHERE image_data IS NULL AND blob_sha256 = ?",
+                (blob_sha256,),
+            )
+            assert (await cursor.fetchone())[0] == 2
+            await cursor.execute("SELECT blob_sha256 FROM documents")
+            assert (await cursor.fetchone())[0] == blob_sha256
+        assert count == 1
+        assert await db.get_blob(blob_sha256) == b"\x01\x02"
+
+
+async def iter_chunks(data: bytes, chunk_size: int):
+    for offset in range(0, len(data), chunk_size):
+        yield data[offset:offset + chunk_size]
+
+
+@pytest.mark.asyncio
+async def test_document_is_streamed_into_blob(tmp_path):
+    data = bytes(range(256)) * 40
+    async with Database(str(tmp_path / "test.db")) as db:
+        await db.create_schema()
+        blob_sha256 = await db.insert_document_stream(
+            1, 123, "MyCoolChannel", "leak.txt", "txt", len(data), iter_chunks(data, 1000)
+        )
+        # the same content from another message reuses the blob
+        assert await db.insert_document_stream(
+            2, 123, "MyCoolChannel", "copy.txt", "txt", len(data), iter_chunks(data, 4096)
+        ) == blob_sha256
+
+        assert blob_sha256 == sha256_hex(data)
+        assert await db.get_blob(blob_sha256) == data
+        assert await db.is_document_in_db(2, 123)
+        async with db.db_cursor() as cursor:
+            await cursor.execute("SELECT COUNT(*) FROM blobs")
+            assert (await cursor.fetchone())[0] == 1
+
+
+@pytest.mark.asyncio
+async def test_truncated_stream_leaves_no_blob(tmp_path):
+    async with Database(str(tmp_path / "test.db")) as db:
+        await db.create_schema()
+        with pytest.raises(ValueError):
+            await db.insert_document_stream(
+                1, 123, "MyCoolChannel", "leak.txt", "txt", 100, iter_chunks(b"short", 2)
+            )
+        assert not await db.is_document_in_db(1, 123)
+        async with db.db_cursor() as cursor:
+            await cursor.execute("SELECT COUNT(*) FROM blobs")
+            assert (await cursor.fetchone())[0] == 0
+
+
+@pytest.mark.asyncio
+async def test_blob_of_an_interrupted_stream_is_deleted_at_start(tmp_path):
+    async with Database(str(tmp_path / "test.db")) as db:
+        await db.create_schema()
+        async with db.db_cursor() as cursor:
+            # What a process killed mid-download leaves behind.
+            await cursor.execute(
+                "INSERT INTO blobs (sha256, size, data) VALUES ('pending:0123', 100, zeroblob(100))"
+            )
+        await db.insert_document_blob(1, 123, "MyCoolChannel", "a.txt", "txt", b"tiny")
+
+    async with Database(str(tmp_path / "test.db")) as db:
+        await db.create_schema()
+        async with db.db_cursor() as cursor:
+            await cursor.execute("SELECT sha256 FROM blobs")
+            assert await cursor.fetchall() == [(sha256_hex(b"tiny"),)]
+
+
+@pytest.mark.asyncio
+async def test_known_photo_is_saved_without_its_bytes(tmp_path):
+    async with Database(str(tmp_path / "test.db")) as db:
+        await db.create_schema()
+        data = b"photo"
+        await db.save_image_blob(123, "first", 1, 42, data)
+        known_photos = await db.get_known_photos(123)
+        assert known_photos == {42: sha256_hex(data)}
+
+        image = ImageData(123, "first", 2, 42, known_photos[42])
+        await db.save_messages_batch([], [image], [], 123, "first")
+
+        assert await db.is_image_in_db(2, 42)
+        assert await db.get_blob(known_photos[42]) == data
+
+
+@pytest.mark.asyncio
+async def test_connection_uses_wal_and_indexed_lookups(tmp_path):
+    async with Database(str(tmp_path / "test.db")) as db:
+        await db.create_schema()
+        async with db.db_cursor() as cursor:
+            await cursor.execute("PRAGMA journal_mode")
+            assert (await cursor.fetchone())[0] == "wal"
+            await cursor.execute(
+                "EXPLAIN QUERY PLAN SELECT 1 FROM documents WHERE message_id = ? AND channel_id = ?",
+                (1, 123),
+            )
+            assert "idx_documents_message" in str(await cursor.fetchall())
+
+        # readers on another connection are not blocked by the scraper
+        async with aiosqlite.connect(str(tmp_path / "test.db")) as reader:
+            async with db.db_cursor() as cursor:
+                await cursor.execute("INSERT INTO download_jobs (kind) VALUES ('photo')")
+                result = await reader.execute("SELECT COUNT(*) FROM download_jobs")
+                assert (await result.fetchone())[0] == 0
+
+
+@pytest.mark.asyncio
+async def test_reaction_counts_are_upserted_and_snapshotted(tmp_path):
+    async with Database(str(tmp_path / "test.db"), reaction_snapshots=True) as db:
+        await db.create_schema()
+        await db.save_reactions([(1, 123, "first", "👍", 7), (1, 123, "first", "🔥", 2)])
+        await db.save_reactions([(1, 123, "first", "👍", 9)])
+
+        async with db.db_cursor() as cursor:
+            await cursor.execute("SELECT emoticon, emoticon_count FROM reactions ORDER BY emoticon")
+            assert await cursor.fetchall() == [("👍", 9), ("🔥", 2)]
+            await cursor.execute(
+                "SELECT emoticon_count FROM reaction_snapshots WHERE emoticon = '👍' ORDER BY id"
+            )
+            assert await cursor.fetchall() == [(7,), (9,)]
+
+
+@pytest.mark.asyncio
+async def test_migration_makes_blob_paths_relative_to_the_store(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    blob_store = BlobStore("blobs", inline_max_bytes=4)
+    blob_sha256 = sha256_hex(b"large enough")
+    blob_store.store_bytes(blob_sha256, b"large enough")
+    db_name = str(tmp_path / "test.db")
+    async with Database(db_name, blob_store) as db:
+        await db.create_schema()
+        async with db.db_cursor() as cursor:
+            # Stored relative to the working directory before migration 11.
+            await cursor.execute(
+                "INSERT INTO blobs (sha256, size, storage, path) VALUES (?, 12, 'file', ?)",
+                (blob_sha256, blob_store.large_backend.path_for(blob_sha256)),
+            )
+            await cursor.execute("PRAGMA user_version = 10")
+
+    async with Database(db_name, blob_store) as db:
+        await db.create_schema()
+        assert await db.get_blob(blob_sha256) == b"large enough"
+
+
+@pytest.mark.asyncio
+async def test_photo_of_a_message_stored_twice_has_one_row(tmp_path):
+    async with Database(str(tmp_path / "test.db")) as db:
+        await db.create_schema()
+        await db.save_image_blob(123, "first", 1, 42, b"photo")
+        # A live event and the next gap fill store the same message.
+        for _ in range(2):
+            await db.save_messages_batch([], [ImageData(123, "first", 2, 42, sha256_hex(b"photo"))], [], 123, "first")
+
+        async with db.db_cursor() as cursor:
+            await cursor.execute("SELECT message_id FROM images ORDER BY message_id")
+            assert await cursor.fetchall() == [(1,), (2,)]
+
+
+@pytest.mark.asyncio
+async def test_migration_removes_duplicate_reactions(tmp_path):
+    db_name = str(tmp_path / "test.db")
+    async with aiosqlite.connect(db_name) as connection:
+        await connection.executescript(
+            """
+            CREATE TABLE messages (id INTEGER PRIMARY KEY, message_id INTEGER, channel_id INTEGER,
+                channel_name TEXT, message_date TIMESTAMPTZ(0), message_text TEXT, url_in_message TEXT,
+                message_fwd_from_channel_id INTEGER, message_fwd_from_channel_username TEXT,
+                last_processed_message_id INTEGER DEFAULT 0);
+            CREATE TABLE reactions (id INTEGER PRIMARY KEY, message_id INTEGER, channel_id INTEGER,
+                channel_name TEXT, emoticon TEXT, emoticon_count INTEGER);
+            INSERT INTO reactions (message_id, channel_id, emoticon, emoticon_count)
+                VALUES (1, 123, '👍', 7), (1, 123, '👍', 8), (2, 123, '👍', 1);
+            """
+        )
+        await connection.commit()
+
+    async with Database(db_name) as db:
+        await db.create_schema()
+        await db.save_reactions([(2, 123, "first", "👍", 3)])
+        async with db.db_cursor() as cursor:
+            await cursor.execute("SELECT message_id, emoticon_count FROM reactions ORDER BY message_id")
+            assert await cursor.fetchall() == [(1, 8), (2, 3)]
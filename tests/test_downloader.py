@@ -0,0 +1,83 @@
+import os
+
+import pytest
+
+from src.downloader import (MAX_PART_SIZE, START_PART_SIZE,
+                            ParallelDownloader, Segment, is_segment_done,
+                            new_range_bitmap, set_segment_done,
+                            split_into_segments)
+
+
+class FakeClient:
+    def __init__(self, data: bytes, fail_at=None):
+        self.data = data
+        self.fail_at = fail_at
+        self.requests = []
+
+    async def iter_download(self, media, offset=0, limit=None, request_size=None, file_size=None):
+        assert offset % request_size == 0
+        for _ in range(limit):
+            if offset >= len(self.data):
+                return
+            self.requests.append((offset, request_size))
+            if offset == self.fail_at:
+                self.fail_at = None
+                raise ConnectionError
+            yield self.data[offset:offset + request_size]
+            offset += request_size
+
+
+def test_range_bitmap():
+    range_bitmap = new_range_bitmap(10)
+    assert len(range_bitmap) == 2
+    set_segment_done(range_bitmap, 9)
+    assert is_segment_done(range_bitmap, 9)
+    assert not is_segment_done(range_bitmap, 8)
+
+
+def test_split_into_segments():
+    assert split_into_segments(25, 10) == [
+        Segment(0, 0, 10),
+        Segment(1, 10, 20),
+        Segment(2, 20, 25),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_parallel_download_writes_every_segment(tmp_path):
+    data = os.urandom(5 * 1024 * 1024 + 123)
+    client = FakeClient(data, fail_at=2 * 1024 * 1024)
+    done = []
+
+    async def on_segment_done(segment):
+        done.append(segment)
+
+    downloader = ParallelDownloader(
+        client, connections=3, segment_size=1024 * 1024, on_segment_done=on_segment_done
+    )
+    file_path = str(tmp_path / "leak.zip")
+
+    await downloader.download("media", len(data), file_path)
+
+    with open(file_path, "rb") as file:
+        assert file.read() == data
+    assert sorted(segment.index for segment in done) == list(range(6))
+    assert START_PART_SIZE < downloader.part_size <= MAX_PART_SIZE
+
+
+@pytest.mark.asyncio
+async def test_only_missing_segments_are_downloaded(tmp_path):
+    data = os.urandom(3 * 1024)
+    client = FakeClient(data)
+    downloader = ParallelDownloader(client, segment_size=1024)
+    file_path = str(tmp_path / "leak.zip")
+    with open(file_path, "wb") as file:
+        file.write(data[:2048] + bytes(1024))
+
+    await downloader.download(
+        "media", len(data), file_path, segments=[Segment(2, 2048, 3072)]
+    )
+
+    with open(file_path, "rb") as file:
+        assert file.read() == data
+    assert all(offset >= 2048 for offset, _ in client.requests)
@@ -0,0 +1,83 @@
+import datetime
+from unittest.mock import AsyncMock
+
+import pytest
+from telethon.errors import ChannelPrivateError
+from telethon.tl.types import Channel, ChatPhotoEmpty, PeerChannel
+
+from src.db import Database
+from src.entity_cache import EntityCache, get_cache_key
+
+
+def make_channel(channel_id: int, username: str) -> Channel:
+    return Channel(
+        id=channel_id,
+        title="TestChannel",
+        photo=ChatPhotoEmpty(),
+        date=datetime.datetime(1999, 10, 3, 1, 7, 56, tzinfo=datetime.timezone.utc),
+        access_hash=-123,
+        username=username,
+    )
+
+
+@pytest.mark.parametrize(
+    "peer, expected",
+    [
+        (123, "id:123"),
+        (PeerChannel(channel_id=123), "id:123"),
+        ("https://t.me/TestChannel", "username:testchannel"),
+        ("@TestChannel", "username:testchannel"),
+        ("https://t.me/+invite_hash", None),
+    ],
+)
+def test_get_cache_key(peer, expected):
+    assert get_cache_key(peer) == expected
+
+
+@pytest.mark.asyncio
+async def test_entity_is_cached_by_id_and_username():
+    get_entity = AsyncMock(return_value=make_channel(123, "TestChannel"))
+    cache = EntityCache()
+
+    assert (await cache.get_entity(get_entity, "https://t.me/TestChannel")).id == 123
+    assert (await cache.get_entity(get_entity, 123)).username == "TestChannel"
+    assert (await cache.get_entity(get_entity, PeerChannel(channel_id=123))).id == 123
+    assert get_entity.await_count == 1
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["misses"] == 1
+
+
+@pytest.mark.asyncio
+async def test_negative_result_is_cached():
+    get_entity = AsyncMock(side_effect=ChannelPrivateError(request=None))
+    cache = EntityCache()
+
+    for _ in range(2):
+        with pytest.raises(ChannelPrivateError):
+            await cache.get_entity(get_entity, 456)
+    assert get_entity.await_count == 1
+
+
+@pytest.mark.asyncio
+async def test_expired_entry_is_resolved_again():
+    get_entity = AsyncMock(return_value=make_channel(123, "TestChannel"))
+    cache = EntityCache(ttl=0)
+
+    await cache.get_entity(get_entity, 123)
+    await cache.get_entity(get_entity, 123)
+    assert get_entity.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_entity_survives_restart_in_database(tmp_path):
+    get_entity = AsyncMock(return_value=make_channel(123, "TestChannel"))
+    async with Database(str(tmp_path / "test.db")) as db:
+        await db.create_schema()
+        await EntityCache(db).get_entity(get_entity, 123)
+
+        cache = EntityCache(db)
+        entity = await cache.get_entity(get_entity, "TestChannel")
+        assert entity.id == 123
+        assert entity.access_hash == -123
+        assert get_entity.await_count == 1
+        assert cache.stats()["persistent_hits"] == 1
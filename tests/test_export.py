@@ -0,0 +1,114 @@
+import datetime
+import os
+import time
+
+import pytest
+
+from src import export
+from src.batch import ReactionData
+from src.db import Database
+from src.export import export_parquet, month_bounds
+from src.message import MessageData
+
+
+def make_message_data(message_id: int, channel_id: int, month: int) -> MessageData:
+    return MessageData(
+        message_id=message_id,
+        channel_id=channel_id,
+        channel_name="channel%s" % channel_id,
+        message_date=datetime.datetime(2023, month, 15, 12, 0, 0, tzinfo=datetime.timezone.utc),
+        message_text="message %s" % message_id,
+        message_views=10,
+    )
+
+
+def test_month_bounds():
+    assert month_bounds("2023-05") == ("2023-05", "2023-06")
+    assert month_bounds("2023-12") == ("2023-12", "2024-01")
+
+
+@pytest.mark.asyncio
+async def test_export_needs_pyarrow(tmp_path, monkeypatch):
+    monkeypatch.setattr(export, "pa", None)
+    async with Database(str(tmp_path / "test.db")) as db:
+        await db.create_schema()
+        with pytest.raises(RuntimeError, match="pyarrow"):
+            await export_parquet(db, str(tmp_path / "export"))
+
+
+@pytest.mark.asyncio
+async def test_export_writes_changed_partitions_only(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    destination = str(tmp_path / "export")
+    async with Database(str(tmp_path / "test.db")) as db:
+        await db.create_schema()
+        await db.save_messages_batch(
+            [make_message_data(1, 123, 4), make_message_data(2, 123, 5), make_message_data(3, 123, 5)],
+            [],
+            [ReactionData(2, 123, "channel123", "👍", 7)],
+            123,
+            "channel123",
+        )
+        await db.save_messages_batch([make_message_data(1, 456, 5)], [], [], 456, "channel456")
+
+        stats = await export_parquet(db, destination, ["messages", "reactions"])
+        assert [(s.table, s.partitions, s.written, s.rows) for s in stats] == [
+            ("messages", 3, 3, 4), ("reactions", 1, 1, 1)
+        ]
+        may = pq.read_table(os.path.join(destination, "messages", "channel=123", "month=2023-05"))
+        assert may.column("message_id").to_pylist() == [2, 3]
+        assert may.column("message_date").to_pylist()[0] == datetime.datetime(
+            2023, 5, 15, 12, 0, 0, tzinfo=datetime.timezone.utc
+        )
+        reactions = pq.read_table(os.path.join(destination, "reactions", "channel=123", "month=2023-05"))
+        assert reactions.column("emoticon_count").to_pylist() == [7]
+
+        stats = await export_parquet(db, destination, ["messages"])
+        assert stats[0].written == 0
+
+        await db.save_refreshed_messages(123, "MyCoolChannel", [(1, {"message_views": 99})], [1], time.time(), [])
+        stats = await export_parquet(db, destination, ["messages"])
+        assert (stats[0].written, stats[0].rows) == (1, 1)
+        april = pq.read_table(os.path.join(destination, "messages", "channel=123", "month=2023-04"))
+        assert april.column("message_views").to_pylist() == [99]
+
+        stats = await export_parquet(db, destination, ["messages"], full=True)
+        assert stats[0].written == 3
+
+
+@pytest.mark.asyncio
+async def test_export_rewrites_partitions_whose_changes_net_to_zero(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    destination = str(tmp_path / "export")
+    async with Database(str(tmp_path / "test.db")) as db:
+        await db.create_schema()
+        await db.save_messages_batch(
+            [make_message_data(1, 123, 5)],
+            [],
+            [ReactionData(1, 123, "channel123", "👍", 7), ReactionData(1, 123, "channel123", "❤", 3)],
+            123,
+            "channel123",
+        )
+        async with db.db_cursor() as cursor:
+            await cursor.execute(
+                "INSERT INTO channels (channel_id, channel_name, channel_title, user_count, date) "
+                "VALUES (123, 'channel123', 'Old title', 10, '2023-01-01 00:00:00')"
+            )
+        await export_parquet(db, destination, ["reactions", "channels"])
+
+        # Same count and same total, only the content differs.
+        await db.save_messages_batch(
+            [],
+            [],
+            [ReactionData(1, 123, "channel123", "👍", 8), ReactionData(1, 123, "channel123", "❤", 2)],
+            123,
+            "channel123",
+        )
+        async with db.db_cursor() as cursor:
+            await cursor.execute("UPDATE channels SET channel_title = 'New title' WHERE channel_id = 123")
+        stats = await export_parquet(db, destination, ["reactions", "channels"])
+        assert [s.written for s in stats] == [1, 1]
+        reactions = pq.read_table(os.path.join(destination, "reactions", "channel=123", "month=2023-05"))
+        assert sorted(reactions.column("emoticon_count").to_pylist()) == [2, 8]
+        channels = pq.read_table(os.path.join(destination, "channels"))
+        assert channels.column("channel_title").to_pylist() == ["New title"]
@@ -0,0 +1,104 @@
+import datetime
+import io
+
+import aiosqlite
+import pytest
+
+from src.db import Database, ForwardEdge
+from src.graph import pagerank, rank_channels, write_edges_csv
+from src.message import MessageData
+
+
+def make_forward(message_id: int, channel_id: int, source_id: int, day: int) -> MessageData:
+    return MessageData(
+        message_id=message_id,
+        channel_id=channel_id,
+        channel_name="channel%s" % channel_id,
+        message_date=datetime.datetime(2023, 5, day, tzinfo=datetime.timezone.utc),
+        message_fwd_from=bool(source_id),
+        message_fwd_from_channel_id=source_id,
+        message_fwd_from_channel_username="channel%s" % source_id if source_id else None,
+    )
+
+
+def make_edge(source_id: int, target_id: int, forwards: int) -> ForwardEdge:
+    return ForwardEdge(
+        source_id, "channel%s" % source_id, target_id, "channel%s" % target_id, forwards, None, None
+    )
+
+
+@pytest.mark.asyncio
+async def test_forward_edges_are_counted_on_insert(tmp_path):
+    async with Database(str(tmp_path / "test.db")) as db:
+        await db.create_schema()
+        messages = [
+            make_forward(1, 2, 1, 3),
+            make_forward(2, 2, 1, 1),
+            make_forward(3, 2, 1, 5),
+            make_forward(4, 2, 2, 5),  # forward from itself
+            make_forward(5, 2, None, 5),
+            make_forward(1, 3, 1, 2),
+        ]
+        await db.save_messages_batch(messages, [], [], 2, "channel2")
+        # Messages seen again are ignored and not counted twice.
+        await db.save_messages_batch(messages[:1], [], [], 2, "channel2")
+
+        edges = await db.get_forward_edges()
+        assert [(e.source_channel_id, e.target_channel_id, e.forwards) for e in edges] == [
+            (1, 2, 3), (1, 3, 1)
+        ]
+        assert edges[0].source_channel_username == "channel1"
+        assert edges[0].first_seen.startswith("2023-05-01")
+        assert edges[0].last_seen.startswith("2023-05-05")
+
+
+@pytest.mark.asyncio
+async def test_migration_counts_existing_forwards(tmp_path):
+    db_name = str(tmp_path / "test.db")
+    async with aiosqlite.connect(db_name) as connection:
+        await connection.executescript(
+            """
+            CREATE TABLE messages (id INTEGER PRIMARY KEY, message_id INTEGER, channel_id INTEGER,
+                channel_name TEXT, message_date TIMESTAMPTZ(0), message_text TEXT, url_in_message TEXT,
+                message_fwd_from_channel_id INTEGER, message_fwd_from_channel_username TEXT,
+                last_processed_message_id INTEGER DEFAULT 0, UNIQUE (message_id, channel_id));
+            INSERT INTO messages (message_id, channel_id, channel_name, message_fwd_from_channel_id)
+                VALUES (1, 2, 'channel2', 1), (2, 2, 'channel2', 1), (3, 2, 'channel2', 0),
+                       (1, 3, 'channel3', 2);
+            """
+        )
+        await connection.commit()
+
+    async with Database(db_name) as db:
+        await db.create_schema()
+        edges = await db.get_forward_edges()
+        assert [(e.source_channel_id, e.target_channel_id, e.forwards) for e in edges] == [
+            (1, 2, 2), (2, 3, 1)
+        ]
+
+
+def test_pagerank_favours_amplified_channels():
+    # 2, 3 and 4 forward from 1, and 4 also from 2.
+    edges = [make_edge(1, 2, 5), make_edge(1, 3, 1), make_edge(1, 4, 1), make_edge(2, 4, 3)]
+
+    ranks = pagerank(edges)
+
+    assert sum(ranks.values()) == pytest.approx(1)
+    assert ranks[1] > ranks[2] > ranks[3] == pytest.approx(ranks[4])
+    assert pagerank([]) == {}
+
+
+def test_rank_channels_and_export():
+    edges = [make_edge(1, 2, 5), make_edge(1, 3, 1), make_edge(2, 3, 2)]
+
+    ranks = rank_channels(edges)
+
+    assert [(r.channel_id, r.channel_name, r.forwarded_by, r.forwards) for r in ranks] == [
+        (1, "channel1", 2, 6), (2, "channel2", 1, 2), (3, "channel3", 0, 0)
+    ]
+
+    output = io.StringIO()
+    write_edges_csv(edges, output)
+    lines = output.getvalue().splitlines()
+    assert lines[0].startswith("source_channel_id,source_channel_username,target_channel_id")
+    assert lines[1] == "1,channel1,2,channel2,5,,"
@@ -0,0 +1,99 @@
+import pytest
+from telethon.tl.types import Message, MessageMediaUnsupported, PeerChannel
+
+from src.db import Database
+from src.jobs import (JOB_DOCUMENT, JOB_LARGE_FILE, JOB_PHOTO,
+                      DownloadWorkerPool, new_download_job)
+
+
+class FakeMessagesClient:
+    def __init__(self):
+        self.requests = []
+
+    async def get_messages(self, channel, ids):
+        self.requests.append((channel, ids))
+        return [
+            Message(id=message_id, peer_id=PeerChannel(channel_id=123), media=MessageMediaUnsupported())
+            for message_id in ids
+        ]
+
+
+@pytest.mark.asyncio
+async def test_jobs_are_claimed_by_priority_within_one_channel(tmp_path):
+    async with Database(str(tmp_path / "test.db")) as db:
+        await db.create_schema()
+        await db.enqueue_download_jobs(
+            [
+                new_download_job(JOB_DOCUMENT, 123, "first", 1),
+                new_download_job(JOB_PHOTO, 123, "first", 3),
+                new_download_job(JOB_PHOTO, 456, "second", 2),
+                new_download_job(JOB_PHOTO, 123, "first", 3),
+            ]
+        )
+
+        jobs = await db.claim_download_jobs(10)
+
+        assert [(job.channel_id, job.message_id) for job in jobs] == [(123, 3), (123, 1)]
+        assert await db.count_download_jobs() == {"pending": 1, "running": 2}
+
+
+@pytest.mark.asyncio
+async def test_worker_pool_drains_queue_and_retries_failed_jobs(tmp_path):
+    async with Database(str(tmp_path / "test.db")) as db:
+        await db.create_schema()
+        await db.enqueue_download_jobs(
+            [new_download_job(JOB_PHOTO, 123, "first", message_id) for message_id in (1, 2, 3)]
+        )
+        handled = []
+
+        async def handle_job(job, message):
+            handled.append(message.id)
+            if message.id == 2:
+                raise ConnectionError("connection lost")
+
+        client = FakeMessagesClient()
+        pool = DownloadWorkerPool(client, db, handle_job, concurrency=2, max_attempts=2, poll_interval=0)
+        pool.close()
+        await pool.run()
+
+        assert sorted(handled) == [1, 2, 2, 3]
+        assert client.requests[0] == ("first", [1, 2, 3])
+        assert (pool.completed, pool.failed) == (2, 1)
+        assert await db.count_download_jobs() == {"done": 2, "failed": 1}
+
+
+@pytest.mark.asyncio
+async def test_interrupted_jobs_are_requeued(tmp_path):
+    async with Database(str(tmp_path / "test.db")) as db:
+        await db.create_schema()
+        await db.enqueue_download_jobs([new_download_job(JOB_PHOTO, 123, "first", 1)])
+        await db.claim_download_jobs(10)
+
+        await db.requeue_running_download_jobs()
+
+        assert [job.message_id for job in await db.claim_download_jobs(10)] == [1]
+
+
+@pytest.mark.asyncio
+async def test_pending_large_files_get_new_attempts_on_every_run(tmp_path):
+    async with Database(str(tmp_path / "test.db")) as db:
+        await db.create_schema()
+        for message_id in (1, 2):
+            await db.add_to_download_manifest(123, message_id, "first", "leak.zip", "leak.zip", 10, 4)
+        await db.enqueue_download_jobs([new_download_job(JOB_LARGE_FILE, 123, "first", 1)])
+        handled = []
+
+        async def handle_job(job, message):
+            handled.append(message.id)
+            raise ConnectionError("connection lost")
+
+        for _ in range(2):
+            pool = DownloadWorkerPool(
+                FakeMessagesClient(), db, handle_job, kinds=(JOB_LARGE_FILE,), max_attempts=1, poll_interval=0
+            )
+            pool.close()
+            await pool.run()
+
+        # The job of message 2 was lost, both failed on every run.
+        assert sorted(handled) == [1, 1, 2, 2]
+        assert await db.count_download_jobs() == {"failed": 2}
@@ -0,0 +1,64 @@
+import asyncio
+import datetime
+from types import SimpleNamespace
+
+import pytest
+from telethon.tl.types import Message, PeerChannel
+from telethon.utils import get_peer_id
+
+from src.batch import MessageBatch
+from src.channel import ScrapeContext
+from src.db import Database
+from src.live import LiveScraper
+
+
+def make_event(message_id: int, text: str) -> SimpleNamespace:
+    message = Message(
+        id=message_id,
+        peer_id=PeerChannel(channel_id=123),
+        date=datetime.datetime(1999, 5, 1, 22, 26, 29, tzinfo=datetime.timezone.utc),
+        message=text,
+    )
+    return SimpleNamespace(chat_id=get_peer_id(PeerChannel(123)), message=message)
+
+
+@pytest.mark.asyncio
+async def test_live_events_are_stored_edited_and_deleted(tmp_path):
+    async with Database(str(tmp_path / "test.db")) as db:
+        await db.create_schema()
+        scraper = LiveScraper(client=None, db=db)
+        context = ScrapeContext(channel_id=123, channel_username="MyCoolChannel", last_message_id=5)
+        scraper.contexts[123] = context
+        scraper.batches[123] = MessageBatch(db, 123, "MyCoolChannel", flush_interval=0)
+        scraper.locks[123] = asyncio.Lock()
+
+        await scraper.on_new_message(make_event(7, "first"))
+        await scraper.on_new_message(make_event(6, "second"))
+        await scraper.on_message_edited(make_event(7, "first, edited"))
+        await scraper.on_message_deleted(SimpleNamespace(chat_id=get_peer_id(PeerChannel(123)), deleted_ids=[6]))
+
+        async with db.db_cursor() as cursor:
+            await cursor.execute(
+                "SELECT message_id, message_text, deleted_at IS NOT NULL FROM messages ORDER BY message_id"
+            )
+            assert await cursor.fetchall() == [(6, "second", 1), (7, "first, edited", 0)]
+        # only the gap fill moves the checkpoint
+        assert context.last_message_id == 5
+        assert (await db.get_scrape_state(123)).last_processed_message_id == 0
+
+
+@pytest.mark.asyncio
+async def test_repeated_task_keeps_running_after_an_error():
+    scraper = LiveScraper(client=None, db=None)
+    calls = []
+
+    async def gap_fill():
+        calls.append(len(calls))
+        if len(calls) == 1:
+            raise ConnectionError("connection lost")
+        if len(calls) == 3:
+            raise asyncio.CancelledError
+
+    with pytest.raises(asyncio.CancelledError):
+        await scraper._repeat(gap_fill, 0)
+    assert calls == [0, 1, 2]
@@ -1,9 +1,11 @@
 import datetime
 
 from telethon.tl.types import Message, PeerChannel, MessageFwdHeader, MessageMediaDocument, Document, \
-    DocumentAttributeFilename, MessageEntityTextUrl
+    DocumentAttributeFilename, MessageEntityTextUrl, ReactionCustomEmoji, ReactionEmoji, MessageEntityUrl, \
+    MessageEntityMention, MessageEntityHashtag
 
-from src.message import get_telegram_link, create_message_data, get_url
+from src.message import get_telegram_link, create_message_data, get_url, get_reaction_emoticon, get_domain, \
+    get_message_entities
 
 
 def test_get_telegram_link():
@@ -67,3 +69,33 @@ def test_create_message_data():
     assert result.url_in_message == "['https://t.me/OtherCoolChannel', 'https://t.me/AtherCoolChannel']"
     assert result.message_fwd_from_channel_link == sample_tg_link
 
+
+
+def test_get_reaction_emoticon():
+    assert get_reaction_emoticon(ReactionEmoji(emoticon="👍")) == "👍"
+    assert get_reaction_emoticon(ReactionCustomEmoji(document_id=42)) == "custom:42"
+
+
+def test_get_domain():
+    assert get_domain("https://WWW.Example.com/path?q=1") == "example.com"
+    assert get_domain("t.me/OtherCoolChannel") == "t.me"
+    assert get_domain("https:///path") is None
+
+
+def test_get_message_entities():
+    text = "Leak at leaks.example.org/x by @CoolAdmin #OpIsrael here"
+    sample_message = Message(id=456, peer_id=PeerChannel(channel_id=123), message=text,
+                             entities=[MessageEntityUrl(offset=8, length=19),
+                                       MessageEntityMention(offset=31, length=10),
+                                       MessageEntityHashtag(offset=42, length=9),
+                                       MessageEntityTextUrl(offset=52, length=4, url='https://www.t.me/Leaks')])
+
+    entities = get_message_entities(sample_message, 123)
+
+    assert [(e.entity_type, e.value, e.domain) for e in entities] == [
+        ("url", "leaks.example.org/x", "leaks.example.org"),
+        ("mention", "@cooladmin", None),
+        ("hashtag", "#opisrael", None),
+        ("text_url", "https://www.t.me/Leaks", "t.me"),
+    ]
+    assert all(e.message_id == 456 and e.channel_id == 123 for e in entities)
@@ -0,0 +1,94 @@
+import time
+
+import pytest
+from telethon.errors import FloodWaitError
+from telethon.tl.types import Message, PeerChannel
+
+from src.ratelimit import RateLimit, RateLimitedClient, RateLimiter
+
+
+class FakeClient:
+    """Serves messages 1..10 and raises the scripted flood waits."""
+
+    def __init__(self, flood_waits):
+        self.flood_waits = list(flood_waits)
+        self.calls = []
+        self.flood_sleep_threshold = 60
+
+    def _maybe_flood(self):
+        if self.flood_waits and self.flood_waits[0] == len(self.calls):
+            self.flood_waits.pop(0)
+            raise FloodWaitError(request=None, capture=0)
+
+    async def get_entity(self, entity):
+        self.calls.append(("get_entity", entity))
+        self._maybe_flood()
+        return entity
+
+    async def iter_messages(self, entity, limit=None, min_id=0, reverse=False, **kwargs):
+        for message_id in range(min_id + 1, 11):
+            self.calls.append(("iter_messages", message_id))
+            self._maybe_flood()
+            yield Message(id=message_id, peer_id=PeerChannel(channel_id=123))
+
+    async def iter_download(self, file, offset=0, limit=None, **kwargs):
+        data = b"0123456789"
+        for position in range(offset, len(data), 2):
+            self.calls.append(("iter_download", position))
+            self._maybe_flood()
+            yield data[position:position + 2]
+
+
+def make_client(flood_waits):
+    limiter = RateLimiter(flood_wait_margin=0)
+    return RateLimitedClient(FakeClient(flood_waits), limiter)
+
+
+@pytest.mark.asyncio
+async def test_call_is_retried_after_flood_wait():
+    client = make_client(flood_waits=[1])
+    assert client.client.flood_sleep_threshold == 0
+    assert await client.get_entity("channel") == "channel"
+    assert client.limiter.flood_waits == 1
+    assert len(client.client.calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_iter_messages_resumes_after_flood_wait():
+    client = make_client(flood_waits=[3, 7])
+    message_ids = [m.id async for m in client.iter_messages("channel", reverse=True)]
+    assert message_ids == list(range(1, 11))
+    assert client.limiter.flood_waits == 2
+
+
+@pytest.mark.asyncio
+async def test_iter_download_resumes_at_offset():
+    client = make_client(flood_waits=[2])
+    chunks = [chunk async for chunk in client.iter_download("file")]
+    assert b"".join(chunks) == b"0123456789"
+
+
+@pytest.mark.asyncio
+async def test_flood_wait_gives_up_after_max_retries():
+    client = make_client(flood_waits=[1, 2, 3, 4, 5, 6])
+    client.limiter.max_retries = 2
+    with pytest.raises(FloodWaitError):
+        await client.get_entity("channel")
+
+
+@pytest.mark.asyncio
+async def test_flood_wait_pauses_every_request_class():
+    limiter = RateLimiter(flood_wait_margin=0.2)
+    limiter.flood_wait(FloodWaitError(request=None, capture=0), attempt=1)
+    started_at = time.monotonic()
+    await limiter.wait("download")
+    assert time.monotonic() - started_at >= 0.15
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_paces_requests():
+    limiter = RateLimiter({"entity": RateLimit(requests_per_second=20, burst=1)})
+    started_at = time.monotonic()
+    for _ in range(3):
+        await limiter.wait("entity")
+    assert time.monotonic() - started_at >= 0.09
@@ -0,0 +1,51 @@
+import pytest
+from telethon.tl.types import Channel, ChatPhotoEmpty, Message, PeerChannel
+
+from src.db import Database
+from src.message import MessageData
+from src.reconcile import reconcile_channel
+
+
+class FakeReconcileClient:
+    def __init__(self, existing_ids):
+        self.existing_ids = set(existing_ids)
+        self.requests = []
+
+    async def get_entity(self, channel):
+        return Channel(
+            id=123, title="Cool", photo=ChatPhotoEmpty(), date=None, username="MyCoolChannel"
+        )
+
+    async def get_messages(self, entity, ids):
+        self.requests.append(ids)
+        return [
+            Message(id=message_id, peer_id=PeerChannel(channel_id=123))
+            if message_id in self.existing_ids else None
+            for message_id in ids
+        ]
+
+
+@pytest.mark.asyncio
+async def test_reconcile_marks_deleted_messages_incrementally(tmp_path):
+    async with Database(str(tmp_path / "test.db")) as db:
+        await db.create_schema()
+        await db.save_messages_batch(
+            [MessageData(message_id, 123, "MyCoolChannel") for message_id in range(1, 251)],
+            [], [], 123, "MyCoolChannel",
+        )
+        client = FakeReconcileClient(set(range(1, 251)) - {3, 180})
+
+        first = await reconcile_channel(client, db, "MyCoolChannel", ids_per_pass=150)
+        assert (first.checked, first.deleted, first.finished_round) == (150, 1, False)
+        assert [len(ids) for ids in client.requests] == [100, 50]
+
+        second = await reconcile_channel(client, db, "MyCoolChannel", ids_per_pass=150)
+        assert (second.checked, second.deleted, second.finished_round) == (100, 1, True)
+        assert client.requests[2][0] == 151
+        assert (await db.get_scrape_state(123)).last_reconciled_message_id == 0
+
+        async with db.db_cursor() as cursor:
+            await cursor.execute(
+                "SELECT message_id FROM messages WHERE deleted_at IS NOT NULL ORDER BY message_id"
+            )
+            assert await cursor.fetchall() == [(3,), (180,)]
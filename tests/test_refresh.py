@@ -0,0 +1,81 @@
+import datetime
+
+import pytest
+from telethon.tl.types import (Channel, ChatPhotoEmpty, Message, MessageReactions,
+                               PeerChannel, ReactionCount, ReactionEmoji)
+
+from src.db import Database
+from src.message import create_message_data
+from src.refresh import get_refresh_interval, refresh_channel
+
+
+def make_message(message_id: int, date: datetime.datetime, views: int, likes: int = 0) -> Message:
+    return Message(
+        id=message_id,
+        peer_id=PeerChannel(channel_id=123),
+        date=date,
+        message="Super important message!",
+        views=views,
+        forwards=1,
+        reactions=MessageReactions(
+            results=[ReactionCount(reaction=ReactionEmoji(emoticon="👍"), count=likes)]
+        ),
+    )
+
+
+class FakeRefreshClient:
+    def __init__(self, messages):
+        self.messages = {message.id: message for message in messages}
+        self.requests = []
+
+    async def get_entity(self, channel):
+        return Channel(
+            id=123, title="Cool", photo=ChatPhotoEmpty(), date=None, username="MyCoolChannel"
+        )
+
+    async def get_messages(self, entity, ids):
+        self.requests.append(ids)
+        return [self.messages.get(message_id) for message_id in ids]
+
+
+def test_refresh_interval_grows_with_message_age():
+    assert get_refresh_interval(60) < get_refresh_interval(6 * 60 * 60) < get_refresh_interval(3 * 24 * 60 * 60)
+    assert get_refresh_interval(30 * 24 * 60 * 60) is None
+
+
+@pytest.mark.asyncio
+async def test_refresh_updates_changed_columns_of_due_messages(tmp_path):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    stored = [
+        make_message(1, now - datetime.timedelta(days=30), views=5),
+        make_message(2, now - datetime.timedelta(minutes=5), views=10),
+        make_message(3, now - datetime.timedelta(minutes=5), views=10),
+    ]
+    async with Database(str(tmp_path / "test.db")) as db:
+        await db.create_schema()
+        await db.save_messages_batch(
+            [create_message_data(m, 123, "MyCoolChannel", None, None) for m in stored],
+            [], [], 123, "MyCoolChannel",
+        )
+        client = FakeRefreshClient(
+            [
+                make_message(2, stored[1].date, views=25, likes=4),
+                make_message(3, stored[2].date, views=10),
+            ]
+        )
+
+        assert (await db.get_scrape_state(123)).last_reaction_sync is None
+        stats = await refresh_channel(client, db, "MyCoolChannel")
+        assert client.requests == [[2, 3]]
+        assert (stats.refreshed, stats.changed, stats.missing) == (2, 1, 0)
+        assert (await db.get_scrape_state(123)).last_reaction_sync is not None
+
+        async with db.db_cursor() as cursor:
+            await cursor.execute("SELECT message_id, message_views FROM messages ORDER BY message_id")
+            assert await cursor.fetchall() == [(1, 5), (2, 25), (3, 10)]
+            await cursor.execute("SELECT message_id, emoticon_count FROM reactions ORDER BY message_id")
+            assert await cursor.fetchall() == [(2, 4), (3, 0)]
+
+        # refreshed just now, nothing is due yet
+        assert (await refresh_channel(client, db, "MyCoolChannel")).refreshed == 0
+        assert len(client.requests) == 1
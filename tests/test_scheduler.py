@@ -0,0 +1,29 @@
+import asyncio
+
+import pytest
+
+from src.scheduler import ChannelScheduler
+
+
+@pytest.mark.asyncio
+async def test_scheduler_bounds_concurrency_and_reports_timings():
+    running = 0
+    max_running = 0
+
+    async def pipeline(channel: str) -> None:
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        if channel == "broken":
+            raise ValueError(channel)
+
+    channels = ["first", "second", "broken", "third", "fourth"]
+    scheduler = ChannelScheduler(pipeline, max_concurrent_channels=2)
+    timings = await scheduler.run(channels)
+
+    assert max_running == 2
+    assert sorted(timing.channel for timing in timings) == sorted(channels)
+    assert [timing.channel for timing in timings if not timing.succeeded] == ["broken"]
+    assert "FAILED" in scheduler.format_timings()
@@ -0,0 +1,74 @@
+import datetime
+import time
+
+import aiosqlite
+import pytest
+
+from src.db import Database
+from src.message import MessageData
+from src.search import search_messages, to_fts_query
+
+
+def make_message_data(message_id: int, channel_name: str, text: str, day: int) -> MessageData:
+    return MessageData(
+        message_id=message_id,
+        channel_id=1 if channel_name == "first" else 2,
+        channel_name=channel_name,
+        message_date=datetime.datetime(2023, 5, day, 12, 0, 0, tzinfo=datetime.timezone.utc),
+        message_text=text,
+    )
+
+
+def test_to_fts_query_quotes_words():
+    assert to_fts_query('t.me/leaks "dump"') == '"t.me/leaks" """dump"""'
+
+
+@pytest.mark.asyncio
+async def test_search_ranks_and_filters_messages(tmp_path):
+    async with Database(str(tmp_path / "test.db")) as db:
+        await db.create_schema()
+        messages = [
+            make_message_data(1, "first", "Атака на банк завтра", 1),
+            make_message_data(2, "first", "Le café est fermé", 2),
+            make_message_data(3, "second", "атака атака атака", 3),
+            make_message_data(4, "second", "nothing to see", 4),
+        ]
+        for message_data in messages:
+            await db.save_messages_batch(
+                [message_data], [], [], message_data.channel_id, message_data.channel_name
+            )
+
+        results = await search_messages(db, "АТАКА")
+        assert [(r.channel_name, r.message_id) for r in results] == [("second", 3), ("first", 1)]
+        assert "[Атака]" in results[1].snippet
+
+        assert [r.message_id for r in await search_messages(db, "cafe ferme")] == [2]
+        assert [r.message_id for r in await search_messages(db, "атака", channels=["first"])] == [1]
+        assert [r.message_id for r in await search_messages(db, "атака", until="2023-05-02")] == [1]
+
+        await db.save_refreshed_messages(
+            messages[3].channel_id, messages[3].channel_name, [(4, {"message_text": "новая атака"})], [4], time.time(), []
+        )
+        assert [r.message_id for r in await search_messages(db, "новая")] == [4]
+        assert await search_messages(db, "nothing") == []
+
+
+@pytest.mark.asyncio
+async def test_migration_indexes_existing_messages(tmp_path):
+    db_name = str(tmp_path / "test.db")
+    async with aiosqlite.connect(db_name) as connection:
+        await connection.executescript(
+            """
+            CREATE TABLE messages (id INTEGER PRIMARY KEY, message_id INTEGER, channel_id INTEGER,
+                channel_name TEXT, message_date TIMESTAMPTZ(0), message_text TEXT, url_in_message TEXT,
+                message_fwd_from_channel_id INTEGER, message_fwd_from_channel_username TEXT,
+                last_processed_message_id INTEGER DEFAULT 0, UNIQUE (message_id, channel_id));
+            INSERT INTO messages (message_id, channel_id, channel_name, message_text)
+                VALUES (1, 123, 'first', 'old leak');
+            """
+        )
+        await connection.commit()
+
+    async with Database(db_name) as db:
+        await db.create_schema()
+        assert [r.message_id for r in await search_messages(db, "leak")] == [1]